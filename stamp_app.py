@@ -1,141 +1,132 @@
+import time
+
+STARTED = time.perf_counter()
+
+import json
+import os
 import tkinter as tk
-from tkinter import messagebox, scrolledtext, ttk
+from tkinter import messagebox, ttk
 from datetime import datetime, timedelta
-from pytz import timezone, utc
-import sqlite3
-import yaml
-import csv
-from pathlib import Path
+from pytz import utc
+from stamp_core import StampCore
+from stamp_sql import STATS
+from stamp_writer import DatabaseWriter
+# Browse, export and the query grid (and numpy with them) are imported when first used
+
+WRITER_POLL_MS = 20
+STARTUP_LOG = 'out/startup_times.jsonl'
+
+
+class StartupTimer:
+    # Milliseconds from the app's first import to each startup milestone. With startup_timing: true in
+    # defaults.yaml (or STAMP_STARTUP_TIMING=1) they are printed and appended to a JSON lines log.
+    def __init__(self, started=STARTED):
+        self.started = started
+        self.marks = {}
+
+    def mark(self, name):
+        self.marks[name] = round((time.perf_counter() - self.started) * 1000, 1)
+
+    def report(self, log_path=None):
+        print('startup: ' + ', '.join(f"{name} {ms:.0f} ms" for name, ms in self.marks.items()))
+        if log_path is not None:
+            log_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(log_path, 'a') as file:
+                file.write(json.dumps({'time': datetime.now().isoformat(timespec='seconds'), **self.marks}) + '\n')
+
 
 class StampApp:
     def __init__(self, root):
         self.root = root
         self.root.title("Stamp In/Out Application")
-
-        # Load defaults from YAML file
-        self.defaults = self.load_defaults('defaults.yaml')
-
-        # Load codes from defaults
-        self.codes = [code.strip() for code in self.defaults.get('codes', 'work,lunch,play').split(',')]
-        self.default_code_stamp_in = self.defaults.get('default_code_stamp_in', 'work')
-        self.default_code_stamp_out = self.defaults.get('default_code_stamp_out', 'play')
-
-        self.lunch_start = datetime.strptime(self.defaults.get('typical_lunch_start', '10:30'), '%H:%M').time()
-        self.lunch_stop = datetime.strptime(self.defaults.get('typical_lunch_stop', '13:00'), '%H:%M').time()
+        self.timer = StartupTimer()
+        self.timer.mark('imports')
+
+        # Database, config and queries live in the tkinter-free core. Schema and daily totals are
+        # checked in finish_startup, once the window is up. With server_url set the database file is
+        # never opened: the stamp server (stamp_server.py) owns it, migrates it and group-commits for
+        # everyone, and stamps, the status and Modify go through it. Browse needs the file and is off.
+        self.core = StampCore(setup=False, connect=False)
+        self.client = None
+        if self.core.server_url:
+            from stamp_server import RemoteWriter, StampClient
+            self.client = StampClient(self.core.server_url)
+        else:
+            self.core.connect()
+        self.timer.mark('config')
+        self.defaults = self.core.defaults
+        self.codes = self.core.codes
+        self.default_code_stamp_in = self.core.default_code_stamp_in
+        self.default_code_stamp_out = self.core.default_code_stamp_out
+        self.time_zone = self.core.time_zone
+        self.conn = self.core.conn
+        self.DB_FILE = self.core.DB_FILE
+        print('using server:' if self.client else 'using database:', self.core.server_url or self.DB_FILE)
 
         self.stamped_in = None
-        self.time_zone = timezone(str(datetime.now().astimezone().tzinfo))
 
         self.text_size = self.defaults.get('text_size', 12)
         self.font = self.defaults.get('font', 'Courier')
 
         self.setup_ui()
+        self.status_label.config(text="Status: checking the database...")
+        # Nothing is stamped or browsed before the schema is known to be current
+        for button in (self.stamp_button, self.modify_button, self.browse_button):
+            button.config(state=tk.DISABLED)
 
         # init
-        db_path = Path(self.defaults.get('db_path', 'out/current/time_log.db'))
-        if not (db_path.is_file() and db_path.suffix == '.db'):
-            db_path = Path('out/current/time_log.db')
-        print('using database:', db_path)
-        self.DB_FILE = db_path 
-        path = Path(self.DB_FILE)
-        path.parent.mkdir(parents=True, exist_ok=True)
-        self.conn = sqlite3.connect(self.DB_FILE)
-        self.setup_database()
-
-        # Set the database file path and backup if necesarry
-        self.DB_FILE.parent.mkdir(exist_ok=True)
-        self.backup_days = int(self.defaults.get('backup_days', '7'))
-        self.backup_dir = Path(self.defaults.get('backup_dir', 'out/backups/'))
-        self.backup_dir.mkdir(parents=True, exist_ok=True)
-        self.check_creation_date_and_backup()
+        if self.client is not None:
+            self.store = self.client
+            self.writer = RemoteWriter(self.client)
+        else:
+            self.store = self.core
+            self.writer = DatabaseWriter(self.DB_FILE)
+        self.writer.start()
+        self.backup_job = None
 
         # Set window size after UI is created
+        self.window_size = None
         self.set_window_size()
-        self.update_status_from_database()
-    
-    def check_creation_date_and_backup(self):
-        def copy_file(src, dst):
-            dst.write_bytes(src.read_bytes())
+        self.timer.mark('window')
+        # The first idle pass draws the window; the rest of startup is queued behind it
+        self.root.after_idle(lambda: self.root.after(0, self.finish_startup))
 
-        current_time = datetime.now()
-        creation_time = self.get_last_backup_info() 
-        if creation_time is None:
-            age_in_days = self.backup_days + 1
-        else:
-            age_in_days = (current_time - creation_time).days
+    def finish_startup(self):
+        self.timer.mark('first_paint')
+        try:
+            if self.client is None and self.core.setup_database():
+                self.timer.mark('daily_totals_rebuilt')
+            self.update_status_from_database()
+        except Exception as e:
+            messagebox.showerror("Error", f"Could not open the database: {e}")
+            self.on_closing()
+            return
+        for button in (self.stamp_button, self.modify_button) + ((self.browse_button,) if self.client is None else ()):
+            button.config(state=tk.NORMAL)
+        self.timer.mark('interactive')
 
-        if age_in_days >= self.backup_days:
-            backup_filename = f"{current_time.strftime('%Y-%m-%d')}_{self.DB_FILE.name}"
-            backup_path = self.backup_dir / backup_filename
-            copy_file(self.DB_FILE, backup_path)
-            self.write_backup_log(current_time, backup_path)
-            print(f"Database backed up to: {backup_path}")
+        # Backup if necesarry; the server's database is backed up where it runs
+        if self.client is None:
+            self.check_creation_date_and_backup()
+        if self.defaults.get('startup_timing') or os.environ.get('STAMP_STARTUP_TIMING'):
+            self.timer.report(self.core.base_dir / STARTUP_LOG)
+
+    def check_creation_date_and_backup(self):
+        if self.core.backup_due():
+            # Runs on its own connection so startup does not wait for the copy
+            self.backup_job = self.core.start_backup()
 
-    def load_defaults(self, file_path):
-        try:
-            with open(file_path, 'r') as file:
-                return yaml.safe_load(file)
-        except FileNotFoundError:
-            return {}
-        except yaml.YAMLError as e:
-            return {}
-
-    def setup_database(self):
-        cursor = self.conn.cursor()
-        try:
-            cursor.execute('''CREATE TABLE IF NOT EXISTS log (
-                                id INTEGER PRIMARY KEY,
-                                timestamp TEXT NOT NULL,
-                                status TEXT NOT NULL,
-                                code TEXT NOT NULL,
-                                comment TEXT
-                            )''')
-            cursor.execute('''CREATE TABLE IF NOT EXISTS backup_log (
-                                time TEXT PRIMARY KEY,
-                                backup_path TEXT NOT NULL
-                            )''')
-            self.conn.commit()
-        finally:
-            cursor.close()
-
-    def write_backup_log(self, dt, backup_path):
-        cursor = self.conn.cursor()
-        try:
-            cursor.execute('INSERT INTO backup_log (time, backup_path) VALUES (?, ?)', 
-                           (dt.strftime('%Y-%m-%d %H:%M:%S'), str(backup_path)))
-            self.conn.commit()
-        finally:
-            cursor.close()
-
-    def get_last_backup_info(self):
-        cursor = self.conn.cursor()
-        try:
-            cursor.execute('SELECT time FROM backup_log ORDER BY time DESC LIMIT 1')
-            last_backup = cursor.fetchone()
-            if last_backup:
-                last_backup_time = datetime.strptime(last_backup[0], '%Y-%m-%d %H:%M:%S')
-                return last_backup_time
-            else:
-                return None
-        finally:
-            cursor.close()
-            
     def update_status_from_database(self):
-        cursor = self.conn.cursor()
-        try:
-            cursor.execute("SELECT timestamp, status FROM log ORDER BY timestamp DESC LIMIT 1")
-            last_db_entry = cursor.fetchone()
-        finally:
-            cursor.close()
+        last_db_entry = self.store.last_entry()
 
         status = 'in'
         if last_db_entry:
-            last_entry_time_utc = datetime.fromisoformat(last_db_entry[0]).replace(tzinfo=utc)
+            last_entry_time_utc = last_db_entry[0]
             last_entry_time_local = last_entry_time_utc.astimezone(self.time_zone)
             status = last_db_entry[1]
             status_msg = f"Status: {status} @{last_entry_time_local.strftime('%Y-%m-%d %H:%M:%S')}"
             self.status_label.config(text=status_msg)
-            self.stamped_in = last_entry_time_utc if status == 'in' else None
+            self.stamped_in = self.store.open_session_start()
         else:
             self.status_label.config(text="Status: ")
         self.set_window_size()
@@ -149,6 +140,9 @@ class StampApp:
         # Get the required window size
         width = self.root.winfo_reqwidth() + 40
         height = self.root.winfo_reqheight()
+        if (width, height) == self.window_size:
+            return
+        self.window_size = (width, height)
         
         # Get the screen dimensions
         screen_width = self.root.winfo_screenwidth()
@@ -202,6 +196,9 @@ class StampApp:
                                      font=(self.font, self.text_size), command=self.browse_entries)
         self.browse_button.pack(pady=5)
 
+        # SQL statistics live behind F12 so the main window stays small
+        self.root.bind('<F12>', self.show_diagnostics)
+
     def stamp_in_out(self):
         now_utc = datetime.now(utc)
         now_local = now_utc.astimezone(self.time_zone)
@@ -210,13 +207,7 @@ class StampApp:
             self.stamped_in = now_utc
             code = self.code_var.get()
             comment = self.comment_var.get()
-            cursor = self.conn.cursor()
-            try:
-                cursor.execute("INSERT INTO log (timestamp, status, code, comment) VALUES (?, ?, ?, ?)", 
-                             (now_utc.isoformat(), 'in', code, comment))
-                self.conn.commit()
-            finally:
-                cursor.close()
+            self.write_stamp(now_utc, 'in', code, comment)
 
             self.comment_label.config(text=self.defaults.get('stamp_out_comment_msg', 'Stamp out comment:'))
             self.comment_var.set(self.defaults.get('default_stamp_out_comment', ''))
@@ -230,13 +221,7 @@ class StampApp:
             comment = self.comment_var.get()
             comment = comment if comment != "" else default_comment
 
-            cursor = self.conn.cursor()
-            try:
-                cursor.execute("INSERT INTO log (timestamp, status, code, comment) VALUES (?, ?, ?, ?)", 
-                             (now_utc.isoformat(), 'out', code, comment))
-                self.conn.commit()
-            finally:
-                cursor.close()
+            self.write_stamp(now_utc, 'out', code, comment)
 
             self.stamped_in = None
             self.comment_label.config(text=self.defaults.get('stamp_in_comment_msg', 'Stamp in comment:'))
@@ -248,19 +233,41 @@ class StampApp:
         self.status_label.config(text=status_msg)
         self.root.update_idletasks()
 
+    def write_stamp(self, now_utc, status, code, comment):
+        self.submit_write(self.store.insert_write(now_utc, status, code, comment))
+
+    def submit_write(self, write, on_done=None):
+        # The status text stays gray until every queued write has been committed
+        self.writer.submit(write, lambda result, error: self.on_write_done(result, error, on_done))
+        self.status_label.config(fg='gray')
+        if self.writer.pending == 1:
+            self.root.after(WRITER_POLL_MS, self.poll_writer)
+
+    def poll_writer(self):
+        self.writer.dispatch()
+        if self.writer.pending:
+            self.root.after(WRITER_POLL_MS, self.poll_writer)
+        else:
+            self.status_label.config(fg='black')
+
+    def on_write_done(self, result, error, on_done):
+        if self.core.cache is not None:
+            self.core.cache.invalidate()
+        if error is not None:
+            messagebox.showerror("Error", f"Could not save to the database: {error}")
+            self.update_status_from_database()
+        if on_done is not None:
+            on_done()
+
     def modify_last_entry(self):
         try:
-            cursor = self.conn.cursor()
-            try:
-                cursor.execute("SELECT id, timestamp, status, comment FROM log ORDER BY id DESC LIMIT 1")
-                last_entry = cursor.fetchone()
-            finally:
-                cursor.close()
-
-            if last_entry is None:
+            last_entry_id = self.store.latest_id()
+            if last_entry_id is None:
                 raise Exception("No entries found")
 
-            entry_id_var = tk.StringVar(value=last_entry[0])
+            entry_id_var = tk.StringVar(value=last_entry_id)
+            # Rows around the current id, refilled in the background as < and > approach its edges
+            entry_window = self.store.entry_window()
 
             modify_window = tk.Toplevel(self.root)
             modify_window.title("Modify Entry")
@@ -274,13 +281,7 @@ class StampApp:
                     entry_display.config(state=tk.DISABLED)
                     return
 
-                cursor = self.conn.cursor()
-                try:
-                    cursor.execute("SELECT id, timestamp, status, code, comment FROM log WHERE id = ?", (entry_id,))
-                    entry = cursor.fetchone()
-                finally:
-                    cursor.close()
-
+                entry = entry_window.get(int(entry_id))
                 if entry:
                     entry_str = f"ID: {entry[0]}\nTimestamp: {entry[1]}\nStatus: {entry[2]}\nCode: {entry[3]}\nComment: {entry[4]}"
                     entry_display.config(state=tk.NORMAL)
@@ -298,14 +299,12 @@ class StampApp:
                 if not entry_id.isdigit():
                     return
 
-                cursor = self.conn.cursor()
-                try:
-                    cursor.execute("DELETE FROM log WHERE id = ?", (entry_id,))
-                    self.conn.commit()
-                finally:
-                    cursor.close()
+                def on_done():
+                    if modify_window.winfo_exists():
+                        update_entry_display()
+                    self.update_status_from_database()
 
-                update_entry_display()
+                self.submit_write(self.store.delete_write(entry_id), on_done)
 
             def edit_entry():
                 entry_id = entry_id_var.get()
@@ -313,22 +312,24 @@ class StampApp:
                     return
                 self.edit_entry(int(entry_id))
 
+            def prefetch(entry_id):
+                if entry_window.near_edge(entry_id) and entry_window.refill_async(entry_id):
+                    modify_window.after(WRITER_POLL_MS, poll_prefetch)
+
+            def poll_prefetch():
+                if entry_window.poll():
+                    modify_window.after(WRITER_POLL_MS, poll_prefetch)
+
             def prev_entry():
                 entry_id = entry_id_var.get()
                 if not entry_id.isdigit():
                     return
                 entry_id = int(entry_id)
 
-                cursor = self.conn.cursor()
-                try:
-                    cursor.execute("SELECT id FROM log WHERE id < ? ORDER BY id DESC LIMIT 1", (entry_id,))
-                    prev_entry = cursor.fetchone()
-                finally:
-                    cursor.close()
-
+                prev_entry = entry_window.adjacent_id(entry_id, -1)
                 if prev_entry:
-                    entry_id_var.set(prev_entry[0])
-                    update_entry_display()
+                    entry_id_var.set(prev_entry)
+                    prefetch(prev_entry)
 
             def next_entry():
                 entry_id = entry_id_var.get()
@@ -336,16 +337,10 @@ class StampApp:
                     return
                 entry_id = int(entry_id)
 
-                cursor = self.conn.cursor()
-                try:
-                    cursor.execute("SELECT id FROM log WHERE id > ? ORDER BY id ASC LIMIT 1", (entry_id,))
-                    next_entry = cursor.fetchone()
-                finally:
-                    cursor.close()
-
+                next_entry = entry_window.adjacent_id(entry_id, 1)
                 if next_entry:
-                    entry_id_var.set(next_entry[0])
-                    update_entry_display()
+                    entry_id_var.set(next_entry)
+                    prefetch(next_entry)
 
             # Bind the update_entry_display method to the entry_id_var
             entry_id_var.trace_add("write", update_entry_display)
@@ -426,24 +421,63 @@ class StampApp:
             font=(self.font, self.text_size)
         )
         view_by_sql_button.grid(row=1, column=4, padx=5, pady=5)
+
+        # Full-text search over comments and codes
+        search_label = tk.Label(browse_window, text="Search:", font=(self.font, self.text_size))
+        search_label.grid(row=2, column=0, padx=5, pady=5, sticky='e')
+
+        search_var = tk.StringVar()
+        in_range_var = tk.BooleanVar(value=False)
+        search_entry = tk.Entry(browse_window, textvariable=search_var, font=(self.font, self.text_size))
+        search_entry.grid(row=2, column=1, columnspan=2, padx=5, pady=5, sticky='ew')
+        in_range_check = tk.Checkbutton(browse_window, text="in date range", variable=in_range_var,
+                                        font=(self.font, self.text_size))
+        in_range_check.grid(row=2, column=3, padx=5, pady=5, sticky='w')
+
+        def search():
+            self.search_entries(browse_window, search_var.get(), from_date_var.get(), to_date_var.get(), in_range_var.get())
+
+        search_entry.bind('<Return>', lambda e: search())
+        search_button = tk.Button(browse_window, text="Search", command=search, font=(self.font, self.text_size))
+        search_button.grid(row=2, column=4, padx=5, pady=5)
         
         # Dump to CSV button
+        gzip_var = tk.BooleanVar(value=False)
         dump_button = tk.Button(
             browse_window,
             text="Dump to CSV",
-            command=lambda: self.dump_to_csv(from_date_var.get(), to_date_var.get(), sql_var.get()),
+            command=lambda: self.dump_to_csv(browse_window, from_date_var.get(), to_date_var.get(), sql_var.get(),
+                                             gzip_var.get()),
             font=(self.font, self.text_size)
         )
-        dump_button.grid(row=2, column=0, columnspan=5, pady=10)
+        dump_button.grid(row=3, column=0, pady=10)
+        gzip_check = tk.Checkbutton(browse_window, text="gzip", variable=gzip_var, font=(self.font, self.text_size))
+        gzip_check.grid(row=3, column=1, padx=5, pady=10, sticky='w')
 
-    def edit_entry(self, entry_id):
-        cursor = self.conn.cursor()
-        try:
-            cursor.execute("SELECT id, timestamp, status, code, comment FROM log WHERE id = ?", (entry_id,))
-            entry = cursor.fetchone()
-        finally:
-            cursor.close()
+        # Changes to every stamp in the date range at once
+        batch_button = tk.Button(
+            browse_window,
+            text="Batch Edit",
+            command=lambda: self.batch_edit(browse_window, from_date_var.get(), to_date_var.get()),
+            font=(self.font, self.text_size)
+        )
+        batch_button.grid(row=3, column=2, padx=5, pady=10)
+
+        # Time report over the date range
+        period_var = tk.StringVar(value='day')
+        period_dropdown = ttk.Combobox(browse_window, textvariable=period_var, values=['day', 'week', 'month', 'total'],
+                                       font=(self.font, self.text_size), width=8, state='readonly')
+        period_dropdown.grid(row=3, column=3, padx=5, pady=10, sticky='e')
+        report_button = tk.Button(
+            browse_window,
+            text="Report",
+            command=lambda: self.show_report(from_date_var.get(), to_date_var.get(), period_var.get()),
+            font=(self.font, self.text_size)
+        )
+        report_button.grid(row=3, column=4, padx=5, pady=10)
 
+    def edit_entry(self, entry_id):
+        entry = self.store.get_entry(entry_id)
         if not entry:
             messagebox.showerror("Error", f"No entry found with ID {entry_id}")
             return
@@ -474,16 +508,9 @@ class StampApp:
                 messagebox.showerror("Error", "Invalid ID or Timestamp format.")
                 return
 
-            cursor = self.conn.cursor()
-            try:
-                cursor.execute("UPDATE log SET timestamp = ?, status = ?, code = ?, comment = ? WHERE id = ?", 
-                             (new_timestamp.isoformat(), new_status, new_code, new_comment, entry_id))
-                self.conn.commit()
-            finally:
-                cursor.close()
-
             edit_window.destroy()
-            self.update_status_from_database()
+            self.submit_write(self.store.update_write(entry_id, new_timestamp, new_status, new_code, new_comment),
+                              self.update_status_from_database)
 
         def cancel_edit():
             edit_window.destroy()
@@ -495,115 +522,290 @@ class StampApp:
 
         edit_window.protocol("WM_DELETE_WINDOW", edit_window.destroy)
 
-    def display_entries(self, window, from_date_str, to_date_str, query_str):
-        try:
-            cursor = self.conn.cursor()
+    def batch_edit(self, browse_window, from_date_str, to_date_str):
+        from stamp_batch import (OPERATIONS, batch_write, describe, list_batches, preview, selection, skipped_lines,
+                                 undo_write)
+
+        batch_window = tk.Toplevel(self.root)
+        batch_window.title(f"Batch Edit: {from_date_str} to {to_date_str}")
+
+        code_var = tk.StringVar()
+        status_var = tk.StringVar()
+        match_var = tk.StringVar()
+        operation_var = tk.StringVar(value='recode')
+        value_var = tk.StringVar()
+        new_var = tk.StringVar()
+        info_var = tk.StringVar()
+
+        labels = ["Only code:", "Only status:", "Comment contains:", "Operation:",
+                  "Value (hours, code, comment or text to replace):", "Replace with:"]
+        for row, text in enumerate(labels):
+            tk.Label(batch_window, text=text, font=(self.font, self.text_size)).grid(row=row, column=0, padx=5, pady=5, sticky='e')
+        ttk.Combobox(batch_window, textvariable=code_var, values=[''] + self.codes,
+                     font=(self.font, self.text_size)).grid(row=0, column=1, padx=5, pady=5, sticky='ew')
+        ttk.Combobox(batch_window, textvariable=status_var, values=['', 'in', 'out'], state='readonly',
+                     font=(self.font, self.text_size)).grid(row=1, column=1, padx=5, pady=5, sticky='ew')
+        tk.Entry(batch_window, textvariable=match_var, font=(self.font, self.text_size)).grid(row=2, column=1, padx=5, pady=5, sticky='ew')
+        ttk.Combobox(batch_window, textvariable=operation_var, values=OPERATIONS, state='readonly',
+                     font=(self.font, self.text_size)).grid(row=3, column=1, padx=5, pady=5, sticky='ew')
+        tk.Entry(batch_window, textvariable=value_var, font=(self.font, self.text_size)).grid(row=4, column=1, padx=5, pady=5, sticky='ew')
+        tk.Entry(batch_window, textvariable=new_var, font=(self.font, self.text_size)).grid(row=5, column=1, padx=5, pady=5, sticky='ew')
+        tk.Label(batch_window, textvariable=info_var, font=(self.font, self.text_size)).grid(row=7, column=0, columnspan=2, pady=5)
+        batch_window.grid_columnconfigure(1, weight=1)
+
+        def selected():
+            where, params = selection(*self.core.epoch_range(from_date_str, to_date_str),
+                                      code_var.get(), status_var.get(), match_var.get())
+            operation = operation_var.get()
+            value = {'shift': lambda: timedelta(hours=float(value_var.get())),
+                     'replace': lambda: (value_var.get(), new_var.get()),
+                     'delete': lambda: None}.get(operation, value_var.get)()
+            return where, params, operation, value
+
+        def show_preview():
             try:
-                if query_str:  # SQL filter mode
-                    cursor.execute(query_str)
-                    rows = cursor.fetchall()
-                    header_text = f"Entries for query: {query_str}\n\n"
-                else:  # Date filter mode
-                    from_date = self.parse_date(from_date_str, datetime.now() - timedelta(days=7), seconds_included=True)
-                    if from_date.tzinfo is None:
-                        from_date = self.time_zone.localize(from_date).astimezone(utc)
-
-                    to_date = self.parse_date(to_date_str, datetime.now(), seconds_included=False)
-                    if to_date.tzinfo is None:
-                        to_date = self.time_zone.localize(to_date).astimezone(utc)
-
-                    to_date = to_date.replace(second=59, microsecond=999999)
-                    
-                    cursor.execute(
-                        "SELECT * FROM log WHERE timestamp BETWEEN ? AND ?",
-                        (from_date.isoformat(), to_date.isoformat())
-                    )
-                    rows = cursor.fetchall()
-                    header_text = f"Entries from {from_date_str} to {to_date_str}:\n\n"
-            finally:
-                cursor.close()
-
-            # Clear any existing display
-            for widget in window.winfo_children():
-                if isinstance(widget, scrolledtext.ScrolledText):
-                    widget.destroy()
-
-            entry_display = scrolledtext.ScrolledText(window, wrap=tk.WORD, width=100, height=20, 
-                                                    font=(self.font, self.text_size))
-            entry_display.grid(row=3, column=0, columnspan=5, padx=5, pady=5, sticky='nsew')
+                where, params, operation, value = selected()
+                info_var.set(f"{describe(operation, value)}: {preview(self.conn, where, params)[0]} stamps")
+            except Exception as e:
+                messagebox.showerror("Error", str(e), parent=batch_window)
 
+        def on_done():
+            self.update_status_from_database()
+            batches = list_batches(self.conn)
+            if batches and batch_window.winfo_exists():
+                batch_id, _, description, rows, undone = batches[0]
+                info_var.set(f"Batch {batch_id} {'undone' if undone else 'applied'}: {description}, {rows} stamps")
+            if browse_window.winfo_exists():
+                self.display_entries(browse_window, from_date_str, to_date_str, None)
+
+        def submit(write, done=on_done):
+            # Browse, and batch edits with it, are only there without a stamp server
+            self.submit_write(write, done)
+
+        def apply():
+            try:
+                where, params, operation, value = selected()
+                rows = preview(self.conn, where, params)[0]
+                write = batch_write(where, params, operation, value, daily_totals=self.core.daily_totals)
+            except Exception as e:
+                messagebox.showerror("Error", str(e), parent=batch_window)
+                return
             if not rows:
-                entry_display.insert(tk.END, "No entries found for the specified filter.")
-            else:
-                entry_display.insert(tk.END, header_text)
-                for row in rows:
-                    row_utc_time = datetime.fromisoformat(row[1]).replace(tzinfo=utc)
-                    entry_text = f"ID: {row[0]}, Timestamp: {row_utc_time.strftime('%Y-%m-%d %H:%M:%S')}, " \
-                               f"Status: {row[2]}, Code: {row[3]}, Comment: {row[4]}\n"
-                    entry_display.insert(tk.END, entry_text)
+                info_var.set("No stamps match")
+            elif messagebox.askyesno("Batch Edit", f"{describe(operation, value)}: change {rows} stamps?", parent=batch_window):
+                submit(write)
+
+        def undo():
+            undone = []
+
+            def write(conn):
+                undone[:] = [undo_write(self.core.daily_totals)(conn)]
+                return undone[0]
+
+            def done():
+                on_done()
+                lines = skipped_lines(undone[0][2]) if undone and undone[0] else []
+                if lines and batch_window.winfo_exists():
+                    messagebox.showwarning("Undo", '\n'.join(lines), parent=batch_window)
+
+            submit(write, done)
+
+        btn_frame = tk.Frame(batch_window)
+        btn_frame.grid(row=6, column=0, columnspan=2, pady=5)
+        tk.Button(btn_frame, text="Preview", command=show_preview, font=(self.font, self.text_size)).pack(side=tk.LEFT, padx=5)
+        tk.Button(btn_frame, text="Apply", bg='orange', command=apply, font=(self.font, self.text_size)).pack(side=tk.LEFT, padx=5)
+        tk.Button(btn_frame, text="Undo Last", command=undo,
+                  font=(self.font, self.text_size)).pack(side=tk.LEFT, padx=5)
+        tk.Button(btn_frame, text="Close", bg='green', command=batch_window.destroy,
+                  font=(self.font, self.text_size)).pack(side=tk.LEFT, padx=5)
+
+    def display_entries(self, window, from_date_str, to_date_str, query_str):
+        from stamp_grid import LOG_SORT_KEYS, QueryGrid, ResultGrid
+        from stamp_query import QueryJob, typed_query
+
+        try:
+            self.clear_entries(window)
+
+            if query_str:  # SQL filter mode: read-only worker with a time limit, a row cap and Cancel
+                job = QueryJob(self.DB_FILE, typed_query(query_str),
+                               time_limit=self.core.sql_time_limit, row_cap=self.core.sql_row_cap,
+                               archives=self.core.query_archives(query_str))
+                entry_display = QueryGrid(window, job, f"Entries for query: {query_str}: ",
+                                          font=(self.font, self.text_size))
+            else:  # Date filter mode
+                where, params = "epoch_us BETWEEN ? AND ?", self.core.epoch_range(from_date_str, to_date_str)
+                header_text = f"Entries from {from_date_str} to {to_date_str}: "
+                entry_display = ResultGrid(window, self.conn, self.core.log_source(*params), where, params,
+                                           LOG_SORT_KEYS, header_text,
+                                           font=(self.font, self.text_size), cache=self.core.cache)
+            self.show_entries(window, entry_display)
 
         except Exception as e:
             messagebox.showerror("Error", str(e))
 
+    def search_entries(self, window, text, from_date_str, to_date_str, in_range):
+        from stamp_grid import QueryGrid
+        from stamp_query import QueryJob
 
-    def dump_to_csv(self, from_date_str, to_date_str, query_str):
         try:
-            from_date = self.parse_date(from_date_str, datetime.now() - timedelta(days=7), seconds_included=True)
-            if from_date.tzinfo is None:
-                from_date = self.time_zone.localize(from_date).astimezone(utc)
+            if in_range:
+                query, params = self.core.search_query(text, from_date_str, to_date_str)
+                header_text = f"Matches for {text} from {from_date_str} to {to_date_str}: "
+            else:
+                query, params = self.core.search_query(text)
+                header_text = f"Matches for {text}: "
+            self.clear_entries(window)
+            job = QueryJob(self.DB_FILE, query, params, time_limit=self.core.sql_time_limit, row_cap=self.core.sql_row_cap)
+            self.show_entries(window, QueryGrid(window, job, header_text, font=(self.font, self.text_size)))
+        except Exception as e:
+            messagebox.showerror("Error", str(e))
 
-            to_date = self.parse_date(to_date_str, datetime.now(), seconds_included=False)
-            if to_date.tzinfo is None:
-                to_date = self.time_zone.localize(to_date).astimezone(utc)
+    def clear_entries(self, window):
+        from stamp_grid import QueryGrid, ResultGrid
 
-            to_date = to_date.replace(second=59, microsecond=999999)
+        # A query still running is cancelled with its grid
+        for widget in window.winfo_children():
+            if isinstance(widget, (ResultGrid, QueryGrid)):
+                widget.destroy()
 
-            cursor = self.conn.cursor()
-            try:
-                if query_str:
-                    cursor.execute(query_str)
-                else:
-                    cursor.execute("SELECT * FROM log WHERE timestamp BETWEEN ? AND ?", (from_date.isoformat(), to_date.isoformat()))
-                rows = cursor.fetchall()
-            finally:
-                cursor.close()
+    def show_entries(self, window, entry_display):
+        entry_display.grid(row=4, column=0, columnspan=5, padx=5, pady=5, sticky='nsew')
+        window.grid_rowconfigure(4, weight=1)
 
-            if not rows:
-                messagebox.showinfo("Info", "No entries found for the specified date range.")
-                return
 
-            path = Path('out')
+    def dump_to_csv(self, window, from_date_str, to_date_str, query_str, compress=False):
+        from stamp_export import ExportJob
+
+        try:
+            query, params, archives = self.core.export_query(from_date_str, to_date_str, query_str)
+
+            path = self.core.out_dir
             path.mkdir(exist_ok=True) 
-            csv_filename = f"{from_date_str[:10]}_{to_date_str[:10]}.csv"
-            with open(path / csv_filename, 'w', newline='') as csvfile:
-                csvwriter = csv.writer(csvfile)
-                csvwriter.writerow(['ID', 'Timestamp', 'Status', 'Code', 'Comment'])
-                for row in rows:
-                    row_utc_time = datetime.fromisoformat(row[1]).replace(tzinfo=utc)
-                    row_local_time = row_utc_time.astimezone(self.time_zone)
-                    csvwriter.writerow([row[0], row_local_time.strftime('%Y-%m-%d %H:%M:%S'), row[2], row[3], row[4]])
-                
-            messagebox.showinfo("Info", f"Data successfully dumped to {csv_filename}")
+            csv_filename = self.core.export_filename(from_date_str, to_date_str, compress)
+            job = ExportJob(self.DB_FILE, path / csv_filename, query, params, self.time_zone, compress,
+                            time_limit=self.core.sql_time_limit if query_str else None, archives=archives)
+
+            # Progress and cancel controls live in the browse window while the export runs
+            progress_frame = tk.Frame(window)
+            progress_frame.grid(row=5, column=0, columnspan=5, pady=5)
+            progress_label = tk.Label(progress_frame, text="Exporting...", font=(self.font, self.text_size))
+            progress_label.pack(side=tk.LEFT, padx=5)
+            tk.Button(progress_frame, text="Cancel", bg="red", command=job.cancel,
+                      font=(self.font, self.text_size)).pack(side=tk.LEFT, padx=5)
+
+            job.start()
+            self.poll_export(job, progress_frame, progress_label, csv_filename)
 
         except Exception as e:
             messagebox.showerror("Error", str(e))
 
-    def parse_date(self, date_str, default_time, seconds_included=True):
-        formats = [
-            "%Y-%m-%d %H:%M:%S" if seconds_included else "%Y-%m-%d %H:%M",
-            "%Y-%m-%d %H:%M"
-        ]
+    def poll_export(self, job, progress_frame, progress_label, csv_filename):
+        window_open = progress_frame.winfo_exists()
+        if job.is_alive():
+            if window_open:
+                progress_label.config(text=f"Exported {job.rows_written} rows...")
+            else:
+                job.cancel()
+            self.root.after(100, self.poll_export, job, progress_frame, progress_label, csv_filename)
+            return
 
-        for fmt in formats:
-            try:
-                return datetime.strptime(date_str, fmt)
-            except ValueError:
-                continue
+        if window_open:
+            progress_frame.destroy()
+        if job.error is not None:
+            messagebox.showerror("Error", str(job.error))
+        elif job.result is None:
+            if window_open:
+                messagebox.showinfo("Info", "Export cancelled.")
+        elif job.result == 0:
+            messagebox.showinfo("Info", "No entries found for the specified date range.")
+        else:
+            messagebox.showinfo("Info", f"Data successfully dumped to {csv_filename} ({job.result} rows)")
 
-        return default_time
+    def show_report(self, from_date_str, to_date_str, period):
+        try:
+            report = self.core.report(from_date_str, to_date_str, period)
+        except Exception as e:
+            messagebox.showerror("Error", str(e))
+            return
+
+        report_window = tk.Toplevel(self.root)
+        report_window.title(f"Report by {period}: {from_date_str} to {to_date_str}")
+
+        style = ttk.Style(report_window)
+        style.configure('Report.Treeview', font=(self.font, self.text_size), rowheight=2 * self.text_size)
+        style.configure('Report.Treeview.Heading', font=(self.font, self.text_size))
+        columns = ('Period', 'Code', 'Hours', 'Sessions')
+        tree = ttk.Treeview(report_window, columns=columns, show='headings', height=20, style='Report.Treeview')
+        for column in columns:
+            tree.heading(column, text=column)
+        for row in report.itertuples(index=False):
+            tree.insert('', tk.END, values=(row.period, row.code, f"{row.hours:.2f}", row.sessions))
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar = ttk.Scrollbar(report_window, orient=tk.VERTICAL, command=tree.yview)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        tree.configure(yscrollcommand=scrollbar.set)
+
+        if report.empty:
+            tree.insert('', tk.END, values=('', 'No sessions found', '', ''))
+
+    def show_diagnostics(self, event=None):
+        diagnostics_window = tk.Toplevel(self.root)
+        diagnostics_window.title("Diagnostics")
+
+        columns = ('Statement', 'Calls', 'Total ms', 'Mean ms', 'p95 ms', 'Max ms', 'Rows', 'Caller')
+        style = ttk.Style(diagnostics_window)
+        style.configure('Diagnostics.Treeview', font=(self.font, self.text_size), rowheight=2 * self.text_size)
+        style.configure('Diagnostics.Treeview.Heading', font=(self.font, self.text_size))
+        tree = ttk.Treeview(diagnostics_window, columns=columns, show='headings', height=20, style='Diagnostics.Treeview')
+        for column in columns:
+            tree.heading(column, text=column)
+            tree.column(column, width=500 if column in ('Statement', 'Caller') else 110, stretch=column == 'Statement')
+
+        record_var = tk.BooleanVar(value=STATS.enabled)
+        info_label = tk.Label(diagnostics_window, font=(self.font, self.text_size), anchor='w')
+
+        def refresh():
+            STATS.enabled = record_var.get()
+            info_label.config(text=f"Statements slower than {STATS.slow_ms:g} ms are logged to {STATS.slow_log}"
+                              if STATS.enabled else "Recording is off; turn it on or set sql_stats: true in defaults.yaml")
+            tree.delete(*tree.get_children())
+            statements = sorted(STATS.snapshot().items(), key=lambda item: -item[1]['total_ms'])
+            for sql, stats in statements:
+                tree.insert('', tk.END, values=(sql, stats['calls'], f"{stats['total_ms']:.1f}", f"{stats['mean_ms']:.2f}",
+                                                f"{stats['p95_ms']:g}", f"{stats['max_ms']:.1f}", stats['rows'],
+                                                next(iter(stats['callers']), '')))
+
+        def reset():
+            STATS.reset()
+            refresh()
+
+        def dump():
+            try:
+                path = STATS.dump_json(self.core.out_dir / 'sql_stats.json')
+                messagebox.showinfo("Info", f"Statistics written to {path}", parent=diagnostics_window)
+            except OSError as e:
+                messagebox.showerror("Error", str(e), parent=diagnostics_window)
+
+        btn_frame = tk.Frame(diagnostics_window)
+        btn_frame.grid(row=0, column=0, columnspan=2, sticky='w')
+        tk.Checkbutton(btn_frame, text="Record", variable=record_var, command=refresh,
+                       font=(self.font, self.text_size)).pack(side=tk.LEFT, padx=5)
+        for text, command in (("Refresh", refresh), ("Reset", reset), ("Dump JSON", dump)):
+            tk.Button(btn_frame, text=text, command=command, font=(self.font, self.text_size)).pack(side=tk.LEFT, padx=5)
+        info_label.grid(row=1, column=0, columnspan=2, sticky='ew', padx=5)
+        tree.grid(row=2, column=0, sticky='nsew')
+        scrollbar = ttk.Scrollbar(diagnostics_window, orient=tk.VERTICAL, command=tree.yview)
+        scrollbar.grid(row=2, column=1, sticky='ns')
+        tree.configure(yscrollcommand=scrollbar.set)
+        diagnostics_window.grid_columnconfigure(0, weight=1)
+        diagnostics_window.grid_rowconfigure(2, weight=1)
+        refresh()
 
     def on_closing(self):
-        self.conn.close()
+        self.writer.close()
+        if self.client is not None:
+            self.client.close()
+        self.core.close()
         self.root.destroy()
 
 if __name__ == '__main__':
@@ -0,0 +1,240 @@
+import argparse
+import os
+import sqlite3
+import stat
+from datetime import datetime
+from pathlib import Path
+
+import stamp_db
+from stamp_db import from_epoch_us, to_epoch_us
+from stamp_sql import execute, fetchall, fetchone
+from stamp_totals import localize
+
+# Every partition exposes these; epoch_us is what ranges are pruned and sorted on
+ARCHIVE_COLUMNS = 'id, timestamp, status, code, comment, epoch_us'
+# SQLite's default limit is 10 attached databases per connection
+MAX_ATTACHED = 10
+
+
+def year_range(year, time_zone):
+    # [from_us, to_us) of a local calendar year
+    return (to_epoch_us(localize(time_zone, datetime(year, 1, 1))),
+            to_epoch_us(localize(time_zone, datetime(year + 1, 1, 1))))
+
+
+def local_year(epoch_us, time_zone):
+    return from_epoch_us(epoch_us).astimezone(time_zone).year
+
+
+def archive_path(archive_dir, db_file, year):
+    return Path(archive_dir) / f"{Path(db_file).stem}_{year}.db"
+
+
+def archivable_years(conn, time_zone, before_year=None):
+    # Closed years with rows in the hot log. The year of the newest row always stays so new ids
+    # (max(id) + 1) keep counting up from the archived ones.
+    first, last = fetchone(conn, 'SELECT MIN(epoch_us), MAX(epoch_us) FROM log')
+    if first is None:
+        return []
+    limit = min(datetime.now().year, local_year(last, time_zone))
+    if before_year is not None:
+        limit = min(limit, before_year)
+    years = []
+    for year in range(local_year(first, time_zone), limit):
+        if fetchone(conn, 'SELECT 1 FROM log WHERE epoch_us >= ? AND epoch_us < ? LIMIT 1',
+                    year_range(year, time_zone)):
+            years.append(year)
+    return years
+
+
+def set_read_only(path, read_only=True):
+    mode = os.stat(path).st_mode
+    if read_only:
+        os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+    else:
+        os.chmod(path, mode | stat.S_IWUSR)
+
+
+def archive_year(db_file, archive_dir, year, time_zone):
+    # Moves one local year of log rows into its own database and records it in archives. Transactions
+    # spanning attached files are not atomic under WAL, so the rows are copied and committed first, then
+    # removed from log together with the bookkeeping. An interruption in between leaves copies that the
+    # next run overwrites; nothing reads them before the archives row exists. Returns (path, rows moved).
+    path = archive_path(archive_dir, db_file, year).resolve()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.exists():
+        # Rows stamped into a year after it was archived are appended
+        set_read_only(path, False)
+    from_us, to_us = year_range(year, time_zone)
+    conn = stamp_db.connect(db_file)
+    try:
+        execute(conn, 'ATTACH DATABASE ? AS archive', (str(path),))
+        execute(conn, '''CREATE TABLE IF NOT EXISTS archive.log (
+                            id INTEGER PRIMARY KEY,
+                            timestamp TEXT NOT NULL,
+                            status TEXT NOT NULL,
+                            code TEXT NOT NULL,
+                            comment TEXT,
+                            epoch_us INTEGER
+                        )''')
+        execute(conn, f'INSERT OR REPLACE INTO archive.log ({ARCHIVE_COLUMNS}) SELECT {ARCHIVE_COLUMNS} FROM main.log '
+                'WHERE epoch_us >= ? AND epoch_us < ? ORDER BY epoch_us', (from_us, to_us))
+        conn.commit()
+        # Only rows that made it into the archive go; anything stamped meanwhile waits for the next run
+        execute(conn, 'BEGIN IMMEDIATE')
+        moved = execute(conn, 'DELETE FROM main.log WHERE epoch_us >= ? AND epoch_us < ? '
+                        'AND id IN (SELECT id FROM archive.log)', (from_us, to_us)).rowcount
+        rows = fetchone(conn, 'SELECT COUNT(*) FROM archive.log')[0]
+        execute(conn, 'INSERT OR REPLACE INTO archives (year, path, from_us, to_us, rows, created) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (year, str(path), from_us, to_us, rows, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    # Indexed once the rows are in, then compacted and locked
+    archive = sqlite3.connect(path)
+    try:
+        execute(archive, 'CREATE INDEX IF NOT EXISTS idx_log_epoch ON log (epoch_us, status)')
+        execute(archive, 'CREATE INDEX IF NOT EXISTS idx_log_code_epoch ON log (code, epoch_us)')
+        archive.commit()
+        execute(archive, 'VACUUM')
+    finally:
+        archive.close()
+    set_read_only(path)
+    return path, moved
+
+
+def archive_closed_years(db_file, archive_dir, time_zone, before_year=None):
+    # Archives every closed year (only those before before_year if given), then compacts the hot
+    # database. Returns [(year, path, rows moved)].
+    conn = stamp_db.connect(db_file)
+    try:
+        stamp_db.migrate(conn)
+        years = archivable_years(conn, time_zone, before_year)
+    finally:
+        conn.close()
+    archived = [(year,) + archive_year(db_file, archive_dir, year, time_zone) for year in years]
+    if archived:
+        conn = stamp_db.connect(db_file)
+        try:
+            execute(conn, 'VACUUM')
+        finally:
+            conn.close()
+    return archived
+
+
+def list_archives(conn):
+    return fetchall(conn, 'SELECT year, path, rows, created FROM archives ORDER BY year')
+
+
+def overlapping(conn, from_us=None, to_us=None):
+    # [(alias, path)] of the archives with rows in [from_us, to_us]; all of them without a range
+    query, params = 'SELECT year, path FROM archives', ()
+    if from_us is not None:
+        query, params = query + ' WHERE to_us > ? AND from_us <= ?', (from_us, to_us)
+    return [(f"archive_{year}", path) for year, path in execute(conn, query + ' ORDER BY year', params)]
+
+
+def union_source(aliases):
+    # FROM clause over the hot log and the given attached archives. Range conditions on the union are
+    # pushed into every branch, so each archive is an index lookup on epoch_us.
+    if not aliases:
+        return 'log'
+    branches = [f"SELECT {ARCHIVE_COLUMNS} FROM main.log"]
+    branches += [f"SELECT {ARCHIVE_COLUMNS} FROM {alias}.log" for alias in aliases]
+    return '(' + ' UNION ALL '.join(branches) + ')'
+
+
+def attach_archives(conn, archives):
+    # Attaches (alias, path) archives read-only to a URI connection of its own (export and query threads)
+    # and adds a TEMP view all_log over the log and all of them for ad-hoc SQL
+    if len(archives) > MAX_ATTACHED:
+        raise ValueError(f"{len(archives)} archives are needed; at most {MAX_ATTACHED} can be read at once")
+    for alias, path in archives:
+        execute(conn, f'ATTACH DATABASE ? AS {alias}', (f"{Path(path).resolve().as_uri()}?mode=ro",))
+    execute(conn, f'CREATE TEMP VIEW IF NOT EXISTS all_log AS SELECT * FROM {union_source([a for a, _ in archives])}')
+
+
+class Archives:
+    # Routes reads on the app's connection over the log and the archives a range overlaps. Archives are
+    # attached on first use; the least recently used is detached to make room under the attach limit.
+    # Several Archives may share a connection: what is attached is read back from the connection.
+    def __init__(self, conn):
+        self.conn = conn
+        self.attached = []
+
+    def source(self, from_us=None, to_us=None):
+        archives = overlapping(self.conn, from_us, to_us)
+        if len(archives) > MAX_ATTACHED:
+            raise ValueError(f"{len(archives)} archives are needed; at most {MAX_ATTACHED} can be read at once")
+        if archives:
+            names = [row[1] for row in fetchall(self.conn, 'PRAGMA database_list') if row[1].startswith('archive_')]
+            self.attached = [alias for alias in self.attached if alias in names] + \
+                            [alias for alias in names if alias not in self.attached]
+        for alias, path in archives:
+            if alias in self.attached:
+                self.attached.remove(alias)
+            else:
+                while len(self.attached) >= MAX_ATTACHED:
+                    execute(self.conn, f'DETACH DATABASE {self.attached.pop(0)}')
+                execute(self.conn, f'ATTACH DATABASE ? AS {alias}', (path,))
+            self.attached.append(alias)
+        return union_source([alias for alias, _ in archives])
+
+    def partitions(self, window=None):
+        # (from_us, to_us, source) pieces covering the log and every archive, for rebuilding daily_totals or
+        # reading everything without attaching all archives at once. Pieces are day-aligned when window(epoch_us)
+        # gives the day around an epoch, otherwise they start where the archives do. Each source reaches into
+        # the next piece so sessions still open at its end are closed. A generator: every piece is attached
+        # when reached, possibly detaching earlier ones.
+        years = fetchall(self.conn, 'SELECT from_us, to_us FROM archives ORDER BY from_us')
+        first, last = fetchone(self.conn, 'SELECT MIN(epoch_us), MAX(epoch_us) FROM log')
+        starts = [from_us for from_us, _ in years] + ([] if first is None else [first])
+        if not starts:
+            return
+        end = max(([last] if last is not None else []) + [to_us - 1 for _, to_us in years])
+        starts = sorted({window(epoch_us).start_us if window else epoch_us for epoch_us in starts})
+        stops = [start - 1 for start in starts[1:]] + [end]
+        for i, (start, stop) in enumerate(zip(starts, stops)):
+            yield start, stop, self.source(start, stops[min(i + 1, len(stops) - 1)])
+
+
+def main(argv=None):
+    from pytz import timezone
+
+    from stamp_core import script_config
+
+    parser = argparse.ArgumentParser(description="Move closed years of stamps into read-only archive databases")
+    parser.add_argument('--config', help="defaults.yaml to use")
+    parser.add_argument('--db', help="database (default: db_path in the config)")
+    parser.add_argument('--archive-dir', help="where archives go (default: archive_dir in the config)")
+    parser.add_argument('--before', type=int, metavar='YEAR', help="only archive years before this one")
+    parser.add_argument('--time-zone', default=str(datetime.now().astimezone().tzinfo))
+    parser.add_argument('--list', action='store_true', help="list the archives and exit")
+    args = parser.parse_args(argv)
+
+    defaults, base_dir, db_file = script_config(args.config)
+    db_file = args.db or db_file
+    archive_dir = args.archive_dir or base_dir / defaults.get('archive_dir', defaults.get('backup_dir', 'out/backups/'))
+    if not args.list:
+        for year, path, moved in archive_closed_years(db_file, archive_dir, timezone(args.time_zone), args.before):
+            print(f"{year}: {moved} rows moved to {path}")
+    conn = stamp_db.connect(db_file)
+    try:
+        stamp_db.migrate(conn)
+        archives = list_archives(conn)
+    finally:
+        conn.close()
+    for year, path, rows, created in archives:
+        print(f"{year}  {rows:>9} rows  {path}  (archived {created})")
+    if not archives:
+        print("No archives")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
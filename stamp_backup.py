@@ -0,0 +1,295 @@
+import argparse
+import gzip
+import hashlib
+import shutil
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import stamp_db
+from stamp_db import LOG_COLUMNS
+
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_KEEP = 10
+HASH_BATCH_SIZE = 5000
+SUFFIXES = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def resolve_compression(compression):
+    compression = str(compression or 'none').lower()
+    if compression not in SUFFIXES:
+        raise ValueError(f"Unknown backup compression: {compression}")
+    if compression == 'zstd' and zstandard is None:
+        print('zstandard is not installed, falling back to gzip backups')
+        return 'gzip'
+    return compression
+
+
+def compression_of(path):
+    for compression, suffix in SUFFIXES.items():
+        if suffix and str(path).endswith(suffix):
+            return compression
+    return 'none'
+
+
+def open_compressed(path, mode, compression):
+    if compression == 'gzip':
+        return gzip.open(path, mode)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is required to read {path}")
+        return zstandard.open(path, mode)
+    return open(path, mode)
+
+
+def content_hash(conn):
+    # Hash of the log rows and of the archives they were moved to, so bookkeeping tables (e.g. backup_log)
+    # do not defeat dedup. An archive file only changes together with its row in archives; without
+    # archives the hash is that of the log alone, as recorded by earlier versions.
+    digest = hashlib.sha256()
+    queries = [f'SELECT {LOG_COLUMNS} FROM log ORDER BY id']
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archives'").fetchone():
+        queries.append('SELECT year, rows, created FROM archives ORDER BY year')
+    for query in queries:
+        cursor = conn.execute(query)
+        while True:
+            rows = cursor.fetchmany(HASH_BATCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                digest.update(repr(row).encode())
+    return digest.hexdigest()
+
+
+def snapshot(db_file, dst_path, pages=BACKUP_PAGES_PER_STEP):
+    # Online copy through the SQLite backup API: consistent even while other connections write
+    src = stamp_db.connect(db_file)
+    dst = sqlite3.connect(dst_path)
+    try:
+        src.backup(dst, pages=pages, sleep=0)
+        # The copy carries the WAL flag; a backup file stands alone
+        dst.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        dst.close()
+        src.close()
+
+
+def run_backup(db_file, backup_dir, compression='none', keep=BACKUP_KEEP, pages=BACKUP_PAGES_PER_STEP):
+    db_file, backup_dir = Path(db_file), Path(backup_dir)
+    backup_dir.mkdir(parents=True, exist_ok=True)
+    compression = resolve_compression(compression)
+    current_time = datetime.now()
+    partial_path = None
+
+    conn = stamp_db.connect(db_file)
+    try:
+        last = conn.execute('SELECT backup_path, content_hash, log_changes FROM backup_log '
+                            'ORDER BY time DESC LIMIT 1').fetchone()
+        changes = stamp_db.log_changes(conn)
+        if last and last[2] is not None and last[2] == changes and Path(last[0]).is_file():
+            # No row of log has changed since the last backup, so it is neither copied nor hashed
+            backup_path, digest = Path(last[0]), last[1]
+            print(f"Database unchanged since backup: {backup_path}")
+        else:
+            # A file of its own, as the startup backup and a command line one may run at once
+            with tempfile.NamedTemporaryFile(dir=backup_dir, prefix=f".{db_file.name}.", suffix='.partial',
+                                             delete=False) as file:
+                partial_path = Path(file.name)
+            snapshot(db_file, partial_path, pages)
+            snap = sqlite3.connect(partial_path)
+            try:
+                digest = content_hash(snap)
+                changes = stamp_db.log_changes(snap)
+            finally:
+                snap.close()
+
+            if last and last[1] == digest and Path(last[0]).is_file():
+                # Changed and changed back: log the check against the existing file
+                backup_path = Path(last[0])
+                print(f"Database unchanged since backup: {backup_path}")
+            else:
+                backup_path = backup_dir / f"{current_time.strftime('%Y-%m-%d')}_{digest[:8]}_{db_file.name}{SUFFIXES[compression]}"
+                if compression == 'none':
+                    partial_path.replace(backup_path)
+                else:
+                    with open(partial_path, 'rb') as fin, open_compressed(backup_path, 'wb', compression) as fout:
+                        shutil.copyfileobj(fin, fout, 1 << 20)
+                print(f"Database backed up to: {backup_path}")
+
+        conn.execute('INSERT OR REPLACE INTO backup_log (time, backup_path, content_hash, compression, log_changes) '
+                     'VALUES (?, ?, ?, ?, ?)', (current_time.strftime('%Y-%m-%d %H:%M:%S'), str(backup_path), digest,
+                                                compression_of(backup_path), changes))
+        conn.commit()
+        apply_retention(conn, keep)
+    finally:
+        conn.close()
+        if partial_path is not None:
+            partial_path.unlink(missing_ok=True)
+    return backup_path
+
+
+def apply_retention(conn, keep):
+    # Keep the newest `keep` backup files (keep <= 0 keeps everything); their log rows go with them
+    if keep <= 0:
+        return
+    paths = [row[0] for row in conn.execute(
+        'SELECT backup_path FROM backup_log GROUP BY backup_path ORDER BY MAX(time) DESC')]
+    for path in paths[keep:]:
+        Path(path).unlink(missing_ok=True)
+        conn.execute('DELETE FROM backup_log WHERE backup_path = ?', (path,))
+    conn.commit()
+
+
+def _unpack(backup_path, dst_path):
+    with open_compressed(backup_path, 'rb', compression_of(backup_path)) as fin, open(dst_path, 'wb') as fout:
+        shutil.copyfileobj(fin, fout, 1 << 20)
+
+
+def verify_backup(backup_path, expected_hash=None):
+    # Returns (ok, message); checks SQLite integrity and, if known, the recorded content hash
+    backup_path = Path(backup_path)
+    if not backup_path.is_file():
+        return False, f"Backup not found: {backup_path}"
+    unpacked = backup_path.with_name(f".{backup_path.name}.verify")
+    try:
+        _unpack(backup_path, unpacked)
+        conn = sqlite3.connect(unpacked)
+        try:
+            integrity = conn.execute('PRAGMA integrity_check').fetchone()[0]
+            if integrity != 'ok':
+                return False, f"Integrity check failed: {integrity}"
+            digest = content_hash(conn)
+        finally:
+            conn.close()
+    except (OSError, sqlite3.DatabaseError, EOFError) as e:
+        return False, f"Could not read backup: {e}"
+    finally:
+        unpacked.unlink(missing_ok=True)
+    if expected_hash and digest != expected_hash:
+        return False, "Content hash does not match backup_log"
+    return True, f"Backup OK: {backup_path}"
+
+
+def recorded_hash(conn, backup_path):
+    row = conn.execute('SELECT content_hash FROM backup_log WHERE backup_path = ? ORDER BY time DESC LIMIT 1',
+                       (str(backup_path),)).fetchone()
+    return row[0] if row else None
+
+
+def restore_backup(db_file, backup_path, backup_dir, compression='none'):
+    # Verifies the backup, snapshots the current database, then copies the backup over it in place
+    conn = stamp_db.connect(db_file)
+    try:
+        ok, message = verify_backup(backup_path, recorded_hash(conn, backup_path))
+        if not ok:
+            raise RuntimeError(message)
+    finally:
+        conn.close()
+
+    run_backup(db_file, backup_dir, compression, keep=0)
+
+    backup_path = Path(backup_path)
+    unpacked = backup_path.with_name(f".{backup_path.name}.restore")
+    conn = stamp_db.connect(db_file)
+    try:
+        backup_rows = conn.execute('SELECT time, backup_path, content_hash, compression, log_changes '
+                                   'FROM backup_log').fetchall()
+        _unpack(backup_path, unpacked)
+        src = sqlite3.connect(unpacked)
+        try:
+            src.backup(conn)
+        finally:
+            src.close()
+        # The restored file may predate the current schema and carries an older backup_log
+        stamp_db.migrate(conn)
+        conn.executemany('INSERT OR REPLACE INTO backup_log (time, backup_path, content_hash, compression, log_changes) '
+                         'VALUES (?, ?, ?, ?, ?)', backup_rows)
+        # The restored count may come round to one recorded for other content; move it past all of them
+        conn.execute("UPDATE meta SET value = MAX(CAST(value AS INTEGER), "
+                     "COALESCE((SELECT MAX(log_changes) FROM backup_log), 0)) + 1 WHERE key = 'log_changes'")
+        conn.commit()
+    finally:
+        conn.close()
+        unpacked.unlink(missing_ok=True)
+    print(f"Database restored from: {backup_path}")
+
+
+class BackupJob(threading.Thread):
+    def __init__(self, db_file, backup_dir, compression='none', keep=BACKUP_KEEP, pages=BACKUP_PAGES_PER_STEP):
+        super().__init__(daemon=True)
+        self.db_file = db_file
+        self.backup_dir = backup_dir
+        self.compression = compression
+        self.keep = keep
+        self.pages = pages
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = run_backup(self.db_file, self.backup_dir, self.compression, self.keep, self.pages)
+        except Exception as e:
+            self.error = e
+            print(f"Backup failed: {e}")
+
+
+def main(argv=None):
+    from stamp_core import script_config
+
+    parser = argparse.ArgumentParser(description="Back up, verify and restore the stamp database")
+    parser.add_argument('--config', help="defaults.yaml to use")
+    parser.add_argument('--db', help="database (default: db_path in the config)")
+    parser.add_argument('--backup-dir', help="default: backup_dir in the config")
+    parser.add_argument('--compression', help="none, gzip or zstd (default: backup_compression in the config)")
+    parser.add_argument('--keep', type=int, help="backups to keep (default: backup_keep in the config)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('backup', help="take a backup now")
+    subparsers.add_parser('list', help="list recorded backups")
+    verify_parser = subparsers.add_parser('verify', help="check a backup (default: latest)")
+    verify_parser.add_argument('path', nargs='?')
+    restore_parser = subparsers.add_parser('restore', help="restore a backup (default: latest)")
+    restore_parser.add_argument('path', nargs='?')
+    args = parser.parse_args(argv)
+
+    defaults, base_dir, db_file = script_config(args.config)
+    db_file = args.db or db_file
+    backup_dir = args.backup_dir or base_dir / defaults.get('backup_dir', 'out/backups/')
+    compression = args.compression or defaults.get('backup_compression', 'none')
+    keep = args.keep if args.keep is not None else int(defaults.get('backup_keep', BACKUP_KEEP))
+
+    conn = stamp_db.connect(db_file)
+    try:
+        stamp_db.migrate(conn)
+        rows = conn.execute('SELECT time, backup_path, content_hash FROM backup_log ORDER BY time DESC').fetchall()
+    finally:
+        conn.close()
+
+    if args.command == 'backup':
+        run_backup(db_file, backup_dir, compression, keep)
+        return 0
+    if args.command == 'list':
+        for time, path, digest in rows:
+            print(f"{time}  {(digest or '')[:8]:8}  {path}")
+        return 0
+
+    path = args.path or (rows[0][1] if rows else None)
+    if path is None:
+        print("No backups recorded")
+        return 1
+    if args.command == 'verify':
+        ok, message = verify_backup(path, next((r[2] for r in rows if r[1] == str(path)), None))
+        print(message)
+        return 0 if ok else 1
+    restore_backup(db_file, path, backup_dir, compression)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
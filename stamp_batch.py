@@ -0,0 +1,173 @@
+from datetime import datetime, timedelta
+
+from stamp_db import from_epoch_us
+from stamp_sql import execute, fetchall, fetchone
+
+JOURNAL_COLUMNS = 'id, timestamp, status, code, comment, epoch_us'
+AFTER_COLUMNS = 'after_timestamp, after_status, after_code, after_comment, after_epoch_us'
+# Batches kept in the journal; older ones can no longer be undone
+EDIT_JOURNAL_KEEP = 20
+OPERATIONS = ('shift', 'recode', 'comment', 'replace', 'delete')
+
+
+def iso_utc(epoch_us):
+    # The text insert_write stores for a UTC datetime, as an SQL function for set-based shifts
+    return None if epoch_us is None else from_epoch_us(epoch_us).isoformat()
+
+
+def selection(from_us, to_us, code=None, status=None, match=None):
+    # WHERE clause and params over log: a time range, optionally narrowed to a code, a status or comment text
+    where, params = ['epoch_us BETWEEN ? AND ?'], [from_us, to_us]
+    if code:
+        where.append('code = ?')
+        params.append(code)
+    if status:
+        where.append('status = ?')
+        params.append(status)
+    if match:
+        where.append('comment LIKE ?')
+        params.append(f"%{match}%")
+    return ' AND '.join(where), tuple(params)
+
+
+def preview(conn, where, params):
+    # (rows, first epoch, last epoch) a batch over the selection would touch
+    return fetchone(conn, f'SELECT COUNT(*), MIN(epoch_us), MAX(epoch_us) FROM log WHERE {where}', params)
+
+
+def assignment(operation, value):
+    # SET clause and params of an update; the right-hand sides see the row as it was
+    if operation == 'shift':
+        offset = value // timedelta(microseconds=1)
+        return 'epoch_us = epoch_us + ?, timestamp = iso_utc(epoch_us + ?)', (offset, offset)
+    if operation == 'recode':
+        if not value:
+            raise ValueError("A new code is needed")
+        return 'code = ?', (value,)
+    if operation == 'comment':
+        return 'comment = ?', (value,)
+    if operation == 'replace':
+        old, new = value
+        if not old:
+            raise ValueError("Nothing to replace")
+        return 'comment = replace(comment, ?, ?)', (old, new)
+    raise ValueError(f"Unknown batch operation: {operation}")
+
+
+def describe(operation, value):
+    if operation == 'shift':
+        return f"shift by {value.total_seconds() / 3600:+g} h"
+    if operation == 'replace':
+        return f"replace {value[0]!r} with {value[1]!r} in comments"
+    if operation == 'delete':
+        return 'delete'
+    return f"{operation} to {value!r}"
+
+
+def refresh_totals(conn, daily_totals, spans):
+    # Recomputes the days of every (first, last) epoch span plus the day of the event before each
+    if daily_totals is None:
+        return
+    for first_us, last_us in spans:
+        if first_us is None:
+            continue
+        daily_totals.refresh(conn, daily_totals.neighbours(conn, first_us))
+        daily_totals.recompute(conn, first_us, last_us)
+
+
+def batch_write(where, params, operation, value=None, description=None, daily_totals=None):
+    # A write (see StampCore) changing every row of the selection with one statement. The rows are first
+    # copied into edit_journal under a new batch, so undo_write can put them back. Returns (batch id, rows),
+    # (None, 0) when nothing matches.
+    if operation not in OPERATIONS:
+        raise ValueError(f"Unknown batch operation: {operation}")
+    set_clause, set_params = assignment(operation, value) if operation != 'delete' else (None, ())
+    description = description or describe(operation, value)
+
+    def write(conn):
+        conn.create_function('iso_utc', 1, iso_utc, deterministic=True)
+        rows, first_us, last_us = preview(conn, where, params)
+        if not rows:
+            return None, 0
+        batch_id = execute(conn, 'INSERT INTO edit_batches (created, operation, description, rows) VALUES (?, ?, ?, ?)',
+                           (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), operation, description, rows)).lastrowid
+        execute(conn, f'INSERT INTO edit_journal (batch_id, {JOURNAL_COLUMNS}) '
+                f'SELECT ?, {JOURNAL_COLUMNS} FROM log WHERE {where}', (batch_id,) + params)
+        in_batch = 'id IN (SELECT id FROM edit_journal WHERE batch_id = ?)'
+        spans = [(first_us, last_us)]
+        if operation == 'delete':
+            execute(conn, f'DELETE FROM log WHERE {in_batch}', (batch_id,))
+        else:
+            execute(conn, f'UPDATE log SET {set_clause} WHERE {in_batch}', set_params + (batch_id,))
+            execute(conn, f'UPDATE edit_journal SET ({AFTER_COLUMNS}) = (log.timestamp, log.status, log.code, '
+                    'log.comment, log.epoch_us) FROM log WHERE edit_journal.batch_id = ? AND log.id = edit_journal.id',
+                    (batch_id,))
+            if operation == 'shift':
+                spans.append(fetchone(conn, f'SELECT MIN(epoch_us), MAX(epoch_us) FROM log WHERE {in_batch}',
+                                      (batch_id,)))
+        refresh_totals(conn, daily_totals, spans)
+        prune(conn)
+        return batch_id, rows
+    return write
+
+
+def undo_write(daily_totals=None):
+    # A write restoring the rows of the latest batch not undone yet. Deleted rows come back under their
+    # old ids unless a new stamp has taken one. Rows are skipped when undoing them would lose a later
+    # change: a deleted row whose id holds the same stamp again, and an updated row edited or deleted
+    # since. Returns (batch id, description, skipped rows as journalled), or None when there is nothing
+    # to undo.
+    def write(conn):
+        batch = fetchone(conn, 'SELECT id, operation, description FROM edit_batches WHERE undone = 0 '
+                         'ORDER BY id DESC LIMIT 1')
+        if batch is None:
+            return None
+        batch_id, operation, description = batch
+        spans = [fetchone(conn, 'SELECT MIN(epoch_us), MAX(epoch_us) FROM edit_journal WHERE batch_id = ?',
+                          (batch_id,))]
+        if operation == 'delete':
+            skipped = fetchall(conn, 'SELECT j.id, j.timestamp, j.status, j.code, j.comment FROM edit_journal AS j '
+                               'JOIN log ON log.id = j.id WHERE j.batch_id = ? '
+                               'AND (log.epoch_us, log.status, log.code) IS (j.epoch_us, j.status, j.code) '
+                               'ORDER BY j.epoch_us, j.id', (batch_id,))
+            execute(conn, f'INSERT INTO log ({JOURNAL_COLUMNS}) SELECT {JOURNAL_COLUMNS} FROM edit_journal '
+                    'WHERE batch_id = ? AND id NOT IN (SELECT id FROM log)', (batch_id,))
+            execute(conn, 'INSERT INTO log (timestamp, status, code, comment, epoch_us) '
+                    'SELECT timestamp, status, code, comment, epoch_us FROM edit_journal AS j '
+                    'WHERE batch_id = ? AND EXISTS (SELECT 1 FROM log WHERE log.id = j.id '
+                    'AND (log.epoch_us, log.status, log.code) IS NOT (j.epoch_us, j.status, j.code))', (batch_id,))
+        else:
+            # Journals from before the after_ columns have no post-image and are undone as before
+            unchanged = ('(j.after_timestamp IS NULL OR (log.timestamp, log.status, log.code, log.comment, log.epoch_us) '
+                         f'IS ({AFTER_COLUMNS}))')
+            skipped = fetchall(conn, 'SELECT j.id, j.timestamp, j.status, j.code, j.comment FROM edit_journal AS j '
+                               f'LEFT JOIN log ON log.id = j.id WHERE j.batch_id = ? AND (log.id IS NULL OR NOT {unchanged}) '
+                               'ORDER BY j.epoch_us, j.id', (batch_id,))
+            spans.append(fetchone(conn, 'SELECT MIN(epoch_us), MAX(epoch_us) FROM log '
+                                  'WHERE id IN (SELECT id FROM edit_journal WHERE batch_id = ?)', (batch_id,)))
+            execute(conn, 'UPDATE log SET timestamp = j.timestamp, status = j.status, code = j.code, '
+                    'comment = j.comment, epoch_us = j.epoch_us '
+                    f'FROM edit_journal AS j WHERE j.batch_id = ? AND log.id = j.id AND {unchanged}', (batch_id,))
+        refresh_totals(conn, daily_totals, spans)
+        execute(conn, 'UPDATE edit_batches SET undone = 1 WHERE id = ?', (batch_id,))
+        execute(conn, 'DELETE FROM edit_journal WHERE batch_id = ?', (batch_id,))
+        return batch_id, description, skipped
+    return write
+
+
+def skipped_lines(skipped):
+    # What undo left alone, for the CLI and the app to show
+    if not skipped:
+        return []
+    return ([f"{len(skipped)} stamps were changed or stamped again after the batch and were left as they are:"] +
+            [f"  {entry_id}  {timestamp}  {status}  {code}  {comment or ''}"
+             for entry_id, timestamp, status, code, comment in skipped])
+
+
+def prune(conn, keep=EDIT_JOURNAL_KEEP):
+    execute(conn, 'DELETE FROM edit_batches WHERE id NOT IN (SELECT id FROM edit_batches ORDER BY id DESC LIMIT ?)', (keep,))
+    execute(conn, 'DELETE FROM edit_journal WHERE batch_id NOT IN (SELECT id FROM edit_batches)')
+
+
+def list_batches(conn):
+    return fetchall(conn, 'SELECT id, created, description, rows, undone FROM edit_batches ORDER BY id DESC')
@@ -0,0 +1,277 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import stamp_db
+from stamp_core import StampCore
+from stamp_import import to_iso_utc
+
+BENCH_DIR = 'out/bench'
+BENCH_ROWS = [10_000, 100_000, 1_000_000]
+BENCH_REPEAT = 5
+BENCH_TIME_ZONE = 'Europe/Oslo'
+# A median this much slower than the baseline is a regression, unless it is below the noise floor
+REGRESSION_TOLERANCE = 0.25
+NOISE_FLOOR_S = 0.002
+# Realistic days have three sessions; very large databases pack more into each day to stay within this span
+MAX_YEARS = 40
+INSERT_BATCH_SIZE = 100_000
+CODES = ['work', 'work', 'work', 'meeting', 'admin', 'conference', 'travel', 'other']
+COMMENTS = ['', '', '', 'standup', 'review', 'on site', 'support']
+US_PER_MINUTE = 60_000_000
+
+
+def local_to_epoch_us(local, time_zone):
+    # Nonexistent local times shift forward and ambiguous ones resolve to standard time, as in stamp_import
+    index = pd.DatetimeIndex(local).tz_localize(time_zone, ambiguous=np.zeros(len(local), bool),
+                                                nonexistent='shift_forward')
+    return index.tz_convert(None).to_numpy().astype('datetime64[us]').astype(np.int64)
+
+
+def transition_days(first, last, time_zone):
+    # Local days between first and last on which the UTC offset changes
+    days = np.arange(first, last + np.timedelta64(2, 'D'))
+    midnights = pd.DatetimeIndex(days).tz_localize(time_zone, nonexistent='shift_forward', ambiguous=True)
+    offsets = np.array([t.utcoffset().total_seconds() for t in midnights])
+    return days[:-1][offsets[1:] != offsets[:-1]]
+
+
+def generate_events(rows, time_zone=BENCH_TIME_ZONE, seed=0, end=None):
+    # Workdays ending yesterday, each split into sessions with a half hour lunch break after the first,
+    # plus a night session starting at 02:30 (nonexistent or ambiguous) on every DST change.
+    # Returns the newest `rows` events sorted by time.
+    rng = np.random.default_rng(seed)
+    sessions = max(3, -(-rows // (2 * 261 * MAX_YEARS)))
+    end = end or date.today() - timedelta(days=1)
+    days = pd.bdate_range(end=end, periods=-(-rows // (2 * sessions)) + 1).to_numpy().astype('datetime64[D]')
+
+    day_us = days.astype('datetime64[us]').astype(np.int64)
+    start = day_us + (8 * 60 + rng.integers(-30, 30, len(days))) * US_PER_MINUTE
+    stop = day_us + (16 * 60 + rng.integers(-30, 60, len(days))) * US_PER_MINUTE
+    bounds = start[:, None] + (stop - start)[:, None] * np.linspace(0, 1, sessions + 1)[None, :]
+    gaps = rng.integers(1, 5, (len(days), sessions)) * US_PER_MINUTE
+    gaps[:, 1] = 30 * US_PER_MINUTE
+    ins = (bounds[:, :-1] + gaps).astype(np.int64).ravel()
+    outs = bounds[:, 1:].astype(np.int64).ravel()
+
+    day_sessions = len(ins)
+    night = transition_days(days[0], days[-1], time_zone).astype('datetime64[us]').astype(np.int64)
+    ins = np.concatenate([ins, night + 150 * US_PER_MINUTE])
+    outs = np.concatenate([outs, night + 240 * US_PER_MINUTE])
+    codes = np.array(CODES, dtype=object)[rng.integers(0, len(CODES), len(ins))]
+    codes[day_sessions:] = 'travel'
+
+    local = np.concatenate([ins, outs]).astype('datetime64[us]')
+    epoch_us = local_to_epoch_us(local, time_zone)
+    status = np.repeat(np.array(['in', 'out'], dtype=object), len(ins))
+    order = np.argsort(epoch_us, kind='stable')[-rows:]
+    comments = np.array(COMMENTS, dtype=object)[rng.integers(0, len(COMMENTS), len(order))]
+    return epoch_us[order], status[order], np.concatenate([codes, codes])[order], comments
+
+
+def generate(db_file, rows, time_zone=BENCH_TIME_ZONE, seed=0):
+    epoch_us, status, codes, comments = generate_events(rows, time_zone, seed)
+    timestamps = to_iso_utc(epoch_us)
+    conn = stamp_db.connect(db_file)
+    try:
+        stamp_db.migrate(conn)
+        index_sql = stamp_db.drop_indexes(conn, 'log')
+        for i in range(0, rows, INSERT_BATCH_SIZE):
+            batch = slice(i, i + INSERT_BATCH_SIZE)
+            conn.executemany('INSERT INTO log (timestamp, status, code, comment, epoch_us) VALUES (?, ?, ?, ?, ?)',
+                             zip(timestamps[batch].tolist(), status[batch].tolist(), codes[batch].tolist(),
+                                 comments[batch].tolist(), epoch_us[batch].tolist()))
+        stamp_db.create_indexes(conn, index_sql)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def prepare(bench_dir, rows, time_zone=BENCH_TIME_ZONE, seed=0):
+    # One database and config per size, reused across runs; daily_totals is built by the first StampCore
+    run_dir = bench_dir / f"{rows}_{seed}"
+    config_path = run_dir / 'defaults.yaml'
+    if config_path.is_file():
+        return config_path
+    run_dir.mkdir(parents=True, exist_ok=True)
+    db_file = run_dir / 'time_log.db'
+    db_file.unlink(missing_ok=True)
+    started = time.perf_counter()
+    config_path.write_text("db_path: time_log.db\nbackup_dir: backups/\n")
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate(db_file, rows, time_zone, seed)
+            StampCore(config_path).close()
+    except BaseException:
+        # The config marks a finished database
+        config_path.unlink()
+        raise
+    print(f"generated {rows} rows in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    return config_path
+
+
+def browse(conn, source, conditions, params, sort_key):
+    # What ResultGrid.refresh does: the total, then the first page
+    from stamp_grid import FETCH_SIZE, VISIBLE_ROWS, count_sql, page_sql
+
+    total = conn.execute(count_sql(source, conditions), params).fetchone()[0]
+    conn.execute(page_sql(source, conditions, sort_key, 'ASC'), params + (VISIBLE_ROWS + FETCH_SIZE, 0)).fetchall()
+    return total
+
+
+def benchmarks(core, config_path, scratch):
+    # name -> zero-argument callable; each runs against the database behind core
+    to_date = datetime.now()
+    month = ((to_date - timedelta(days=30)).strftime('%Y-%m-%d %H:%M'), to_date.strftime('%Y-%m-%d %H:%M'))
+    year = ((to_date - timedelta(days=365)).strftime('%Y-%m-%d %H:%M'), to_date.strftime('%Y-%m-%d %H:%M'))
+
+    def status():
+        core.cache.invalidate()
+        core.last_entry()
+
+    def browse_date():
+        browse(core.conn, 'log', 'WHERE epoch_us BETWEEN ? AND ?', core.epoch_range(*month), 'epoch_us')
+
+    def browse_sql():
+        # What QueryGrid runs for the Filter by SQL box
+        from stamp_query import QueryJob
+
+        job = QueryJob(core.DB_FILE, "SELECT * FROM log WHERE code = 'meeting'",
+                       time_limit=core.sql_time_limit, row_cap=core.sql_row_cap)
+        job.start()
+        job.join()
+        job.drain()
+
+    def search():
+        for text in ('review', 'on site', 'nothing like this'):
+            core.conn.execute(*core.search_query(text)).fetchall()
+
+    def modify_walk():
+        window = core.entry_window()
+        entry_id = core.latest_id()
+        for _ in range(1000):
+            entry_id = window.adjacent_id(entry_id, -1) or entry_id
+            window.get(entry_id)
+
+    def dump_csv():
+        from stamp_export import export_csv
+
+        query, params, archives = core.export_query(*year)
+        export_csv(core.DB_FILE, scratch / 'dump.csv', query, params, core.time_zone, archives=archives)
+
+    def report():
+        core.report(*year, period='week')
+
+    def backup():
+        from stamp_backup import run_backup
+
+        core.backup_due()
+        backup_dir = scratch / 'backups'
+        shutil.rmtree(backup_dir, ignore_errors=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_backup(core.DB_FILE, backup_dir, core.backup_compression, core.backup_keep)
+
+    def cold_start():
+        subprocess.run([sys.executable, str(Path(__file__).with_name('stamp_cli.py')), '--config', str(config_path),
+                        'status'], check=True, stdout=subprocess.DEVNULL)
+
+    return {'status': status, 'browse_date': browse_date, 'browse_sql': browse_sql, 'search': search, 'modify_walk': modify_walk,
+            'dump_csv': dump_csv, 'report': report, 'backup': backup, 'cold_start': cold_start}
+
+
+def measure(function, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return {'median_s': statistics.median(times), 'min_s': min(times), 'runs': repeat}
+
+
+def run(bench_dir, sizes, repeat=BENCH_REPEAT, only=None, time_zone=BENCH_TIME_ZONE, seed=0):
+    results = {}
+    for rows in sizes:
+        config_path = prepare(bench_dir, rows, time_zone, seed)
+        core = StampCore(config_path)
+        try:
+            with tempfile.TemporaryDirectory() as scratch:
+                for name, function in benchmarks(core, config_path, Path(scratch)).items():
+                    if only and name not in only:
+                        continue
+                    results.setdefault(str(rows), {})[name] = measure(function, repeat)
+                    print(f"{rows:>10} {name:<12} {results[str(rows)][name]['median_s'] * 1000:10.2f} ms", file=sys.stderr)
+        finally:
+            core.close()
+    return {
+        'meta': {'time': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+                 'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(), 'repeat': repeat, 'seed': seed},
+        'results': results,
+    }
+
+
+def compare(report, baseline, tolerance=REGRESSION_TOLERANCE):
+    # (rows, name, baseline median, current median) for every benchmark slower than the baseline allows
+    regressions = []
+    for rows, timings in report['results'].items():
+        for name, timing in timings.items():
+            previous = baseline.get('results', {}).get(rows, {}).get(name)
+            if previous is None:
+                continue
+            before, after = previous['median_s'], timing['median_s']
+            if after > before * (1 + tolerance) and after - before > NOISE_FLOOR_S:
+                regressions.append((rows, name, before, after))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the hot paths on generated databases")
+    parser.add_argument('--rows', type=int, nargs='+', default=BENCH_ROWS, help="database sizes to run")
+    parser.add_argument('--dir', default=BENCH_DIR, help="where generated databases and results are kept")
+    parser.add_argument('--repeat', type=int, default=BENCH_REPEAT)
+    parser.add_argument('--only', nargs='+', help="benchmark names to run")
+    parser.add_argument('--time-zone', default=BENCH_TIME_ZONE, help="zone the generated stamps are local to")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="results JSON (default: <dir>/results.json)")
+    parser.add_argument('--baseline', help="baseline JSON to compare against (default: <dir>/baseline.json)")
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the baseline")
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    bench_dir = Path(args.dir)
+    report = run(bench_dir, args.rows, args.repeat, args.only, args.time_zone, args.seed)
+    output = Path(args.output) if args.output else bench_dir / 'results.json'
+    output.write_text(json.dumps(report, indent=2))
+    print(f"results written to {output}")
+
+    baseline_path = Path(args.baseline) if args.baseline else bench_dir / 'baseline.json'
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(report, indent=2))
+        print(f"baseline saved to {baseline_path}")
+        return 0
+    if not baseline_path.is_file():
+        print(f"no baseline at {baseline_path}; run with --save-baseline to create one")
+        return 0
+    regressions = compare(report, json.loads(baseline_path.read_text()), args.tolerance)
+    for rows, name, before, after in regressions:
+        print(f"REGRESSION {name} @ {rows} rows: {before * 1000:.2f} ms -> {after * 1000:.2f} ms ({after / before:.2f}x)")
+    if not regressions:
+        print(f"no regressions against {baseline_path}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,49 @@
+from collections import OrderedDict
+
+from stamp_sql import fetchall, normalize_query
+
+QUERY_CACHE_SIZE = 256
+
+
+class QueryCache:
+    # LRU cache of read results on one connection. Every entry belongs to a data version: a local counter
+    # bumped by invalidate() after writes on this connection, paired with PRAGMA data_version, which moves
+    # whenever another connection (the DatabaseWriter thread, another process) commits.
+    def __init__(self, conn, max_entries=QUERY_CACHE_SIZE):
+        self.conn = conn
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.counter = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        self.counter += 1
+
+    def data_version(self):
+        return self.counter, self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def fetchall(self, query, params=()):
+        version = self.data_version()
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+        key = (normalize_query(query), tuple(params))
+        rows = self.entries.get(key)
+        if rows is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return list(rows)
+
+        self.misses += 1
+        rows = fetchall(self.conn, query, params)
+        self.entries[key] = rows
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return list(rows)
+
+    def fetchone(self, query, params=()):
+        rows = self.fetchall(query, params)
+        return rows[0] if rows else None
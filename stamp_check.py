@@ -0,0 +1,173 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+from stamp_batch import batch_write
+from stamp_db import from_epoch_us, to_epoch_us
+from stamp_sql import execute, fetchone
+
+CHECK_BATCH_SIZE = 5000
+MAX_SESSION_HOURS = 24
+STATUSES = ('in', 'out')
+# What every kind of issue means; the fixable ones say what the fix does
+ISSUE_KINDS = {
+    'bad_timestamp': "timestamp is not ISO 8601",
+    'naive_timestamp': "timestamp has no time zone (fix: mark it UTC, as epoch_us already assumes)",
+    'offset_timestamp': "timestamp is not in UTC (fix: convert it to UTC)",
+    'epoch_mismatch': "epoch_us is missing or does not match the timestamp (fix: recompute it)",
+    'bad_status': "status is neither in nor out",
+    'missing_code': "code is empty",
+    'duplicate': "same time, status and code as the stamp before (fix: delete it, stamp undo restores it)",
+    'unclosed_in': "in followed by another in (fix: delete the first, which no report counts; stamp undo restores it)",
+    'orphan_out': "out without an open session (fix: delete it, which no report counts; stamp undo restores it)",
+    'long_session': f"session longer than {MAX_SESSION_HOURS} hours",
+    'future': "stamped in the future",
+}
+# Repairs rewrite a timestamp in place; deletes go through an edit_journal batch, like stamp edit
+REPAIRS = ('naive_timestamp', 'offset_timestamp', 'epoch_mismatch')
+DELETES = ('duplicate', 'unclosed_in', 'orphan_out')
+FIXABLE = REPAIRS + DELETES
+
+
+class LogChecker:
+    # Streams the log in (epoch_us, id) order, the order reports pair sessions in, keeping only the
+    # previous stamp and the open session. Overlapping sessions show up as an unclosed_in followed by
+    # an orphan_out. Issues are (kind, ids, epoch_us, detail) tuples. The position of the last checked
+    # stamp is kept in meta, so later runs can start from there; edits before it need a full run.
+    def __init__(self, conn, archives=None, batch_size=CHECK_BATCH_SIZE, max_session_hours=MAX_SESSION_HOURS):
+        self.conn = conn
+        self.archives = archives
+        self.batch_size = batch_size
+        self.max_session_us = int(max_session_hours * 3600 * 1_000_000)
+        self.position = None
+
+    def saved_position(self):
+        row = fetchone(self.conn, "SELECT value FROM meta WHERE key = 'check_position'")
+        return tuple(int(value) for value in row[0].split()) if row else None
+
+    def save_position(self):
+        # The caller commits
+        if self.position is not None:
+            execute(self.conn, "INSERT OR REPLACE INTO meta (key, value) VALUES ('check_position', ?)",
+                    (f"{self.position[0]} {self.position[1]}",))
+
+    def check(self, incremental=False):
+        now_us = to_epoch_us(datetime.now(timezone.utc) + timedelta(minutes=1))
+        start = self.saved_position() if incremental else None
+        self.position = start
+
+        # Rows without an epoch have no place in the order; they are always looked at
+        for row in execute(self.conn, 'SELECT id, timestamp, status, code, epoch_us FROM log WHERE epoch_us IS NULL'):
+            yield from self._check_row(row, now_us)
+
+        previous = self._previous(start)
+        if start is None:
+            cursor = execute(self.conn, 'SELECT id, timestamp, status, code, epoch_us FROM log '
+                             'WHERE epoch_us IS NOT NULL ORDER BY epoch_us, id')
+        else:
+            cursor = execute(self.conn, 'SELECT id, timestamp, status, code, epoch_us FROM log '
+                             'WHERE (epoch_us, id) > (?, ?) ORDER BY epoch_us, id', start)
+        session = previous if previous is not None and previous[2] == 'in' else None
+        while True:
+            rows = cursor.fetchmany(self.batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield from self._check_row(row, now_us)
+                self.position = (row[4], row[0])
+                if previous is not None and (row[4], row[2], row[3]) == (previous[4], previous[2], previous[3]):
+                    yield 'duplicate', (row[0],), row[4], f"same as {previous[0]}"
+                    continue
+                if row[2] == 'in':
+                    if session is not None:
+                        yield 'unclosed_in', (session[0], row[0]), session[4], f"{session[0]} is never stamped out"
+                    session = row
+                elif row[2] == 'out':
+                    if session is None:
+                        yield 'orphan_out', (row[0],), row[4], "no in before it"
+                    elif row[4] - session[4] > self.max_session_us:
+                        yield ('long_session', (session[0], row[0]), session[4],
+                               f"{(row[4] - session[4]) / 3_600_000_000:.1f} hours")
+                    session = None
+                previous = row
+
+    def _check_row(self, row, now_us):
+        entry_id, timestamp, status, code, epoch_us = row
+        try:
+            parsed = datetime.fromisoformat(timestamp)
+        except (TypeError, ValueError):
+            yield 'bad_timestamp', (entry_id,), epoch_us, repr(timestamp)
+        else:
+            if parsed.tzinfo is None:
+                yield 'naive_timestamp', (entry_id,), epoch_us, timestamp
+            elif parsed.utcoffset():
+                yield 'offset_timestamp', (entry_id,), epoch_us, timestamp
+            if epoch_us != to_epoch_us(parsed):
+                yield 'epoch_mismatch', (entry_id,), epoch_us, f"{epoch_us} for {timestamp}"
+        if status not in STATUSES:
+            yield 'bad_status', (entry_id,), epoch_us, repr(status)
+        if not code:
+            yield 'missing_code', (entry_id,), epoch_us, ''
+        if epoch_us is not None and epoch_us > now_us:
+            yield 'future', (entry_id,), epoch_us, timestamp
+
+    def _previous(self, position):
+        # The stamp the stream continues from: the last one checked, or for a full run the newest
+        # archived stamp, so an archived in does not make the first out of the log an orphan
+        if position is not None:
+            row = fetchone(self.conn, 'SELECT id, timestamp, status, code, epoch_us FROM log WHERE (epoch_us, id) <= (?, ?) '
+                           'ORDER BY epoch_us DESC, id DESC LIMIT 1', position)
+            if row is not None:
+                return row
+            first_us = position[0]
+        else:
+            first_us = fetchone(self.conn, 'SELECT MIN(epoch_us) FROM log')[0]
+        if self.archives is None or first_us is None:
+            return None
+        year = fetchone(self.conn, 'SELECT from_us FROM archives WHERE from_us <= ? ORDER BY from_us DESC LIMIT 1',
+                        (first_us,))
+        if year is None:
+            return None
+        source = self.archives.source(year[0], first_us)
+        return fetchone(self.conn, f'SELECT id, timestamp, status, code, epoch_us FROM {source} '
+                        'WHERE epoch_us >= ? AND epoch_us < ? ORDER BY epoch_us DESC, id DESC LIMIT 1',
+                        (year[0], first_us))
+
+
+def fix_plan(fixes):
+    # (ids to delete, ids to repair) for the fixable issues among [(kind, ids)]
+    deletes, repairs = set(), set()
+    for kind, ids in fixes:
+        if kind in DELETES:
+            deletes.add(ids[0])
+        elif kind in REPAIRS:
+            repairs.add(ids[0])
+    return deletes, repairs - deletes
+
+
+def fix_write(fixes, daily_totals=None):
+    # A write (see StampCore) applying the fixable issues among [(kind, ids)] in one transaction:
+    # deletes first, as one batch in edit_journal so stamp undo puts the rows back, then timestamp and
+    # epoch repairs on what is left. Refreshes the daily totals of every day the fixed rows were or end
+    # up on. Returns (rows changed, batch id of the deletes or None).
+    deletes, repairs = fix_plan(fixes)
+    delete = batch_write('id IN (SELECT value FROM json_each(?))', (json.dumps(sorted(deletes)),), 'delete',
+                         description=f"check --fix: delete {len(deletes)} stamps", daily_totals=daily_totals)
+
+    def write(conn):
+        batch_id, changed = delete(conn) if deletes else (None, 0)
+        touched = []
+        for entry_id in sorted(repairs):
+            row = fetchone(conn, 'SELECT timestamp FROM log WHERE id = ?', (entry_id,))
+            if row is None:
+                continue
+            if daily_totals is not None:
+                touched += daily_totals.touched(conn, entry_id)
+            epoch_us = to_epoch_us(row[0])
+            changed += execute(conn, 'UPDATE log SET timestamp = ?, epoch_us = ? WHERE id = ?',
+                               (from_epoch_us(epoch_us).isoformat(), epoch_us, entry_id)).rowcount
+            if daily_totals is not None:
+                touched += daily_totals.touched(conn, entry_id)
+        if daily_totals is not None:
+            daily_totals.refresh(conn, touched)
+        return changed, batch_id
+    return write
@@ -0,0 +1,274 @@
+import argparse
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import stamp_sql
+from stamp_core import StampCore
+from stamp_db import from_epoch_us
+from stamp_sql import STATS
+
+
+def print_status(core):
+    last_entry = core.last_entry()
+    if last_entry is None:
+        print("Status: ")
+        return
+    timestamp, status, code = last_entry
+    print(f"Status: {status} @{timestamp.astimezone(core.time_zone).strftime('%Y-%m-%d %H:%M:%S')} ({code})")
+
+
+def stamp(core, args):
+    last_entry = core.last_entry()
+    if last_entry is not None and last_entry[1] == args.command and not args.force:
+        print(f"Already stamped {args.command}; use --force to stamp {args.command} again", file=sys.stderr)
+        return 1
+    core.stamp(args.command, args.code, args.comment)
+    print_status(core)
+    return 0
+
+
+def report(core, args):
+    result = core.report(args.from_date, args.to_date, args.period)
+    if result.empty:
+        print("No sessions found")
+    else:
+        print(result[['period', 'code', 'hours', 'sessions']].to_string(index=False, float_format='%.2f'))
+    return 0
+
+
+def export(core, args):
+    from stamp_export import export_csv
+
+    query, params, archives = core.export_query(args.from_date, args.to_date, args.sql)
+    if args.output:
+        csv_path = Path(args.output)
+    else:
+        core.out_dir.mkdir(parents=True, exist_ok=True)
+        csv_path = core.out_dir / core.export_filename(args.from_date, args.to_date, args.gzip)
+    written = export_csv(core.DB_FILE, csv_path, query, params, core.time_zone, compress=args.gzip, archives=archives)
+    if written:
+        print(f"Data successfully dumped to {csv_path} ({written} rows)")
+    else:
+        print("No entries found for the specified date range.")
+    return 0
+
+
+def search(core, args):
+    query, params = core.search_query(args.text, args.from_date, args.to_date, args.limit)
+    rows = stamp_sql.fetchall(core.conn, query, params)[:args.limit]
+    for row in rows:
+        local_time = datetime.fromisoformat(row[1]).replace(tzinfo=timezone.utc).astimezone(core.time_zone).strftime('%Y-%m-%d %H:%M')
+        print(f"{row[0]:>8}  {local_time}  {row[2]:<3}  {row[3]:<12}  {row[4] or ''}")
+    if not rows:
+        print("No matches")
+    return 0
+
+
+def import_entries(core, args):
+    from stamp_import import import_file
+
+    time_zone = core.time_zone
+    if args.time_zone:
+        from pytz import timezone
+        time_zone = timezone(args.time_zone)
+    stats = import_file(core.conn, args.path, time_zone, core.daily_totals, args.format)
+    core.cache.invalidate()
+    rate = stats['read'] / stats['seconds'] if stats['seconds'] else 0
+    print(f"Imported {stats['imported']} of {stats['read']} rows "
+          f"({stats['duplicates']} duplicates, {stats['invalid']} invalid) in {stats['seconds']:.2f}s, {rate:,.0f} rows/s")
+    return 0
+
+
+def snapshot(core, args):
+    from stamp_snapshot import write_snapshot
+
+    directory = Path(args.dir) if args.dir else core.base_dir / core.defaults.get('snapshot_dir', 'out/snapshot/')
+    stats = write_snapshot(core.DB_FILE, directory, args.full)
+    rate = stats['added'] / stats['seconds'] if stats['seconds'] else 0
+    print(f"Snapshot in {directory} ({stats['mode']}): {stats['added']} rows added, {stats['rows']} in total "
+          f"in {stats['seconds']:.2f}s, {rate:,.0f} rows/s")
+    return 0
+
+
+def confirm(question):
+    try:
+        answer = input(f"{question} [y/N] ")
+    except EOFError:
+        answer = ''
+    return answer.strip().lower() in ('y', 'yes')
+
+
+def check(core, args):
+    from stamp_check import FIXABLE, ISSUE_KINDS, LogChecker, fix_plan, fix_write
+
+    checker = LogChecker(core.conn, core.archives)
+    counts = {}
+    fixes = []
+    for kind, ids, epoch_us, detail in checker.check(args.incremental):
+        counts[kind] = counts.get(kind, 0) + 1
+        if kind in FIXABLE:
+            fixes.append((kind, ids))
+        if not args.quiet:
+            local_time = '?' if epoch_us is None else from_epoch_us(epoch_us).astimezone(core.time_zone).strftime('%Y-%m-%d %H:%M')
+            print(f"{kind:<16}  {','.join(str(i) for i in ids):<15}  {local_time:<16}  {detail}")
+
+    for kind, count in counts.items():
+        print(f"{count:>8}  {kind}: {ISSUE_KINDS[kind]}")
+    if not counts:
+        print("No issues found")
+    fix = args.fix and fixes
+    if fix and not args.yes:
+        deletes, repairs = fix_plan(fixes)
+        fix = confirm(f"Delete {len(deletes)} stamps and repair {len(repairs)} timestamps?")
+        if not fix:
+            print("Nothing changed")
+
+    def finish(conn):
+        # Fixes and the new position in one transaction
+        changed, batch_id = fix_write(fixes, core.daily_totals)(conn) if fix else (0, None)
+        checker.save_position()
+        return changed, batch_id
+
+    changed, batch_id = core.apply(finish)
+    if fix:
+        undo_note = f"; `stamp undo` puts back the deleted stamps (batch {batch_id})" if batch_id else ''
+        print(f"Fixed {len(fixes)} issues, {changed} rows changed{undo_note}; run again to check the result")
+    return 1 if any(kind not in FIXABLE or not fix for kind in counts) else 0
+
+
+def batch_edit(core, args):
+    from stamp_batch import batch_write, describe, preview, selection
+
+    if args.shift is not None:
+        operation, value = 'shift', timedelta(hours=args.shift)
+    elif args.recode is not None:
+        operation, value = 'recode', args.recode
+    elif args.set_comment is not None:
+        operation, value = 'comment', args.set_comment
+    elif args.replace is not None:
+        operation, value = 'replace', tuple(args.replace)
+    else:
+        operation, value = 'delete', None
+    where, params = selection(*core.epoch_range(args.from_date, args.to_date), args.code, args.status, args.match)
+    rows = preview(core.conn, where, params)[0]
+    print(f"{describe(operation, value)}: {rows} stamps from {args.from_date} to {args.to_date}")
+    if not rows:
+        return 0
+    if not args.yes and not confirm("Apply?"):
+        print("Nothing changed")
+        return 1
+    batch_id, changed = core.apply(batch_write(where, params, operation, value, daily_totals=core.daily_totals))
+    print(f"Changed {changed} stamps (batch {batch_id}); `stamp undo` reverts it")
+    return 0
+
+
+def undo(core, args):
+    from stamp_batch import list_batches, skipped_lines, undo_write
+
+    if args.list:
+        for batch_id, created, description, rows, undone in list_batches(core.conn):
+            print(f"{batch_id:>6}  {created}  {rows:>7} stamps  {description}{'  (undone)' if undone else ''}")
+        return 0
+    undone = core.apply(undo_write(core.daily_totals))
+    if undone is None:
+        print("Nothing to undo")
+        return 1
+    batch_id, description, skipped = undone
+    print(f"Undid batch {batch_id}: {description}")
+    for line in skipped_lines(skipped):
+        print(line)
+    print_status(core)
+    return 0
+
+
+def main(argv=None):
+    now = datetime.now()
+    parser = argparse.ArgumentParser(prog='stamp', description="Stamp in and out without starting the GUI")
+    parser.add_argument('--config', help="defaults.yaml to use")
+    parser.add_argument('--sql-stats', metavar='JSON', help="record SQL statistics and write them here on exit")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    for status in ('in', 'out'):
+        stamp_parser = subparsers.add_parser(status, help=f"stamp {status}")
+        stamp_parser.add_argument('-c', '--code', help="code (default from defaults.yaml)")
+        stamp_parser.add_argument('-m', '--comment', help="comment")
+        stamp_parser.add_argument('-f', '--force', action='store_true', help=f"stamp {status} even if already {status}")
+    subparsers.add_parser('status', help="show the latest stamp")
+
+    range_parser = argparse.ArgumentParser(add_help=False)
+    range_parser.add_argument('--from', dest='from_date', default=(now - timedelta(days=7)).strftime("%Y-%m-%d %H:%M"),
+                              help="start, 'YYYY-MM-DD HH:MM' (default: a week ago)")
+    range_parser.add_argument('--to', dest='to_date', default=now.strftime("%Y-%m-%d %H:%M"),
+                              help="end, 'YYYY-MM-DD HH:MM' (default: now)")
+    report_parser = subparsers.add_parser('report', parents=[range_parser], help="worked hours per code")
+    report_parser.add_argument('--period', choices=['day', 'week', 'month', 'total'], default='day')
+    export_parser = subparsers.add_parser('export', parents=[range_parser], help="dump entries to CSV")
+    export_parser.add_argument('--sql', help="export this query instead of the date range")
+    export_parser.add_argument('--gzip', action='store_true')
+    export_parser.add_argument('-o', '--output', help="output file (default: out/<from>_<to>.csv)")
+    search_parser = subparsers.add_parser('search', help="full-text search over comments and codes")
+    search_parser.add_argument('text')
+    search_parser.add_argument('--from', dest='from_date', help="only stamps from, 'YYYY-MM-DD HH:MM'")
+    search_parser.add_argument('--to', dest='to_date', default=now.strftime("%Y-%m-%d %H:%M"),
+                               help="only stamps to, 'YYYY-MM-DD HH:MM' (with --from; default: now)")
+    search_parser.add_argument('-n', '--limit', type=int, default=20)
+    import_parser = subparsers.add_parser('import', help="bulk import stamps from CSV (as written by export) or JSONL")
+    import_parser.add_argument('path')
+    import_parser.add_argument('--format', choices=['csv', 'jsonl'], help="default: from the file extension")
+    import_parser.add_argument('--time-zone', help="zone of timestamps without an offset (default: local)")
+    snapshot_parser = subparsers.add_parser('snapshot', help="write or extend a columnar NumPy snapshot of all stamps")
+    snapshot_parser.add_argument('dir', nargs='?', help="snapshot directory (default: snapshot_dir in defaults.yaml)")
+    snapshot_parser.add_argument('--full', action='store_true', help="rewrite it instead of appending newer stamps")
+    check_parser = subparsers.add_parser('check', help="check the log for stamps out of sequence and bad timestamps")
+    check_parser.add_argument('--incremental', action='store_true', help="only stamps after the last checked one")
+    check_parser.add_argument('--fix', action='store_true', help="apply the fixable issues in one transaction")
+    check_parser.add_argument('-y', '--yes', action='store_true', help="do not ask before fixing")
+    check_parser.add_argument('-q', '--quiet', action='store_true', help="only print the counts")
+    edit_parser = subparsers.add_parser('edit', parents=[range_parser], help="change every stamp in a range at once")
+    edit_parser.add_argument('--code', help="only stamps with this code")
+    edit_parser.add_argument('--status', choices=['in', 'out'], help="only stamps with this status")
+    edit_parser.add_argument('--match', help="only stamps whose comment contains this")
+    operation_group = edit_parser.add_mutually_exclusive_group(required=True)
+    operation_group.add_argument('--shift', type=float, metavar='HOURS', help="move the stamps by this many hours")
+    operation_group.add_argument('--recode', metavar='CODE', help="give the stamps this code")
+    operation_group.add_argument('--set-comment', metavar='TEXT', help="replace the comments with this")
+    operation_group.add_argument('--replace', nargs=2, metavar=('OLD', 'NEW'), help="replace text within the comments")
+    operation_group.add_argument('--delete', action='store_true', help="delete the stamps")
+    edit_parser.add_argument('-y', '--yes', action='store_true', help="do not ask before applying")
+    undo_parser = subparsers.add_parser('undo', help="revert the latest batch edit")
+    undo_parser.add_argument('--list', action='store_true', help="list the batch edits that can be undone")
+    args = parser.parse_args(argv)
+
+    core = StampCore(args.config)
+    if args.sql_stats:
+        STATS.enabled = True
+    try:
+        if args.command == 'status':
+            print_status(core)
+            return 0
+        if args.command in ('in', 'out'):
+            return stamp(core, args)
+        if args.command == 'report':
+            return report(core, args)
+        if args.command == 'search':
+            return search(core, args)
+        if args.command == 'import':
+            return import_entries(core, args)
+        if args.command == 'snapshot':
+            return snapshot(core, args)
+        if args.command == 'check':
+            return check(core, args)
+        if args.command == 'edit':
+            return batch_edit(core, args)
+        if args.command == 'undo':
+            return undo(core, args)
+        return export(core, args)
+    finally:
+        core.close()
+        if args.sql_stats:
+            STATS.dump_json(args.sql_stats)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,342 @@
+import json
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from pytz import timezone, utc
+
+import stamp_db
+import stamp_sql
+from stamp_archive import Archives, overlapping, union_source
+from stamp_cache import QUERY_CACHE_SIZE, QueryCache
+from stamp_db import LOG_COLUMNS, from_epoch_us, to_epoch_us
+from stamp_query import QUERY_ROW_CAP, QUERY_TIME_LIMIT
+from stamp_totals import DailyTotals
+
+# Everything here is usable without tkinter; heavier modules (backup, export, numpy/pandas reports)
+# are imported where they are used so scripts like `stamp_cli.py status` start fast.
+
+DEFAULTS_FILE = 'defaults.yaml'
+# The parsed config, next to the other outputs of the config's directory
+DEFAULTS_CACHE = 'out/defaults_cache.json'
+DEFAULT_DB_PATH = 'out/current/time_log.db'
+SEARCH_RANK_LIMIT = 10_000
+
+
+def default_config_path():
+    # The working directory wins, so the desktop launcher's --cwd keeps working; otherwise use the checkout
+    path = Path(DEFAULTS_FILE)
+    return path if path.is_file() else Path(__file__).with_name(DEFAULTS_FILE)
+
+
+def script_config(config_path=None):
+    # (defaults, base directory, database) for the standalone scripts, which resolve relative paths in
+    # the config next to it the way StampCore does
+    config_path = Path(config_path) if config_path else default_config_path()
+    defaults = load_defaults(config_path)
+    return defaults, config_path.parent, config_db_path(defaults, config_path.parent)
+
+
+def config_db_path(defaults, base_dir):
+    # db_path unless it names no existing .db file, in which case the default location
+    db_path = base_dir / defaults.get('db_path', DEFAULT_DB_PATH)
+    if not (db_path.is_file() and db_path.suffix == '.db'):
+        db_path = base_dir / DEFAULT_DB_PATH
+    return db_path
+
+
+def load_defaults(file_path):
+    # Parsed YAML is cached as JSON and reused while the file keeps its mtime and size, so starting
+    # without config changes does not import yaml
+    file_path = Path(file_path)
+    try:
+        stat = file_path.stat()
+    except FileNotFoundError:
+        return {}
+    key = [str(file_path.resolve()), stat.st_mtime_ns, stat.st_size]
+    cache_path = file_path.parent / DEFAULTS_CACHE
+    try:
+        with open(cache_path, 'r') as file:
+            cached = json.load(file)
+        if cached['key'] == key:
+            return cached['defaults']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    import yaml
+
+    try:
+        with open(file_path, 'r') as file:
+            defaults = yaml.safe_load(file) or {}
+    except FileNotFoundError:
+        return {}
+    except yaml.YAMLError as e:
+        print(f"Ignoring {file_path}, it is not valid YAML: {e}")
+        return {}
+    try:
+        text = json.dumps({'key': key, 'defaults': defaults})
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, 'w') as file:
+            file.write(text)
+    except (OSError, TypeError, ValueError):
+        # Values JSON cannot hold (e.g. YAML dates) are simply parsed every time
+        pass
+    return defaults
+
+
+def parse_date(date_str, default_time, seconds_included=True):
+    formats = [
+        "%Y-%m-%d %H:%M:%S" if seconds_included else "%Y-%m-%d %H:%M",
+        "%Y-%m-%d %H:%M"
+    ]
+
+    for fmt in formats:
+        try:
+            return datetime.strptime(date_str, fmt)
+        except (TypeError, ValueError):
+            continue
+
+    return default_time
+
+
+def fts_match(text):
+    # Every word must match as a prefix; quoting keeps FTS5 syntax characters in user input literal
+    return ' '.join('"' + word.replace('"', '""') + '"*' for word in text.split())
+
+
+class StampCore:
+    def __init__(self, config_path=None, setup=True, connect=True):
+        # setup=False leaves migrations and the daily totals check to a later setup_database() call,
+        # for the app to run after its window is up. connect=False opens no database until connect(), which
+        # the app skips with server_url set: the stamp server owns the database then.
+        config_path = Path(config_path) if config_path else default_config_path()
+        self.defaults = load_defaults(config_path)
+        # Relative paths in the config are relative to the config file
+        self.base_dir = config_path.parent
+
+        # Load codes from defaults
+        self.codes = [code.strip() for code in self.defaults.get('codes', 'work,lunch,play').split(',')]
+        self.default_code_stamp_in = self.defaults.get('default_code_stamp_in', 'work')
+        self.default_code_stamp_out = self.defaults.get('default_code_stamp_out', 'play')
+
+        self.lunch_start = datetime.strptime(self.defaults.get('typical_lunch_start', '10:30'), '%H:%M').time()
+        self.lunch_stop = datetime.strptime(self.defaults.get('typical_lunch_stop', '13:00'), '%H:%M').time()
+
+        self.time_zone = timezone(str(datetime.now().astimezone().tzinfo))
+
+        self.DB_FILE = config_db_path(self.defaults, self.base_dir)
+        # A stamp server (stamp_server.py) the app goes through instead of the file
+        self.server_url = self.defaults.get('server_url') or None
+
+        self.backup_days = int(self.defaults.get('backup_days', '7'))
+        self.backup_dir = self.base_dir / self.defaults.get('backup_dir', 'out/backups/')
+        self.backup_compression = self.defaults.get('backup_compression', 'none')
+        self.backup_keep = int(self.defaults.get('backup_keep', 10))
+        self.backup_pages_per_step = int(self.defaults.get('backup_pages_per_step', 256))
+        self.out_dir = self.base_dir / 'out'
+        # Bounds for SQL typed into Browse; 0 turns the time limit off
+        self.sql_time_limit = float(self.defaults.get('sql_time_limit', QUERY_TIME_LIMIT))
+        self.sql_row_cap = int(self.defaults.get('sql_row_cap', QUERY_ROW_CAP))
+
+        stamp_sql.STATS.configure(bool(self.defaults.get('sql_stats', False)),
+                                  float(self.defaults.get('slow_query_ms', stamp_sql.SLOW_QUERY_MS)),
+                                  self.base_dir / self.defaults.get('slow_query_log', 'out/slow_queries.log'))
+        self.conn = self.cache = self.archives = self.daily_totals = None
+        if connect:
+            self.connect()
+            if setup:
+                self.setup_database()
+
+    def connect(self):
+        self.DB_FILE.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = stamp_db.connect(self.DB_FILE)
+        self.cache = QueryCache(self.conn, int(self.defaults.get('query_cache_size', QUERY_CACHE_SIZE)))
+        self.archives = Archives(self.conn)
+        self.daily_totals = DailyTotals(self.time_zone, self.lunch_start, self.lunch_stop, archived=True)
+
+    def setup_database(self):
+        # Returns whether the daily totals were rebuilt
+        stamp_db.migrate(self.conn)
+        return self.daily_totals.ensure(self.conn, self.archives.partitions(self.daily_totals.window))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+    def last_entry(self):
+        # (utc timestamp, status, code) of the latest stamp, or None; current_state is kept by triggers on log
+        last_db_entry = self.cache.fetchone("SELECT timestamp, status, code FROM current_state")
+        if last_db_entry is None:
+            return None
+        return datetime.fromisoformat(last_db_entry[0]).replace(tzinfo=utc), last_db_entry[1], last_db_entry[2]
+
+    def open_session_start(self):
+        # utc start of the session stamped in and not yet out, or None
+        row = self.cache.fetchone("SELECT session_start FROM current_state")
+        return datetime.fromisoformat(row[0]).replace(tzinfo=utc) if row and row[0] else None
+
+    def latest_id(self):
+        # Id of the same latest stamp last_entry() describes
+        row = self.cache.fetchone("SELECT entry_id FROM current_state")
+        return row[0] if row else None
+
+    def get_entry(self, entry_id):
+        return self.cache.fetchone(f"SELECT {LOG_COLUMNS} FROM log WHERE id = ?", (int(entry_id),))
+
+    def adjacent_id(self, entry_id, step):
+        # Nearest id before (step < 0) or after (step > 0) entry_id
+        if step < 0:
+            query = "SELECT id FROM log WHERE id < ? ORDER BY id DESC LIMIT 1"
+        else:
+            query = "SELECT id FROM log WHERE id > ? ORDER BY id ASC LIMIT 1"
+        row = self.cache.fetchone(query, (int(entry_id),))
+        return row[0] if row else None
+
+    def entry_window(self):
+        from stamp_navigator import EntryWindow, fetch_window, read_window
+
+        return EntryWindow(lambda entry_id, radius: fetch_window(self.conn, entry_id, radius), self.cache.data_version,
+                           int(self.defaults.get('modify_prefetch_rows', 200)),
+                           refill_fetch=lambda entry_id, radius: read_window(self.DB_FILE, entry_id, radius))
+
+    def get_last_backup_info(self):
+        last_backup = stamp_sql.fetchone(self.conn, 'SELECT time FROM backup_log ORDER BY time DESC LIMIT 1')
+        if last_backup:
+            last_backup_time = datetime.strptime(last_backup[0], '%Y-%m-%d %H:%M:%S')
+            return last_backup_time
+        else:
+            return None
+
+    def backup_due(self):
+        creation_time = self.get_last_backup_info()
+        if creation_time is None:
+            return True
+        return (datetime.now() - creation_time).days >= self.backup_days
+
+    def start_backup(self):
+        from stamp_backup import BackupJob
+
+        job = BackupJob(self.DB_FILE, self.backup_dir, self.backup_compression,
+                        self.backup_keep, self.backup_pages_per_step)
+        job.start()
+        return job
+
+    def epoch_range(self, from_date_str, to_date_str):
+        from_date = parse_date(from_date_str, datetime.now() - timedelta(days=7), seconds_included=True)
+        if from_date.tzinfo is None:
+            from_date = self.time_zone.localize(from_date).astimezone(utc)
+
+        to_date = parse_date(to_date_str, datetime.now(), seconds_included=False)
+        if to_date.tzinfo is None:
+            to_date = self.time_zone.localize(to_date).astimezone(utc)
+
+        to_date = to_date.replace(second=59, microsecond=999999)
+        return to_epoch_us(from_date), to_epoch_us(to_date)
+
+    def day_range(self, from_date_str, to_date_str):
+        from_us, to_us = self.epoch_range(from_date_str, to_date_str)
+        return (from_epoch_us(from_us).astimezone(self.time_zone).date(),
+                from_epoch_us(to_us).astimezone(self.time_zone).date())
+
+    def log_source(self, from_us, to_us):
+        # The log, or its union with the archives overlapping [from_us, to_us], attached to self.conn
+        return self.archives.source(from_us, to_us)
+
+    def query_archives(self, query_str):
+        # Ad-hoc SQL sees archived years through the all_log view; the archives are attached only if it is used
+        return overlapping(self.conn) if 'all_log' in query_str else []
+
+    def export_query(self, from_date_str, to_date_str, query_str=None):
+        # (query, params, archives) for export_csv, which attaches the archives to its own connection
+        if query_str:
+            from stamp_query import typed_query
+
+            return typed_query(query_str), (), self.query_archives(query_str)
+        from_us, to_us = self.epoch_range(from_date_str, to_date_str)
+        archives = overlapping(self.conn, from_us, to_us)
+        query = (f"SELECT {LOG_COLUMNS} FROM {union_source([alias for alias, _ in archives])} "
+                 "WHERE epoch_us BETWEEN ? AND ? ORDER BY epoch_us")
+        return query, (from_us, to_us), archives
+
+    def search_query(self, text, from_date_str=None, to_date_str=None, limit=None):
+        # Best matches first for comment/code search, with matches in the comment marked by « »
+        if not text.split():
+            raise ValueError("Nothing to search for")
+        limit = limit or self.sql_row_cap
+        in_range, range_params = '', ()
+        if from_date_str is not None:
+            in_range, range_params = 'AND log.epoch_us BETWEEN ? AND ?', self.epoch_range(from_date_str, to_date_str)
+        if stamp_db.has_comment_search(self.conn):
+            match = fts_match(text)
+            # bm25 costs a lookup per match, so words on many stamps list the newest matches instead. Counting
+            # stops past the limit, so this stays cheap however common the words are.
+            matches = stamp_sql.fetchone(self.conn, 'SELECT COUNT(*) FROM (SELECT 1 FROM log_fts WHERE log_fts MATCH ? LIMIT ?)',
+                                         (match, SEARCH_RANK_LIMIT + 1))[0]
+            order = 'rank' if matches <= SEARCH_RANK_LIMIT else 'log_fts.rowid DESC'
+            query = ("SELECT log.id, log.timestamp, log.status, log.code, highlight(log_fts, 0, '«', '»') "
+                     f"FROM log_fts JOIN log ON log.id = log_fts.rowid WHERE log_fts MATCH ? {in_range} "
+                     f"ORDER BY {order} LIMIT ?")
+            return query, (match,) + range_params + (limit + 1,)
+        # No FTS5 in this SQLite: newest matches first, the slow way
+        pattern = '%' + text.strip() + '%'
+        query = (f"SELECT {LOG_COLUMNS} FROM log WHERE (comment LIKE ? OR code LIKE ?) {in_range} "
+                 "ORDER BY epoch_us DESC LIMIT ?")
+        return query, (pattern, pattern) + range_params + (limit + 1,)
+
+    # Writes are functions of a connection so the GUI can queue them on its DatabaseWriter
+    # while scripts run them directly through apply(). None of them commit.
+
+    def insert_write(self, timestamp, status, code, comment):
+        def write(conn):
+            cursor = stamp_sql.execute(conn, "INSERT INTO log (timestamp, status, code, comment, epoch_us) VALUES (?, ?, ?, ?, ?)",
+                                  (timestamp.isoformat(), status, code, comment, to_epoch_us(timestamp)))
+            if not self.daily_totals.append(conn, cursor.lastrowid):
+                self.daily_totals.refresh(conn, self.daily_totals.touched(conn, cursor.lastrowid))
+            return cursor.lastrowid
+        return write
+
+    def update_write(self, entry_id, timestamp, status, code, comment):
+        def write(conn):
+            touched = self.daily_totals.touched(conn, entry_id)
+            stamp_sql.execute(conn, "UPDATE log SET timestamp = ?, status = ?, code = ?, comment = ?, epoch_us = ? WHERE id = ?",
+                         (timestamp.isoformat(), status, code, comment, to_epoch_us(timestamp), entry_id))
+            self.daily_totals.refresh(conn, touched + self.daily_totals.touched(conn, entry_id))
+        return write
+
+    def delete_write(self, entry_id):
+        def write(conn):
+            touched = self.daily_totals.touched(conn, entry_id)
+            stamp_sql.execute(conn, "DELETE FROM log WHERE id = ?", (entry_id,))
+            self.daily_totals.refresh(conn, touched)
+        return write
+
+    def apply(self, write):
+        try:
+            return stamp_db.run_write(self.conn, write)
+        finally:
+            # Commits on our own connection do not move PRAGMA data_version
+            self.cache.invalidate()
+
+    def stamp_write(self, status, code=None, comment=None, timestamp=None):
+        # insert_write with the configured defaults for whatever is not given
+        if status not in ('in', 'out'):
+            raise ValueError(f"Unknown status: {status}")
+        timestamp = timestamp or datetime.now(utc)
+        if code is None:
+            code = self.default_code_stamp_in if status == 'in' else self.default_code_stamp_out
+        if not comment:
+            comment = self.defaults.get(f'default_stamp_{status}_comment', '')
+        return self.insert_write(timestamp, status, code, comment)
+
+    def stamp(self, status, code=None, comment=None, timestamp=None):
+        # Returns the new row id
+        return self.apply(self.stamp_write(status, code, comment, timestamp))
+
+    def report(self, from_date_str, to_date_str, period='day'):
+        from stamp_report import daily_time_report
+
+        # Whole local days from the maintained daily_totals rollup
+        from_day, to_day = self.day_range(from_date_str, to_date_str)
+        return daily_time_report(self.conn, from_day, to_day, period)
+
+    def export_filename(self, from_date_str, to_date_str, compress=False):
+        return f"{from_date_str[:10]}_{to_date_str[:10]}.csv" + ('.gz' if compress else '')
@@ -0,0 +1,343 @@
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MIGRATION_BATCH_SIZE = 5000
+LOG_COLUMNS = 'id, timestamp, status, code, comment'
+
+# Connection settings shared by the app, scripts and background threads
+BUSY_TIMEOUT = 5.0
+CACHE_SIZE_KB = 16 * 1024
+MMAP_SIZE = 256 * 1024 * 1024
+WRITE_RETRIES = 5
+RETRY_BACKOFF = 0.05
+CHECKPOINT_INTERVAL = 60
+
+
+def connect(db_file, read_only=False, isolation_level='', timeout=BUSY_TIMEOUT, check_same_thread=True):
+    # Every connection to the stamp database comes from here. WAL lets readers and one writer work at once
+    # across processes, synchronous=NORMAL is durable enough with WAL, and lock waits go through the busy
+    # timeout instead of failing with "database is locked".
+    if read_only:
+        conn = sqlite3.connect(f"{Path(db_file).resolve().as_uri()}?mode=ro", uri=True, timeout=timeout,
+                               isolation_level=isolation_level, check_same_thread=check_same_thread)
+    else:
+        conn = sqlite3.connect(db_file, timeout=timeout, isolation_level=isolation_level,
+                               check_same_thread=check_same_thread)
+        # Persistent in the file; cheap once set
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = {-CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    return conn
+
+
+def is_busy(error):
+    # SQLITE_BUSY / SQLITE_LOCKED and their extended codes, e.g. a read snapshot gone stale under WAL
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+
+
+def backoff(attempt):
+    # Exponential with jitter so writers in separate processes do not retry in lockstep
+    time.sleep(RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def run_write(conn, write, retries=WRITE_RETRIES):
+    # Runs write(conn) in its own IMMEDIATE transaction and commits, retrying the whole transaction when
+    # another process holds the lock past the busy timeout. The write must be safe to run again.
+    for attempt in range(retries + 1):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            result = write(conn)
+            conn.commit()
+            return result
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.rollback()
+            if not is_busy(e) or attempt == retries:
+                raise
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        backoff(attempt)
+
+
+def checkpoint(conn):
+    # Passive: copies what it can from the WAL without waiting on readers or blocking writers
+    return conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+
+
+def to_epoch_us(timestamp):
+    # Stored timestamps are UTC; naive ones (e.g. typed into the edit dialog) are taken as UTC too
+    dt = datetime.fromisoformat(timestamp) if isinstance(timestamp, str) else timestamp
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def from_epoch_us(epoch_us):
+    return EPOCH + timedelta(microseconds=epoch_us)
+
+
+def backfill_epoch(conn, batch_size=MIGRATION_BATCH_SIZE):
+    # Fill epoch_us for rows written without it, one committed batch at a time
+    while True:
+        rows = conn.execute('SELECT id, timestamp FROM log WHERE epoch_us IS NULL LIMIT ?',
+                            (batch_size,)).fetchall()
+        if not rows:
+            return
+        conn.executemany('UPDATE log SET epoch_us = ? WHERE id = ?',
+                         [(to_epoch_us(ts), row_id) for row_id, ts in rows])
+        conn.commit()
+
+
+def drop_indexes(conn, table):
+    # Drops the explicit indexes on a table and returns their SQL so they can be recreated after a bulk load
+    indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? "
+                           "AND sql IS NOT NULL", (table,)).fetchall()
+    for name, _ in indexes:
+        conn.execute(f'DROP INDEX {name}')
+    return [sql for _, sql in indexes]
+
+
+def create_indexes(conn, index_sql):
+    for sql in index_sql:
+        conn.execute(sql)
+
+
+def drop_triggers(conn, table):
+    # Drops the triggers on a table and returns their SQL, for bulk loads that do the triggers' work
+    # set-based and put them back with create_indexes in the same transaction
+    triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?",
+                            (table,)).fetchall()
+    for name, _ in triggers:
+        conn.execute(f'DROP TRIGGER {name}')
+    return [sql for _, sql in triggers]
+
+
+def _create_base_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS log (
+                        id INTEGER PRIMARY KEY,
+                        timestamp TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        code TEXT NOT NULL,
+                        comment TEXT
+                    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS backup_log (
+                        time TEXT PRIMARY KEY,
+                        backup_path TEXT NOT NULL
+                    )''')
+
+
+def _add_epoch_column(conn):
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(log)')]
+    if 'epoch_us' not in columns:
+        conn.execute('ALTER TABLE log ADD COLUMN epoch_us INTEGER')
+    backfill_epoch(conn)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_log_epoch ON log (epoch_us, status)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_log_code_epoch ON log (code, epoch_us)')
+
+
+def _add_backup_hash_columns(conn):
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(backup_log)')]
+    if 'content_hash' not in columns:
+        conn.execute('ALTER TABLE backup_log ADD COLUMN content_hash TEXT')
+    if 'compression' not in columns:
+        conn.execute('ALTER TABLE backup_log ADD COLUMN compression TEXT')
+
+
+def _add_daily_totals(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS daily_totals (
+                        day TEXT NOT NULL,
+                        code TEXT NOT NULL,
+                        seconds REAL NOT NULL,
+                        lunch_seconds REAL NOT NULL,
+                        sessions INTEGER NOT NULL,
+                        events INTEGER NOT NULL,
+                        PRIMARY KEY (day, code)
+                    ) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS meta (
+                        key TEXT PRIMARY KEY,
+                        value TEXT
+                    )''')
+
+
+def _add_comment_search(conn):
+    # External-content FTS5 index over comment and code, kept in sync with log by triggers.
+    # SQLite builds without FTS5 skip it and search falls back to LIKE.
+    try:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS log_fts USING fts5("
+                     "comment, code, content='log', content_rowid='id', prefix='2 3')")
+    except sqlite3.OperationalError as e:
+        print(f'comment search index not created: {e}')
+        return
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS log_fts_insert AFTER INSERT ON log BEGIN
+                        INSERT INTO log_fts (rowid, comment, code) VALUES (new.id, new.comment, new.code);
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS log_fts_delete AFTER DELETE ON log BEGIN
+                        INSERT INTO log_fts (log_fts, rowid, comment, code) VALUES ('delete', old.id, old.comment, old.code);
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS log_fts_update AFTER UPDATE OF comment, code ON log BEGIN
+                        INSERT INTO log_fts (log_fts, rowid, comment, code) VALUES ('delete', old.id, old.comment, old.code);
+                        INSERT INTO log_fts (rowid, comment, code) VALUES (new.id, new.comment, new.code);
+                    END''')
+    conn.execute("INSERT INTO log_fts (log_fts) VALUES ('rebuild')")
+
+
+def _add_archives(conn):
+    # One row per closed year moved out of log into its own read-only database (stamp_archive)
+    conn.execute('''CREATE TABLE IF NOT EXISTS archives (
+                        year INTEGER PRIMARY KEY,
+                        path TEXT NOT NULL,
+                        from_us INTEGER NOT NULL,
+                        to_us INTEGER NOT NULL,
+                        rows INTEGER NOT NULL,
+                        created TEXT NOT NULL
+                    )''')
+
+
+# The newest stamp by time, ties going to the highest id; MAX() keeps it an index lookup
+CURRENT_STATE_REFRESH = [
+    'DELETE FROM current_state',
+    '''INSERT INTO current_state (id, entry_id, timestamp, epoch_us, status, code, session_start)
+       SELECT 1, id, timestamp, epoch_us, status, code, CASE WHEN status = 'in' THEN timestamp END
+       FROM log WHERE epoch_us = (SELECT MAX(epoch_us) FROM log) ORDER BY id DESC LIMIT 1''',
+]
+
+
+def _add_current_state(conn):
+    # Single row describing the newest stamp, kept by triggers so the status is one lookup.
+    # Edits and deletes only recompute it when they touch the newest stamp or move a row past it.
+    conn.execute('''CREATE TABLE IF NOT EXISTS current_state (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        entry_id INTEGER NOT NULL,
+                        timestamp TEXT NOT NULL,
+                        epoch_us INTEGER NOT NULL,
+                        status TEXT NOT NULL,
+                        code TEXT NOT NULL,
+                        session_start TEXT
+                    )''')
+    refresh = ''.join(statement + ';\n' for statement in CURRENT_STATE_REFRESH)
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS current_state_insert AFTER INSERT ON log
+                    WHEN new.epoch_us >= COALESCE((SELECT epoch_us FROM current_state), new.epoch_us) BEGIN
+                        INSERT OR REPLACE INTO current_state (id, entry_id, timestamp, epoch_us, status, code, session_start)
+                        VALUES (1, new.id, new.timestamp, new.epoch_us, new.status, new.code,
+                                CASE WHEN new.status = 'in' THEN new.timestamp END);
+                    END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS current_state_delete AFTER DELETE ON log
+                     WHEN old.id = (SELECT entry_id FROM current_state) BEGIN
+                         {refresh}
+                     END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS current_state_update AFTER UPDATE ON log
+                     WHEN old.id = (SELECT entry_id FROM current_state)
+                       OR new.epoch_us >= COALESCE((SELECT epoch_us FROM current_state), new.epoch_us) BEGIN
+                         {refresh}
+                     END''')
+    for statement in CURRENT_STATE_REFRESH:
+        conn.execute(statement)
+
+
+def _add_edit_journal(conn):
+    # Rows as they were before each batch edit (stamp_batch), so the latest batch can be undone
+    conn.execute('''CREATE TABLE IF NOT EXISTS edit_batches (
+                        id INTEGER PRIMARY KEY,
+                        created TEXT NOT NULL,
+                        operation TEXT NOT NULL,
+                        description TEXT NOT NULL,
+                        rows INTEGER NOT NULL,
+                        undone INTEGER NOT NULL DEFAULT 0
+                    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS edit_journal (
+                        batch_id INTEGER NOT NULL,
+                        id INTEGER NOT NULL,
+                        timestamp TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        code TEXT NOT NULL,
+                        comment TEXT,
+                        epoch_us INTEGER,
+                        PRIMARY KEY (batch_id, id)
+                    ) WITHOUT ROWID''')
+
+
+def _add_log_changes(conn):
+    # A count of row changes to log that, unlike PRAGMA data_version, is the same for every connection
+    # and survives restarts. Backups record it and skip the copy when it has not moved.
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('log_changes', 0)")
+    for event in ('insert', 'update', 'delete'):
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS log_changes_{event} AFTER {event.upper()} ON log BEGIN
+                             UPDATE meta SET value = value + 1 WHERE key = 'log_changes';
+                         END''')
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(backup_log)')]
+    if 'log_changes' not in columns:
+        conn.execute('ALTER TABLE backup_log ADD COLUMN log_changes INTEGER')
+
+
+def _current_state_ties(conn):
+    # An insert tying the newest stamp's time only takes over with a higher id, as CURRENT_STATE_REFRESH
+    # breaks ties; before, a row restored under its old id (undo) at that time did too
+    conn.execute('DROP TRIGGER IF EXISTS current_state_insert')
+    conn.execute('''CREATE TRIGGER current_state_insert AFTER INSERT ON log
+                    WHEN NOT EXISTS (SELECT 1 FROM current_state)
+                      OR EXISTS (SELECT 1 FROM current_state AS cur WHERE new.epoch_us > cur.epoch_us
+                                 OR (new.epoch_us = cur.epoch_us AND new.id > cur.entry_id)) BEGIN
+                        INSERT OR REPLACE INTO current_state (id, entry_id, timestamp, epoch_us, status, code, session_start)
+                        VALUES (1, new.id, new.timestamp, new.epoch_us, new.status, new.code,
+                                CASE WHEN new.status = 'in' THEN new.timestamp END);
+                    END''')
+    for statement in CURRENT_STATE_REFRESH:
+        conn.execute(statement)
+
+
+def _add_edit_journal_after(conn):
+    # Rows as a batch update left them, so undo can tell the ones edited since and leave those alone
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(edit_journal)')]
+    for column, sql_type in (('timestamp', 'TEXT'), ('status', 'TEXT'), ('code', 'TEXT'), ('comment', 'TEXT'),
+                             ('epoch_us', 'INTEGER')):
+        if f'after_{column}' not in columns:
+            conn.execute(f'ALTER TABLE edit_journal ADD COLUMN after_{column} {sql_type}')
+
+
+def log_changes(conn):
+    row = conn.execute("SELECT value FROM meta WHERE key = 'log_changes'").fetchone()
+    return int(row[0]) if row else None
+
+
+def has_comment_search(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'log_fts'").fetchone() is not None
+
+
+# Append only: position + 1 is the schema version stored in PRAGMA user_version
+MIGRATIONS = [
+    _create_base_tables,
+    _add_epoch_column,
+    _add_backup_hash_columns,
+    _add_daily_totals,
+    _add_comment_search,
+    _add_archives,
+    _add_current_state,
+    _add_edit_journal,
+    _add_log_changes,
+    _current_state_ties,
+    _add_edit_journal_after,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for target, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(conn)
+        conn.execute(f'PRAGMA user_version = {target}')
+        conn.commit()
+        print(f'database schema migrated to version {target}')
+    # Rows stamped by an older copy of the app after the upgrade still need an epoch
+    backfill_epoch(conn)
+    return version
@@ -0,0 +1,95 @@
+import csv
+import gzip
+import sqlite3
+import threading
+
+from stamp_query import connect_read_only, limit_connection
+from stamp_sql import execute, timed
+from stamp_tz import format_local
+
+EXPORT_BATCH_SIZE = 2000
+CSV_HEADER = ['ID', 'Timestamp', 'Status', 'Code', 'Comment']
+
+
+def format_rows(rows, time_zone):
+    with timed('export time zone'):
+        local_times = format_local([row[1] for row in rows], time_zone)
+    return [[row[0], local_time, row[2], row[3], row[4]] for row, local_time in zip(rows, local_times)]
+
+
+def export_csv(db_file, csv_path, query, params, time_zone, compress=False,
+               batch_size=EXPORT_BATCH_SIZE, progress=None, cancel_event=None, time_limit=None, archives=()):
+    # Streams the query to csv_path batch by batch so memory use does not grow with the row count.
+    # Returns the number of rows written, or None if cancelled. No file is left behind unless rows were written.
+    # The connection is read-only and cancel_event interrupts a statement that is still running.
+    opener = gzip.open if compress else open
+    written = 0
+    cancelled = False
+    conn = connect_read_only(db_file, archives)
+    reason = limit_connection(conn, cancel_event, time_limit)
+    try:
+        with timed('export'), opener(csv_path, 'wt', newline='') as csvfile:
+            csvwriter = csv.writer(csvfile)
+            csvwriter.writerow(CSV_HEADER)
+            cursor = execute(conn, query, params)
+            while True:
+                if cancel_event is not None and cancel_event.is_set():
+                    cancelled = True
+                    break
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                csvwriter.writerows(format_rows(rows, time_zone))
+                written += len(rows)
+                if progress is not None:
+                    progress(written)
+    except sqlite3.OperationalError as e:
+        csv_path.unlink(missing_ok=True)
+        stopped = reason()
+        if stopped is None:
+            raise
+        if stopped != 'cancelled':
+            raise TimeoutError(f"Export {stopped}") from e
+        cancelled = True
+    except BaseException:
+        csv_path.unlink(missing_ok=True)
+        raise
+    finally:
+        conn.close()
+
+    if cancelled or written == 0:
+        csv_path.unlink(missing_ok=True)
+    return None if cancelled else written
+
+
+class ExportJob(threading.Thread):
+    # Runs export_csv on its own connection; the UI polls rows_written and reads result/error when done
+    def __init__(self, db_file, csv_path, query, params, time_zone, compress=False, time_limit=None, archives=()):
+        super().__init__(daemon=True)
+        self.db_file = db_file
+        self.csv_path = csv_path
+        self.query = query
+        self.params = params
+        self.time_zone = time_zone
+        self.compress = compress
+        self.time_limit = time_limit
+        self.archives = archives
+        self.cancel_event = threading.Event()
+        self.rows_written = 0
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = export_csv(self.db_file, self.csv_path, self.query, self.params, self.time_zone,
+                                     compress=self.compress, progress=self.on_progress,
+                                     cancel_event=self.cancel_event, time_limit=self.time_limit,
+                                     archives=self.archives)
+        except Exception as e:
+            self.error = e
+
+    def on_progress(self, rows_written):
+        self.rows_written = rows_written
+
+    def cancel(self):
+        self.cancel_event.set()
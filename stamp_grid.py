@@ -0,0 +1,291 @@
+import tkinter as tk
+from tkinter import font as tkfont, ttk
+from datetime import datetime
+
+from stamp_db import LOG_COLUMNS
+from stamp_sql import fetchall, timed
+
+GRID_COLUMNS = ['ID', 'Timestamp', 'Status', 'Code', 'Comment']
+GRID_WIDTHS = {'ID': 80, 'Timestamp': 220, 'Status': 80, 'Code': 160, 'Comment': 500}
+# Width of the columns of a query that does not return log rows
+QUERY_COLUMN_WIDTH = 160
+VISIBLE_ROWS = 20
+FETCH_SIZE = 200
+QUERY_POLL_MS = 50
+# Sort expressions per column; comment is coalesced so keyset comparisons never see NULL
+LOG_SORT_KEYS = {'ID': 'id', 'Timestamp': 'epoch_us', 'Status': 'status', 'Code': 'code',
+                 'Comment': "COALESCE(comment, '')"}
+
+
+def count_sql(source, conditions=''):
+    return f"SELECT COUNT(*) FROM {source} {conditions}"
+
+
+def page_sql(source, conditions, sort_key, order):
+    return (f"SELECT {LOG_COLUMNS}, {sort_key} FROM {source} {conditions} "
+            f"ORDER BY {sort_key} {order}, id {order} LIMIT ? OFFSET ?")
+
+
+class ResultGrid(tk.Frame):
+    # Treeview over a row source that only ever holds a few pages of rows in memory.
+    # Scrolling steps are keyset-paginated on (sort key, id); scrollbar jumps fall back to OFFSET.
+    def __init__(self, parent, conn, source, where=None, params=(), sort_keys=LOG_SORT_KEYS, header_text='',
+                 font=('Courier', 12), height=VISIBLE_ROWS, fetch_size=FETCH_SIZE, cache=None):
+        super().__init__(parent)
+        self.conn = conn
+        # Optional QueryCache so re-running the same filter or paging back is served from memory
+        self.cache = cache
+        self.source = source
+        self.where = where
+        self.params = tuple(params)
+        self.sort_keys = sort_keys
+        self.sort_column = 'Timestamp'
+        self.descending = False
+        self.header_text = header_text
+        self.height = height
+        self.fetch_size = fetch_size
+        self.total = 0
+        self.offset = 0
+        self.buffer = []
+        self.buffer_start = 0
+
+        style = ttk.Style(self)
+        style.configure('Grid.Treeview', font=font, rowheight=tkfont.Font(font=font).metrics('linespace') + 4)
+        style.configure('Grid.Treeview.Heading', font=font)
+
+        self.summary_label = tk.Label(self, font=font, anchor='w')
+        self.summary_label.grid(row=0, column=0, columnspan=2, sticky='ew')
+        self.tree = ttk.Treeview(self, columns=GRID_COLUMNS, show='headings', height=height,
+                                 selectmode='browse', style='Grid.Treeview')
+        for column in GRID_COLUMNS:
+            self.tree.heading(column, text=column, command=lambda c=column: self.sort_by(c))
+            self.tree.column(column, width=GRID_WIDTHS[column], stretch=column == 'Comment')
+        self.tree.grid(row=1, column=0, sticky='nsew')
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.on_scrollbar)
+        self.scrollbar.grid(row=1, column=1, sticky='ns')
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(1, weight=1)
+
+        self.tree.bind('<MouseWheel>', lambda e: self.scroll_to(self.offset - 3 * (1 if e.delta > 0 else -1)))
+        self.tree.bind('<Button-4>', lambda e: self.scroll_to(self.offset - 3))
+        self.tree.bind('<Button-5>', lambda e: self.scroll_to(self.offset + 3))
+        self.tree.bind('<Prior>', lambda e: self.scroll_to(self.offset - self.height))
+        self.tree.bind('<Next>', lambda e: self.scroll_to(self.offset + self.height))
+
+        self.refresh()
+
+    def _query(self, query, params):
+        if self.cache is not None:
+            return self.cache.fetchall(query, params)
+        return fetchall(self.conn, query, params)
+
+    def _conditions(self, extra=None):
+        conditions = [c for c in (self.where, extra) if c]
+        return f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    def _fetch(self, extra=None, extra_params=(), descending=False, limit=FETCH_SIZE, offset=0):
+        sort_key = self.sort_keys[self.sort_column]
+        order = 'DESC' if descending else 'ASC'
+        return self._query(page_sql(self.source, self._conditions(extra), sort_key, order),
+                           self.params + tuple(extra_params) + (limit, offset))
+
+    def _fetch_after(self, row, limit):
+        sort_key = self.sort_keys[self.sort_column]
+        op = '<' if self.descending else '>'
+        return self._fetch(f"({sort_key}, id) {op} (?, ?)", (row[-1], row[0]), self.descending, limit)
+
+    def _fetch_before(self, row, limit):
+        sort_key = self.sort_keys[self.sort_column]
+        op = '>' if self.descending else '<'
+        rows = self._fetch(f"({sort_key}, id) {op} (?, ?)", (row[-1], row[0]), not self.descending, limit)
+        rows.reverse()
+        return rows
+
+    def refresh(self):
+        self.total = self._query(count_sql(self.source, self._conditions()), self.params)[0][0]
+        self.buffer = []
+        self.buffer_start = 0
+        if self.total:
+            self.summary_label.config(text=f"{self.header_text}{self.total} rows")
+        else:
+            self.summary_label.config(text="No entries found for the specified filter.")
+        self.scroll_to(0)
+
+    def sort_by(self, column):
+        if column == self.sort_column:
+            self.descending = not self.descending
+        else:
+            self.sort_column, self.descending = column, False
+        for name in GRID_COLUMNS:
+            arrow = (' ▼' if self.descending else ' ▲') if name == column else ''
+            self.tree.heading(name, text=name + arrow)
+        self.buffer = []
+        self.buffer_start = 0
+        self.scroll_to(0)
+
+    def _ensure(self, start, end):
+        buffer_end = self.buffer_start + len(self.buffer)
+        if self.buffer and self.buffer_start <= start and end <= buffer_end:
+            return
+        if self.buffer and self.buffer_start <= start <= buffer_end < end:
+            self.buffer += self._fetch_after(self.buffer[-1], end - buffer_end + self.fetch_size)
+        elif self.buffer and self.buffer_start <= end <= buffer_end and start < self.buffer_start:
+            rows = self._fetch_before(self.buffer[0], self.buffer_start - start + self.fetch_size)
+            self.buffer = rows + self.buffer
+            self.buffer_start -= len(rows)
+        else:
+            self.buffer_start = max(0, start - self.fetch_size // 2)
+            self.buffer = self._fetch(descending=self.descending, limit=end - self.buffer_start + self.fetch_size,
+                                      offset=self.buffer_start)
+
+        # Keep the window bounded: drop whichever side is furthest from the viewport
+        limit = 3 * self.fetch_size + self.height
+        if len(self.buffer) > limit:
+            if start - self.buffer_start > self.buffer_start + len(self.buffer) - end:
+                drop = len(self.buffer) - limit
+                self.buffer = self.buffer[drop:]
+                self.buffer_start += drop
+            else:
+                self.buffer = self.buffer[:limit]
+
+    def scroll_to(self, offset):
+        self.offset = max(0, min(offset, self.total - self.height))
+        end = min(self.offset + self.height, self.total)
+        if self.total:
+            self._ensure(self.offset, end)
+        visible = self.buffer[self.offset - self.buffer_start:end - self.buffer_start] if self.total else []
+
+        with timed('grid render'):
+            self.tree.delete(*self.tree.get_children())
+            for row in visible:
+                self.tree.insert('', tk.END, values=(row[0], self.format_timestamp(row[1]), row[2], row[3], row[4] or ''))
+        if self.total:
+            self.scrollbar.set(self.offset / self.total, end / self.total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def on_scrollbar(self, action, value, unit=None):
+        if action == 'moveto':
+            self.scroll_to(int(float(value) * self.total))
+        elif action == 'scroll':
+            self.scroll_to(self.offset + int(value) * (self.height if unit == 'pages' else 1))
+
+    @staticmethod
+    def format_timestamp(timestamp):
+        try:
+            return datetime.fromisoformat(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+        except (TypeError, ValueError):
+            return timestamp
+
+
+class QueryGrid(tk.Frame):
+    # Rows of an ad-hoc query, shown as its QueryJob streams them in. Cancel (or closing the window)
+    # interrupts the statement; headings sort whatever has arrived in memory. Results starting with the
+    # log columns are shown as log rows; anything else (aggregates, joins) with the query's own columns.
+    def __init__(self, parent, job, header_text='', font=('Courier', 12), height=VISIBLE_ROWS):
+        super().__init__(parent)
+        self.job = job
+        self.header_text = header_text
+        self.rows = []
+        self.headings = GRID_COLUMNS
+        self.log_rows = None
+        self.sort_column = None
+        self.descending = False
+
+        style = ttk.Style(self)
+        style.configure('Grid.Treeview', font=font, rowheight=tkfont.Font(font=font).metrics('linespace') + 4)
+        style.configure('Grid.Treeview.Heading', font=font)
+
+        self.summary_label = tk.Label(self, font=font, anchor='w')
+        self.summary_label.grid(row=0, column=0, sticky='ew')
+        self.cancel_button = tk.Button(self, text="Cancel", bg='red', font=font, command=self.job.cancel)
+        self.cancel_button.grid(row=0, column=1, sticky='e')
+        self.tree = ttk.Treeview(self, columns=GRID_COLUMNS, show='headings', height=height,
+                                 selectmode='browse', style='Grid.Treeview')
+        for column in GRID_COLUMNS:
+            self.tree.heading(column, text=column, command=lambda c=column: self.sort_by(c))
+            self.tree.column(column, width=GRID_WIDTHS[column], stretch=column == 'Comment')
+        self.tree.grid(row=1, column=0, columnspan=2, sticky='nsew')
+        scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.tree.yview)
+        scrollbar.grid(row=1, column=2, sticky='ns')
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(1, weight=1)
+        self.bind('<Destroy>', lambda e: self.job.cancel() if e.widget is self else None)
+
+        self.job.start()
+        self.poll()
+
+    def poll(self):
+        # Checked before draining so the last batches are never left in the queue
+        running = self.job.is_alive()
+        rows = self.job.drain()
+        if self.log_rows is None and self.job.columns is not None:
+            self.use_columns(self.job.columns)
+        if rows:
+            self.rows += rows
+            with timed('grid render'):
+                if self.sort_column is None:
+                    self.insert(rows)
+                else:
+                    self.sort_by(self.sort_column, toggle=False)
+        if running:
+            self.summary_label.config(text=f"{self.header_text}running... {len(self.rows)} rows")
+            self.after(QUERY_POLL_MS, self.poll)
+            return
+
+        self.cancel_button.config(state=tk.DISABLED)
+        if self.job.error is not None:
+            self.summary_label.config(text=f"Error: {self.job.error}", fg='red')
+        elif self.job.stopped is not None:
+            self.summary_label.config(text=f"{self.header_text}{self.job.stopped} after {len(self.rows)} rows", fg='red')
+        elif self.job.truncated:
+            self.summary_label.config(text=f"{self.header_text}first {len(self.rows)} rows (row cap reached)")
+        elif self.rows:
+            self.summary_label.config(text=f"{self.header_text}{len(self.rows)} rows")
+        else:
+            self.summary_label.config(text="No entries found for the specified filter.")
+
+    def use_columns(self, names):
+        self.log_rows = [name.lower() for name in names[:len(GRID_COLUMNS)]] == [name.lower() for name in GRID_COLUMNS]
+        if self.log_rows:
+            return
+        self.sort_column = None
+        # Names can repeat (SELECT 1, 1), so columns are addressed by position
+        self.headings = list(names)
+        columns = [f"c{i}" for i in range(len(names))]
+        self.tree.configure(columns=columns)
+        for column, name in zip(columns, names):
+            self.tree.heading(column, text=name, command=lambda c=column: self.sort_by(c))
+            self.tree.column(column, width=QUERY_COLUMN_WIDTH, stretch=True)
+
+    def column_index(self, column):
+        return GRID_COLUMNS.index(column) if self.log_rows is not False else int(column[1:])
+
+    def insert(self, rows):
+        for row in rows:
+            if self.log_rows is False:
+                values = ['' if value is None else value for value in row]
+            else:
+                values = (row[0], ResultGrid.format_timestamp(row[1]), row[2], row[3], row[4] or '')
+            self.tree.insert('', tk.END, values=values)
+
+    def sort_by(self, column, toggle=True):
+        if toggle:
+            if column == self.sort_column:
+                self.descending = not self.descending
+            else:
+                self.sort_column, self.descending = column, False
+        i = self.column_index(column)
+        for j, (name, heading) in enumerate(zip(self.tree['columns'], self.headings)):
+            arrow = (' ▼' if self.descending else ' ▲') if j == i else ''
+            self.tree.heading(name, text=heading + arrow)
+        if self.log_rows is False:
+            # Numbers before text, each in its own order
+            key = lambda row: (row[i] is None, not isinstance(row[i], (int, float)),
+                               row[i] if isinstance(row[i], (int, float)) else str(row[i]))
+        else:
+            key = lambda row: (row[i] is None, row[i] if i == 0 else str(row[i]))
+        self.rows.sort(key=key, reverse=self.descending)
+        self.tree.delete(*self.tree.get_children())
+        self.insert(self.rows)
@@ -0,0 +1,159 @@
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from stamp_db import CURRENT_STATE_REFRESH, create_indexes, drop_indexes, drop_triggers, has_comment_search
+from stamp_sql import execute, executemany, fetchone
+
+IMPORT_CHUNK_SIZE = 100_000
+REBUILD_INDEX_THRESHOLD = 100_000
+# dump_to_csv headers -> log columns; JSONL uses the log column names directly
+CSV_COLUMNS = {'Timestamp': 'timestamp', 'Status': 'status', 'Code': 'code', 'Comment': 'comment'}
+STATUSES = ('in', 'out')
+
+
+def text(values):
+    # Stripped str array; numpy's string ufuncs do per row in C what .str methods do in Python
+    return np.strings.strip(values.to_numpy(dtype=str))
+
+
+def has_offset(values):
+    # ISO 8601 text ending in Z or in a +hh:mm / +hhmm offset after the date
+    sign = np.maximum(np.strings.rfind(values, '+'), np.strings.rfind(values, '-'))
+    return np.strings.endswith(values, 'Z') | ((sign >= 10) & np.isin(np.strings.str_len(values) - sign, (5, 6)))
+
+
+def to_epoch_us(values, time_zone):
+    # values are stripped text. Timestamps with an offset are used as is; naive ones are local time in
+    # time_zone. Ambiguous local times resolve to standard time and nonexistent ones shift forward, like
+    # pytz's default. Each kind is parsed in one pd.to_datetime call, so a file with only one kind takes one.
+    # Returns the epoch values and a mask of the ones that parsed.
+    offset = has_offset(values)
+    epoch_us = np.zeros(len(values), np.int64)
+    parsed = np.zeros(len(values), bool)
+    if offset.any():
+        aware = pd.to_datetime(pd.Series(values[offset]), format='ISO8601', utc=True, errors='coerce')
+        epoch_us[offset], parsed[offset] = _utc_epoch_us(aware)
+    if not offset.all():
+        naive = pd.to_datetime(pd.Series(values[~offset]), format='ISO8601', errors='coerce')
+        local = naive.dt.tz_localize(time_zone, ambiguous=np.zeros(len(naive), bool), nonexistent='shift_forward')
+        epoch_us[~offset], parsed[~offset] = _utc_epoch_us(local)
+    return epoch_us, parsed
+
+
+def resolution_us(values):
+    # Microseconds one step of each stripped timestamp text stands for: 1 with a fraction of a second,
+    # otherwise a second (or a minute without seconds). Stamps are saved with microseconds but exported to
+    # the second. An hh:mm offset has a colon of its own.
+    colons = np.strings.count(values, ':') - (has_offset(values) & (np.strings.find(values, ':', -3) >= 0))
+    fraction = (np.strings.find(values, '.') >= 0) | (np.strings.find(values, ',') >= 0)
+    return np.where(fraction, 1, np.where(colons >= 2, 1_000_000, 60_000_000))
+
+
+def _utc_epoch_us(series):
+    moments = series.dt.tz_convert(None).to_numpy()
+    return moments.astype('datetime64[us]').astype(np.int64), ~np.isnat(moments)
+
+
+def to_iso_utc(epoch_us):
+    # Same text as datetime.isoformat() on a UTC datetime: microseconds only when non-zero
+    moments = epoch_us.astype('datetime64[us]')
+    text = np.where(epoch_us % 1_000_000 == 0,
+                    np.datetime_as_string(moments, unit='s'), np.datetime_as_string(moments, unit='us'))
+    return np.char.add(text, '+00:00')
+
+
+def read_chunks(path, file_format=None):
+    path = Path(path)
+    file_format = file_format or ('jsonl' if path.suffix in ('.jsonl', '.json') or path.name.endswith('.jsonl.gz') else 'csv')
+    if file_format == 'jsonl':
+        for chunk in pd.read_json(path, lines=True, chunksize=IMPORT_CHUNK_SIZE, dtype=False,
+                                  convert_dates=False, keep_default_dates=False):
+            yield chunk
+    elif file_format == 'csv':
+        for chunk in pd.read_csv(path, chunksize=IMPORT_CHUNK_SIZE, dtype=str, keep_default_na=False):
+            yield chunk.rename(columns=CSV_COLUMNS)
+    else:
+        raise ValueError(f"Unknown import format: {file_format}")
+
+
+def import_file(conn, path, time_zone, daily_totals=None, file_format=None, rebuild_threshold=REBUILD_INDEX_THRESHOLD):
+    # Stages the whole file in a temp table, drops rows already in log on (epoch_us, status, code),
+    # and inserts the rest in one transaction. Times are compared at the precision of the file, so a
+    # stamp exported to the second matches the one saved with microseconds. Returns counts of read,
+    # invalid, duplicate and imported rows.
+    started = time.perf_counter()
+    stats = {'read': 0, 'invalid': 0, 'duplicates': 0, 'imported': 0}
+    execute(conn, 'DROP TABLE IF EXISTS temp.import_staging')
+    # The key keeps the first of the rows a file repeats
+    execute(conn, 'CREATE TEMP TABLE import_staging (timestamp TEXT, status TEXT, code TEXT, comment TEXT, epoch_us INTEGER, '
+            'resolution_us INTEGER, UNIQUE (epoch_us, status, code) ON CONFLICT IGNORE)')
+    try:
+        valid_rows = 0
+        for chunk in read_chunks(path, file_format):
+            stats['read'] += len(chunk)
+            missing = {'timestamp', 'status', 'code'} - set(chunk.columns)
+            if missing:
+                raise ValueError(f"Missing columns in {path}: {', '.join(sorted(missing))}")
+            timestamps, status, code = text(chunk['timestamp']), np.strings.lower(text(chunk['status'])), text(chunk['code'])
+            comment = chunk['comment'].fillna('').astype(str).to_numpy() if 'comment' in chunk else np.full(len(chunk), '')
+            epoch_us, parsed = to_epoch_us(timestamps, time_zone)
+            valid = np.isin(status, STATUSES) & (code != '') & parsed
+            stats['invalid'] += int((~valid).sum())
+            if not valid.any():
+                continue
+            valid_rows += int(valid.sum())
+            executemany(conn, 'INSERT INTO import_staging (timestamp, status, code, comment, epoch_us, resolution_us) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        zip(to_iso_utc(epoch_us[valid]).tolist(), status[valid].tolist(), code[valid].tolist(),
+                            comment[valid].tolist(), epoch_us[valid].tolist(), resolution_us(timestamps[valid]).tolist()))
+        conn.commit()
+
+        staged = fetchone(conn, 'SELECT COUNT(*), MIN(epoch_us), MAX(epoch_us) FROM import_staging')
+        if not staged[0]:
+            stats['duplicates'] = valid_rows
+            return stats
+
+        execute(conn, 'BEGIN IMMEDIATE')
+        # Rows already stamped, at the precision of the file, unless the log has nothing in the file's range
+        if fetchone(conn, 'SELECT 1 FROM log WHERE epoch_us BETWEEN ? AND ? LIMIT 1', (staged[1], staged[2] + 60_000_000)):
+            execute(conn, 'DELETE FROM import_staging AS s WHERE EXISTS (SELECT 1 FROM log '
+                    'WHERE log.epoch_us BETWEEN s.epoch_us AND s.epoch_us + s.resolution_us - 1 '
+                    'AND log.status = s.status AND log.code = s.code)')
+        to_import = fetchone(conn, 'SELECT COUNT(*) FROM import_staging')[0]
+        stats['duplicates'] = valid_rows - to_import
+
+        last_id = fetchone(conn, 'SELECT COALESCE(MAX(id), 0) FROM log')[0]
+        # The triggers on log would update the search index, current_state and log_changes row by row;
+        # they are suspended for the insert and their work is done once for all new rows below
+        trigger_sql = drop_triggers(conn, 'log')
+        index_sql = drop_indexes(conn, 'log') if to_import >= rebuild_threshold else []
+        execute(conn, 'INSERT INTO log (timestamp, status, code, comment, epoch_us) '
+                'SELECT timestamp, status, code, comment, epoch_us FROM import_staging ORDER BY epoch_us')
+        create_indexes(conn, index_sql)
+        create_indexes(conn, trigger_sql)
+        if to_import:
+            # Indexing the new rows, or all of them when the import outweighs what the log held before
+            if has_comment_search(conn) and to_import >= last_id:
+                execute(conn, "INSERT INTO log_fts (log_fts) VALUES ('rebuild')")
+            elif has_comment_search(conn):
+                execute(conn, 'INSERT INTO log_fts (rowid, comment, code) SELECT id, comment, code FROM log WHERE id > ?',
+                        (last_id,))
+            for statement in CURRENT_STATE_REFRESH:
+                execute(conn, statement)
+            execute(conn, "UPDATE meta SET value = value + ? WHERE key = 'log_changes'", (to_import,))
+        if daily_totals is not None and to_import:
+            daily_totals.refresh(conn, daily_totals.neighbours(conn, staged[1]))
+            daily_totals.recompute(conn, staged[1], staged[2])
+        conn.commit()
+        stats['imported'] = to_import
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        execute(conn, 'DROP TABLE IF EXISTS temp.import_staging')
+        stats['seconds'] = time.perf_counter() - started
+    return stats
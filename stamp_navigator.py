@@ -0,0 +1,113 @@
+import bisect
+import threading
+
+import stamp_db
+from stamp_db import LOG_COLUMNS
+from stamp_sql import fetchall
+
+NEIGHBOUR_RADIUS = 200
+REFILL_MARGIN = 50
+
+
+def fetch_window(conn, center_id, radius):
+    # Up to radius rows before center_id and radius + 1 from it on, in one range query.
+    # Also returns whether the window reaches the first and the last row of the log.
+    rows = fetchall(conn, f"SELECT * FROM (SELECT {LOG_COLUMNS} FROM log WHERE id < ? ORDER BY id DESC LIMIT ?) "
+                          f"UNION ALL SELECT * FROM (SELECT {LOG_COLUMNS} FROM log WHERE id >= ? ORDER BY id LIMIT ?) "
+                          f"ORDER BY id", (center_id, radius, center_id, radius + 1))
+    before = bisect.bisect_left([row[0] for row in rows], center_id)
+    return rows, before < radius, len(rows) - before < radius + 1
+
+
+def read_window(db_file, center_id, radius):
+    # fetch_window on a read-only connection of its own, for the refill thread
+    conn = stamp_db.connect(db_file, read_only=True)
+    try:
+        return fetch_window(conn, center_id, radius)
+    finally:
+        conn.close()
+
+
+class EntryWindow:
+    # Full log rows around the entry shown in the Modify window so < and > step through memory.
+    # fetch(center_id, radius) gives what fetch_window does, from the app's connection or a stamp server.
+    # Coming within `margin` rows of an open edge re-centres the window on a background thread through
+    # refill_fetch (fetch by default); poll() from the Tk thread swaps the new rows in. Rows are tied to
+    # data_version() and reloaded after any write.
+    def __init__(self, fetch, data_version, radius=NEIGHBOUR_RADIUS, margin=REFILL_MARGIN, refill_fetch=None):
+        self.fetch = fetch
+        self.refill_fetch = refill_fetch or fetch
+        self.data_version = data_version
+        self.radius = radius
+        self.margin = margin
+        self.rows = []
+        self.ids = []
+        self.at_start = False
+        self.at_end = False
+        self.version = None
+        self.job = None
+
+    def _set(self, window, version):
+        self.rows, self.at_start, self.at_end = window
+        self.ids = [row[0] for row in self.rows]
+        self.version = version
+
+    def _covers(self, entry_id):
+        return bool(self.rows) and (self.at_start or entry_id >= self.ids[0]) and (self.at_end or entry_id <= self.ids[-1])
+
+    def _load(self, entry_id):
+        version = self.data_version()
+        if version != self.version or not self._covers(entry_id):
+            self._set(self.fetch(entry_id, self.radius), version)
+
+    def get(self, entry_id):
+        self._load(entry_id)
+        i = bisect.bisect_left(self.ids, entry_id)
+        return self.rows[i] if i < len(self.ids) and self.ids[i] == entry_id else None
+
+    def adjacent_id(self, entry_id, step):
+        # Nearest id before (step < 0) or after (step > 0) entry_id, which need not exist any more
+        self._load(entry_id)
+        if step < 0:
+            i = bisect.bisect_left(self.ids, entry_id) - 1
+        else:
+            i = bisect.bisect_right(self.ids, entry_id)
+        if 0 <= i < len(self.ids):
+            return self.ids[i]
+        if self.at_start if step < 0 else self.at_end:
+            return None
+        # Stepped past an edge the refill has not caught up with yet
+        self._set(self.fetch(entry_id, self.radius), self.data_version())
+        return self.adjacent_id(entry_id, step)
+
+    def near_edge(self, entry_id):
+        i = bisect.bisect_left(self.ids, entry_id)
+        return (not self.at_start and i < self.margin) or (not self.at_end and len(self.ids) - i <= self.margin)
+
+    def refill_async(self, entry_id):
+        # Returns True if a refill was started; poll() until it returns False
+        if self.job is not None:
+            return False
+        result = {}
+
+        def run():
+            try:
+                result['window'] = self.refill_fetch(entry_id, self.radius)
+            except Exception as e:
+                result['error'] = e
+
+        self.job = threading.Thread(target=run, daemon=True), result, self.data_version()
+        self.job[0].start()
+        return True
+
+    def poll(self):
+        if self.job is None:
+            return False
+        thread, result, version = self.job
+        if thread.is_alive():
+            return True
+        self.job = None
+        # A write since the refill started makes it stale; the next step reloads instead
+        if 'window' in result and version == self.version:
+            self._set(result['window'], version)
+        return False
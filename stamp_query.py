@@ -0,0 +1,115 @@
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+import stamp_db
+from stamp_sql import execute
+
+QUERY_TIME_LIMIT = 30
+QUERY_ROW_CAP = 10_000
+QUERY_BATCH_SIZE = 500
+# SQLite virtual machine steps between deadline and cancel checks
+PROGRESS_STEPS = 10_000
+
+
+def connect_read_only(db_file, archives=()):
+    # Ad-hoc SQL cannot write through this connection, whatever the user types.
+    # archives are (alias, path) pairs from stamp_archive.overlapping, attached read-only as well.
+    from stamp_archive import attach_archives
+
+    conn = stamp_db.connect(db_file, read_only=True)
+    try:
+        attach_archives(conn, archives)
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+
+def typed_query(query_str):
+    # SQL as typed into the Filter by SQL box; sqlite3 reads trailing semicolons as a second statement
+    return re.sub(r'[\s;]+$', '', query_str).strip()
+
+
+def limit_connection(conn, cancel_event=None, time_limit=None, steps=PROGRESS_STEPS):
+    # Interrupts the running statement once cancel_event is set or time_limit seconds have passed.
+    # Returns a function telling which of the two stopped it, for the OperationalError that follows.
+    deadline = time.monotonic() + time_limit if time_limit else None
+
+    def reason():
+        if cancel_event is not None and cancel_event.is_set():
+            return 'cancelled'
+        if deadline is not None and time.monotonic() > deadline:
+            return f"stopped after the {time_limit:g}s time limit"
+        return None
+
+    conn.set_progress_handler(lambda: reason() is not None, steps)
+    return reason
+
+
+class QueryJob(threading.Thread):
+    # Runs one ad-hoc query on a read-only connection and hands rows to the Tk thread in batches
+    # through `batches`. Stops at row_cap rows, after time_limit seconds, or on cancel().
+    def __init__(self, db_file, query, params=(), time_limit=QUERY_TIME_LIMIT, row_cap=QUERY_ROW_CAP,
+                 batch_size=QUERY_BATCH_SIZE, archives=()):
+        super().__init__(daemon=True)
+        self.db_file = db_file
+        self.archives = archives
+        self.query = query
+        self.params = params
+        self.time_limit = time_limit
+        self.row_cap = row_cap
+        self.batch_size = batch_size
+        self.batches = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.conn = None
+        # Column names of the result, set before the first batch
+        self.columns = None
+        self.rows_read = 0
+        self.truncated = False
+        self.stopped = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.conn = connect_read_only(self.db_file, self.archives)
+            reason = limit_connection(self.conn, self.cancel_event, self.time_limit)
+            try:
+                cursor = execute(self.conn, self.query, self.params)
+                self.columns = [column[0] for column in cursor.description or ()]
+                while self.rows_read < self.row_cap:
+                    rows = cursor.fetchmany(min(self.batch_size, self.row_cap - self.rows_read))
+                    if not rows:
+                        break
+                    self.rows_read += len(rows)
+                    self.batches.put(rows)
+                else:
+                    self.truncated = cursor.fetchone() is not None
+            except sqlite3.OperationalError:
+                self.stopped = reason()
+                if self.stopped is None:
+                    raise
+            finally:
+                self.conn.close()
+        except Exception as e:
+            self.error = e
+
+    def cancel(self):
+        self.cancel_event.set()
+        conn = self.conn
+        if conn is not None:
+            try:
+                conn.interrupt()
+            except sqlite3.ProgrammingError:
+                # Already closed
+                pass
+
+    def drain(self):
+        rows = []
+        while True:
+            try:
+                rows += self.batches.get_nowait()
+            except queue.Empty:
+                return rows
@@ -0,0 +1,105 @@
+from datetime import time
+
+import numpy as np
+import pandas as pd
+
+from stamp_sql import fetchall, fetchone, timed
+
+PERIODS = {'day': 'D', 'week': 'W', 'month': 'M', 'total': None}
+US_PER_SECOND = 1_000_000
+NS_PER_SECOND = 1_000_000_000
+
+
+def load_events(conn, from_us, to_us, source='log'):
+    # The event just before from_us is included so a session already open at from_us is counted.
+    # Every column comes back as one delimited string that numpy parses, so no Python object is made per
+    # event. Rows are read in index order (epoch_us, status) and put in (epoch_us, id) order here.
+    epoch_text, id_text, in_text, code_text = fetchone(
+        conn, "SELECT group_concat(epoch_us), group_concat(id), group_concat(status = 'in', ''), "
+              f"group_concat(code, char(31)) FROM (SELECT epoch_us, id, status, code FROM {source} "
+              f"WHERE epoch_us BETWEEN COALESCE((SELECT MAX(epoch_us) FROM {source} WHERE epoch_us < ?), ?) AND ? "
+              "ORDER BY epoch_us)", (from_us, from_us, to_us))
+    if epoch_text is None:
+        return np.empty(0, np.int64), np.empty(0, bool), np.empty(0, np.intp), np.empty(0, object)
+    epoch_us = np.fromstring(epoch_text, np.int64, sep=',')
+    is_in = np.frombuffer(in_text.encode('ascii'), np.uint8) == ord('1')
+    code_idx, code_names = pd.factorize(np.array(code_text.split('\x1f'), dtype=object))
+    if not (np.diff(epoch_us) > 0).all():
+        order = np.lexsort((np.fromstring(id_text, np.int64, sep=','), epoch_us))
+        epoch_us, is_in, code_idx = epoch_us[order], is_in[order], code_idx[order]
+    return epoch_us, is_in, code_idx, np.asarray(code_names, dtype=object)
+
+
+def pair_sessions(epoch_us, is_in, code_idx):
+    # An 'in' directly followed by an 'out' is a session carrying the 'in' code; anything else is unpaired
+    paired = is_in[:-1] & ~is_in[1:]
+    return epoch_us[:-1][paired], epoch_us[1:][paired], code_idx[:-1][paired]
+
+
+def _local_ns(epoch_us, time_zone):
+    return pd.to_datetime(epoch_us, unit='us', utc=True).tz_convert(time_zone).tz_localize(None)
+
+
+def lunch_overlap_seconds(start_local, end_local, lunch_start, lunch_stop):
+    # Overlap of each session with the lunch window on the day the session starts. asi8 is in the unit of
+    # the index, which pandas may pick, so both are converted to nanoseconds first.
+    start_local, end_local = start_local.as_unit('ns'), end_local.as_unit('ns')
+    day_ns = start_local.normalize().asi8
+    lunch_from = day_ns + (lunch_start.hour * 3600 + lunch_start.minute * 60) * NS_PER_SECOND
+    lunch_to = day_ns + (lunch_stop.hour * 3600 + lunch_stop.minute * 60) * NS_PER_SECOND
+    overlap = np.minimum(end_local.asi8, lunch_to) - np.maximum(start_local.asi8, lunch_from)
+    return np.clip(overlap, 0, None) / NS_PER_SECOND
+
+
+def time_report(conn, from_us, to_us, time_zone, period='day', lunch_start=time(10, 30), lunch_stop=time(13, 0),
+                subtract_lunch=True, source='log'):
+    # Worked time per period and code as a DataFrame with columns period, code, seconds, hours, sessions.
+    # source is the log or its union with archives (StampCore.log_source).
+    if period not in PERIODS:
+        raise ValueError(f"Unknown report period: {period}")
+    epoch_us, is_in, code_idx, code_names = load_events(conn, from_us, to_us, source)
+    start_us, end_us, session_codes = pair_sessions(epoch_us, is_in, code_idx)
+    start_us = np.maximum(start_us, from_us)
+    end_us = np.minimum(end_us, to_us)
+    keep = end_us > start_us
+    start_us, end_us, session_codes = start_us[keep], end_us[keep], session_codes[keep]
+
+    with timed('report time zone'):
+        start_local = _local_ns(start_us, time_zone)
+        seconds = (end_us - start_us) / US_PER_SECOND
+        if subtract_lunch:
+            seconds -= lunch_overlap_seconds(start_local, _local_ns(end_us, time_zone), lunch_start, lunch_stop)
+
+    frequency = PERIODS[period]
+    frame = pd.DataFrame({
+        'period': start_local.to_period(frequency) if frequency else np.full(len(seconds), 'total'),
+        'code': code_names[session_codes],
+        'seconds': seconds,
+    })
+    result = frame.groupby(['period', 'code'], sort=True).agg(seconds=('seconds', 'sum'),
+                                                              sessions=('seconds', 'size')).reset_index()
+    result['period'] = result['period'].astype(str)
+    result.insert(3, 'hours', result['seconds'] / 3600)
+    return result
+
+
+def daily_time_report(conn, from_day, to_day, period='day', subtract_lunch=True):
+    # Same shape as time_report for whole local days, read from daily_totals in O(days)
+    if period not in PERIODS:
+        raise ValueError(f"Unknown report period: {period}")
+    worked = 'seconds - lunch_seconds' if subtract_lunch else 'seconds'
+    rows = fetchall(conn, f"SELECT day, code, {worked}, sessions FROM daily_totals "
+                          "WHERE day BETWEEN ? AND ? AND sessions > 0 ORDER BY day, code",
+                          (from_day.isoformat(), to_day.isoformat()))
+    frame = pd.DataFrame(rows, columns=['period', 'code', 'seconds', 'sessions'])
+
+    frequency = PERIODS[period]
+    if frequency:
+        frame['period'] = pd.to_datetime(frame['period']).dt.to_period(frequency)
+    else:
+        frame['period'] = 'total'
+    result = frame.groupby(['period', 'code'], sort=True).agg(seconds=('seconds', 'sum'),
+                                                              sessions=('sessions', 'sum')).reset_index()
+    result['period'] = result['period'].astype(str)
+    result.insert(3, 'hours', result['seconds'] / 3600)
+    return result
@@ -0,0 +1,451 @@
+import argparse
+import http.client
+import json
+import os
+import queue
+import select
+import socket
+import socketserver
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import stamp_db
+from stamp_archive import Archives
+from stamp_db import LOG_COLUMNS
+from stamp_navigator import NEIGHBOUR_RADIUS, EntryWindow, fetch_window
+from stamp_sql import fetchall, fetchone
+from stamp_writer import DatabaseWriter
+
+DEFAULT_SERVER_URL = 'http://127.0.0.1:8765'
+READ_POOL_SIZE = 4
+# The writer takes whatever requests are queued when it starts a transaction; concurrent stamps
+# pile up while one group commits, so there is nothing to gain from waiting for more
+SERVER_GROUP_WINDOW = 0
+WRITE_TIMEOUT = 30
+CLIENT_TIMEOUT = 10
+LOG_FIELDS = ['id', 'timestamp', 'status', 'code', 'comment']
+# Only these are sent again after the connection drops; a POST may already have been committed
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+
+
+class ReadPool:
+    # Read-only connections shared by the request threads, each with its own view of the archives
+    def __init__(self, db_file, size=READ_POOL_SIZE):
+        self.connections = queue.Queue()
+        for _ in range(size):
+            conn = stamp_db.connect(db_file, read_only=True, check_same_thread=False)
+            self.connections.put((conn, Archives(conn)))
+
+    @contextmanager
+    def connection(self):
+        item = self.connections.get()
+        try:
+            yield item
+        finally:
+            self.connections.put(item)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get_nowait()[0].close()
+
+
+class StampService:
+    # What the server does, independent of HTTP: writes go to one DatabaseWriter that group-commits
+    # whatever is queued, reads are served from the pool
+    def __init__(self, core, readers=READ_POOL_SIZE, group_window=SERVER_GROUP_WINDOW):
+        self.core = core
+        self.pool = ReadPool(core.DB_FILE, readers)
+        self.writer = DatabaseWriter(core.DB_FILE, group_window=group_window)
+        self.running = True
+        self.pump = threading.Thread(target=self._dispatch, daemon=True)
+        self.writer.start()
+        self.pump.start()
+
+    def _dispatch(self):
+        while self.running:
+            self.writer.dispatch(wait=0.1)
+
+    def write(self, write):
+        # Blocks the request thread until the writer has committed (or rejected) this write
+        done = threading.Event()
+        outcome = {}
+
+        def callback(result, error):
+            outcome['result'], outcome['error'] = result, error
+            done.set()
+
+        self.writer.submit(write, callback)
+        if not done.wait(WRITE_TIMEOUT):
+            raise TimeoutError("The write was not committed in time")
+        if outcome['error'] is not None:
+            raise outcome['error']
+        return outcome['result']
+
+    def status(self):
+        with self.pool.connection() as (conn, _):
+            row = fetchone(conn, 'SELECT entry_id, timestamp, status, code, session_start FROM current_state')
+        return dict(zip(['id', 'timestamp', 'status', 'code', 'session_start'], row)) if row else {}
+
+    def stamp(self, body):
+        timestamp = datetime.fromisoformat(body['timestamp']) if body.get('timestamp') else None
+        return {'id': self.write(self.core.stamp_write(body['status'], body.get('code'), body.get('comment'), timestamp))}
+
+    def update(self, entry_id, body):
+        timestamp = datetime.fromisoformat(body['timestamp'])
+        self.write(self.core.update_write(entry_id, timestamp, body['status'], body['code'], body.get('comment', '')))
+        return {'id': entry_id}
+
+    def delete(self, entry_id):
+        self.write(self.core.delete_write(entry_id))
+        return {'id': entry_id}
+
+    def entries(self, params):
+        # Stamps in a local date range, oldest first, archives included
+        from_us, to_us = self.core.epoch_range(params.get('from'), params.get('to'))
+        limit = int(params.get('limit', self.core.sql_row_cap))
+        with self.pool.connection() as (conn, archives):
+            rows = fetchall(conn, f"SELECT {LOG_COLUMNS} FROM {archives.source(from_us, to_us)} "
+                            "WHERE epoch_us BETWEEN ? AND ? ORDER BY epoch_us LIMIT ?",
+                            (from_us, to_us, limit))
+        return [dict(zip(LOG_FIELDS, row)) for row in rows]
+
+    def window(self, params):
+        # Log rows around an id for the Modify window, as stamp_navigator.fetch_window gives them
+        with self.pool.connection() as (conn, _):
+            rows, at_start, at_end = fetch_window(conn, int(params['id']), int(params.get('radius', NEIGHBOUR_RADIUS)))
+        return {'rows': rows, 'at_start': at_start, 'at_end': at_end}
+
+    def report(self, params):
+        from stamp_report import daily_time_report
+
+        from_day, to_day = self.core.day_range(params.get('from'), params.get('to'))
+        with self.pool.connection() as (conn, _):
+            result = daily_time_report(conn, from_day, to_day, params.get('period', 'day'))
+        return json.loads(result.to_json(orient='records'))
+
+    def close(self):
+        self.writer.close()
+        self.running = False
+        self.pump.join()
+        self.pool.close()
+
+
+class StampRequestHandler(BaseHTTPRequestHandler):
+    # JSON over HTTP/1.1 with keep-alive:
+    #   GET /status, GET /entries?from=&to=&limit=, GET /window?id=&radius=, GET /report?from=&to=&period=
+    #   POST /stamps {status, code, comment, timestamp}, PUT and DELETE /entries/<id>
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # Headers and body go out in separate writes; with Nagle on, every TCP response waits for a delayed ACK
+        self.disable_nagle_algorithm = self.server.address_family != socket.AF_UNIX
+        super().setup()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        routes = {'/status': lambda: self.server.service.status(),
+                  '/entries': lambda: self.server.service.entries(params),
+                  '/window': lambda: self.server.service.window(params),
+                  '/report': lambda: self.server.service.report(params)}
+        self._respond(routes.get(url.path))
+
+    def do_POST(self):
+        if urlsplit(self.path).path == '/stamps':
+            body = self._body()
+            self._respond(lambda: self.server.service.stamp(json.loads(body)), 201)
+        else:
+            self._respond(None)
+
+    def do_PUT(self):
+        entry_id = self._entry_id()
+        body = self._body()
+        self._respond(None if entry_id is None else lambda: self.server.service.update(entry_id, json.loads(body)))
+
+    def do_DELETE(self):
+        entry_id = self._entry_id()
+        self._respond(None if entry_id is None else lambda: self.server.service.delete(entry_id))
+
+    def _entry_id(self):
+        parts = urlsplit(self.path).path.strip('/').split('/')
+        return int(parts[1]) if len(parts) == 2 and parts[0] == 'entries' and parts[1].isdigit() else None
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _respond(self, handler, status=200):
+        if handler is None:
+            status, payload = 404, {'error': f"Not found: {self.command} {self.path}"}
+        else:
+            try:
+                payload = handler()
+            except (KeyError, ValueError, TypeError) as e:
+                status, payload = 400, {'error': f"Bad request: {e}"}
+            except Exception as e:
+                status, payload = 500, {'error': str(e)}
+        data = json.dumps(payload, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class StampHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class StampUnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def server_bind(self):
+        # A socket file left behind by a server that did not shut down cleanly
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+
+
+def make_server(service, url=DEFAULT_SERVER_URL, verbose=False):
+    # url is http://host:port or unix:///path/to/socket
+    parts = urlsplit(url)
+    if parts.scheme == 'unix':
+        server = StampUnixServer(parts.path, StampRequestHandler)
+    elif parts.scheme == 'http':
+        server = StampHTTPServer((parts.hostname or '127.0.0.1', parts.port or 80), StampRequestHandler)
+    else:
+        raise ValueError(f"Unsupported server url: {url}")
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class StampClient:
+    # Talks to a stamp server; one keep-alive connection per thread. Mirrors the parts of StampCore the
+    # main window and the Modify window use, and its *_write methods give closures for RemoteWriter like
+    # the core's do for DatabaseWriter.
+    def __init__(self, url, timeout=CLIENT_TIMEOUT):
+        self.url = urlsplit(url)
+        if self.url.scheme not in ('http', 'unix'):
+            raise ValueError(f"Unsupported server url: {url}")
+        self.timeout = timeout
+        self.local = threading.local()
+        # Bumped by every write through this client, for EntryWindow to reload its rows
+        self.writes = 0
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and conn.sock is not None and select.select([conn.sock], [], [], 0)[0]:
+            # Readable while idle: the server has closed the keep-alive connection
+            conn.close()
+        if conn is None:
+            if self.url.scheme == 'unix':
+                conn = UnixHTTPConnection(self.url.path, self.timeout)
+            else:
+                conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=self.timeout)
+            self.local.conn = conn
+        return conn
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        headers = {'Content-Type': 'application/json'} if data is not None else {}
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, data, headers)
+                response = conn.getresponse()
+                payload = json.loads(response.read() or b'null')
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The connection dropped under the request; reconnect once unless the request could
+                # have been carried out already
+                conn.close()
+                self.local.conn = None
+                if attempt or method not in IDEMPOTENT_METHODS:
+                    raise
+        if response.status >= 400:
+            message = payload.get('error') if isinstance(payload, dict) else payload
+            raise (ValueError if response.status == 400 else RuntimeError)(message)
+        return payload
+
+    def status(self):
+        return self.request('GET', '/status')
+
+    def last_entry(self):
+        # Same shape as StampCore.last_entry
+        state = self.status()
+        if not state:
+            return None
+        return datetime.fromisoformat(state['timestamp']).replace(tzinfo=timezone.utc), state['status'], state['code']
+
+    def open_session_start(self):
+        state = self.status()
+        if not state.get('session_start'):
+            return None
+        return datetime.fromisoformat(state['session_start']).replace(tzinfo=timezone.utc)
+
+    def latest_id(self):
+        return self.status().get('id')
+
+    def window(self, entry_id, radius=NEIGHBOUR_RADIUS):
+        result = self.request('GET', '/window?' + urlencode({'id': int(entry_id), 'radius': radius}))
+        return [tuple(row) for row in result['rows']], result['at_start'], result['at_end']
+
+    def get_entry(self, entry_id):
+        rows = self.window(entry_id, 0)[0]
+        return rows[0] if rows and rows[0][0] == int(entry_id) else None
+
+    def entry_window(self):
+        return EntryWindow(self.window, lambda: self.writes)
+
+    def stamp(self, status, code=None, comment=None, timestamp=None):
+        body = {'status': status, 'code': code, 'comment': comment,
+                'timestamp': timestamp.isoformat() if timestamp else None}
+        entry_id = self.request('POST', '/stamps', body)['id']
+        self.writes += 1
+        return entry_id
+
+    def update(self, entry_id, timestamp, status, code, comment):
+        self.request('PUT', f'/entries/{int(entry_id)}',
+                     {'timestamp': timestamp.isoformat(), 'status': status, 'code': code, 'comment': comment})
+        self.writes += 1
+
+    def delete(self, entry_id):
+        self.request('DELETE', f'/entries/{int(entry_id)}')
+        self.writes += 1
+
+    def entries(self, from_date_str, to_date_str, limit=None):
+        query = {'from': from_date_str, 'to': to_date_str}
+        if limit:
+            query['limit'] = limit
+        return self.request('GET', '/entries?' + urlencode(query))
+
+    def report(self, from_date_str, to_date_str, period='day'):
+        return self.request('GET', '/report?' + urlencode({'from': from_date_str, 'to': to_date_str, 'period': period}))
+
+    def insert_write(self, timestamp, status, code, comment):
+        return lambda client: client.stamp(status, code, comment, timestamp)
+
+    def update_write(self, entry_id, timestamp, status, code, comment):
+        return lambda client: client.update(entry_id, timestamp, status, code, comment)
+
+    def delete_write(self, entry_id):
+        return lambda client: client.delete(entry_id)
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+
+
+class RemoteWriter(DatabaseWriter):
+    # DatabaseWriter's submit/dispatch/close for a StampClient: writes are functions of the client,
+    # sent one after another off the Tk thread. The server does the group commits.
+    def __init__(self, client):
+        super().__init__(None)
+        self.client = client
+
+    def run(self):
+        try:
+            while True:
+                item = self.requests.get()
+                if item is None:
+                    break
+                write, callback = item
+                try:
+                    self.completed.put((callback, write(self.client), None))
+                except Exception as e:
+                    self.completed.put((callback, None, e))
+        finally:
+            self.client.close()
+
+
+def load(url, clients, stamps):
+    # Stamps from `clients` threads with a connection each; returns stamps per second
+    client = StampClient(url)
+    errors = []
+
+    def run():
+        try:
+            for i in range(stamps):
+                client.stamp('in' if i % 2 == 0 else 'out', 'load', 'load test')
+        except Exception as e:
+            errors.append(e)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=run) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+    return clients * stamps / seconds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve one stamp database to many clients over HTTP or a Unix socket")
+    parser.add_argument('--config', help="defaults.yaml to use")
+    parser.add_argument('--url', help=f"http://host:port or unix:///path (default: server_url or {DEFAULT_SERVER_URL})")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help="run the server")
+    serve_parser.add_argument('--readers', type=int, default=READ_POOL_SIZE, help="read connections")
+    serve_parser.add_argument('--verbose', action='store_true', help="log every request")
+    load_parser = subparsers.add_parser('load', help="stamp against a running server and report the rate")
+    load_parser.add_argument('--clients', type=int, default=16)
+    load_parser.add_argument('--stamps', type=int, default=500, help="per client")
+    args = parser.parse_args(argv)
+
+    from stamp_core import StampCore, default_config_path, load_defaults
+
+    url = args.url or load_defaults(args.config or default_config_path()).get('server_url') or DEFAULT_SERVER_URL
+    if args.command == 'load':
+        rate = load(url, args.clients, args.stamps)
+        print(f"{args.clients * args.stamps} stamps from {args.clients} clients: {rate:,.0f} stamps/s")
+        return 0
+
+    core = StampCore(args.config)
+    service = StampService(core, args.readers)
+    server = make_server(service, url, args.verbose)
+    print(f"serving {core.DB_FILE} on {url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        core.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,233 @@
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+import stamp_db
+from stamp_archive import Archives
+from stamp_sql import execute, fetchone
+
+SNAPSHOT_BATCH_SIZE = 100_000
+SNAPSHOT_VERSION = 1
+MANIFEST = 'manifest.json'
+# File name -> dtype. Every file is a 1-d .npy array; comment text is comment_bytes[offsets[i]:offsets[i + 1]]
+COLUMNS = {
+    'id': np.int64,
+    'epoch_us': np.int64,
+    'status': np.uint8,
+    'code': np.int32,
+    'comment_offsets': np.int64,
+    'comment_bytes': np.uint8,
+}
+STATUSES = ['in', 'out']
+
+
+def _read_header(file):
+    file.seek(0)
+    np.lib.format.read_magic(file)
+    shape, _, dtype = np.lib.format.read_array_header_1_0(file)
+    return file.tell(), shape[0], dtype
+
+
+def _write_header(path, dtype, length):
+    # Rewrites the shape in place. numpy pads headers so the shape can grow without moving the data;
+    # should the header ever need more room, the file is rewritten behind a longer one.
+    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': (length,)}
+    with open(path, 'r+b') as file:
+        offset = _read_header(file)[0]
+        file.seek(0)
+        np.lib.format.write_array_header_1_0(file, header)
+        if file.tell() == offset:
+            return
+        file.seek(offset)
+        data = file.read()
+    with open(path, 'wb') as file:
+        np.lib.format.write_array_header_1_0(file, header)
+        file.write(data)
+
+
+class SnapshotWriter:
+    # Appends rows to the column files of a snapshot directory. Data past the length in manifest.json is
+    # not part of the snapshot, so an interrupted append is cut off by the next one; the manifest is
+    # replaced last and is what commits an append.
+    def __init__(self, directory, manifest):
+        self.directory = Path(directory)
+        self.manifest = manifest
+        self.codes = {code: i for i, code in enumerate(manifest['codes'])}
+        self.statuses = {status: i for i, status in enumerate(manifest['statuses'])}
+        self.rows = manifest['rows']
+        self.comment_bytes = manifest['comment_bytes']
+        self.files = {}
+        lengths = {'comment_offsets': self.rows + 1, 'comment_bytes': self.comment_bytes}
+        for name, dtype in COLUMNS.items():
+            path = self.directory / f"{name}.npy"
+            if not path.exists():
+                with open(path, 'wb') as file:
+                    np.lib.format.write_array_header_1_0(file, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                                'fortran_order': False, 'shape': (0,)})
+                    if name == 'comment_offsets':
+                        file.write(np.zeros(1, np.int64).tobytes())
+            file = open(path, 'r+b')
+            offset = _read_header(file)[0]
+            file.truncate(offset + lengths.get(name, self.rows) * np.dtype(dtype).itemsize)
+            file.seek(0, os.SEEK_END)
+            self.files[name] = file
+
+    def append(self, rows):
+        # rows are (id, epoch_us, status, code, comment) tuples in (epoch_us, id) order
+        ids, epoch_us, statuses, codes, comments = zip(*rows)
+        encoded = [(comment or '').encode('utf-8') for comment in comments]
+        lengths = np.fromiter(map(len, encoded), np.int64, len(encoded))
+        columns = {
+            'id': np.array(ids, np.int64),
+            'epoch_us': np.array(epoch_us, np.int64),
+            'status': np.fromiter((self.statuses.setdefault(s, len(self.statuses)) for s in statuses), np.uint8, len(rows)),
+            'code': np.fromiter((self.codes.setdefault(c, len(self.codes)) for c in codes), np.int32, len(rows)),
+            'comment_offsets': self.comment_bytes + np.cumsum(lengths),
+            'comment_bytes': np.frombuffer(b''.join(encoded), np.uint8),
+        }
+        for name, values in columns.items():
+            self.files[name].write(values.tobytes())
+        self.rows += len(rows)
+        self.comment_bytes += int(lengths.sum())
+        self.manifest.update(last_epoch_us=int(columns['epoch_us'][-1]), last_id=int(columns['id'][-1]))
+        self.manifest['id_sum'] += int(columns['id'].sum())
+
+    def commit(self):
+        lengths = {'comment_offsets': self.rows + 1, 'comment_bytes': self.comment_bytes}
+        for name, file in self.files.items():
+            file.flush()
+            os.fsync(file.fileno())
+            file.close()
+            _write_header(self.directory / f"{name}.npy", COLUMNS[name], lengths.get(name, self.rows))
+        self.manifest.update(rows=self.rows, comment_bytes=self.comment_bytes,
+                             codes=list(self.codes), statuses=list(self.statuses),
+                             updated=datetime.now().isoformat(timespec='seconds'))
+        write_manifest(self.directory, self.manifest)
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+
+def read_manifest(directory):
+    try:
+        with open(Path(directory) / MANIFEST, 'r') as file:
+            manifest = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+    return manifest if manifest.get('version') == SNAPSHOT_VERSION else None
+
+
+def write_manifest(directory, manifest):
+    path = Path(directory) / MANIFEST
+    temp_path = path.with_suffix('.tmp')
+    with open(temp_path, 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(temp_path, path)
+
+
+def empty_manifest(db_file):
+    return {'version': SNAPSHOT_VERSION, 'db': str(Path(db_file).resolve()), 'rows': 0, 'comment_bytes': 0,
+            'last_epoch_us': None, 'last_id': None, 'id_sum': 0, 'codes': [], 'statuses': list(STATUSES)}
+
+
+def unchanged(conn, pieces, manifest):
+    # Whether the rows the snapshot holds are still the ones in the database up to its last row, as far as
+    # count and ids tell; changes to the text of older rows need a full snapshot
+    if manifest['last_id'] is None:
+        return True
+    last = (manifest['last_epoch_us'], manifest['last_id'])
+    count, id_sum = 0, 0
+    for from_us, to_us, source in pieces:
+        if from_us > last[0]:
+            break
+        rows, ids = fetchone(conn, f'SELECT COUNT(*), COALESCE(SUM(id), 0) FROM {source} '
+                             'WHERE epoch_us BETWEEN ? AND ? AND (epoch_us, id) <= (?, ?)', (from_us, to_us) + last)
+        count, id_sum = count + rows, id_sum + ids
+    return count == manifest['rows'] and id_sum == manifest['id_sum']
+
+
+def write_snapshot(db_file, directory, full=False, batch_size=SNAPSHOT_BATCH_SIZE):
+    # Writes every stamp, archived ones included, as a columnar snapshot in directory. Only rows after the
+    # last snapshotted one are appended, unless full is set or older rows changed. Returns a dict with the
+    # mode ('full' or 'append'), rows added, total rows and seconds.
+    started = time.perf_counter()
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    conn = stamp_db.connect(db_file, read_only=True)
+    try:
+        # Archives are read a year at a time, attached as each piece is reached
+        archives = Archives(conn)
+        manifest = None if full else read_manifest(directory)
+        if manifest is not None and manifest['db'] != str(Path(db_file).resolve()):
+            manifest = None
+        if manifest is not None and not unchanged(conn, archives.partitions(), manifest):
+            manifest = None
+        mode = 'full' if manifest is None else 'append'
+        if manifest is None:
+            manifest = empty_manifest(db_file)
+            for name in COLUMNS:
+                (directory / f"{name}.npy").unlink(missing_ok=True)
+            (directory / MANIFEST).unlink(missing_ok=True)
+
+        last = (manifest['last_epoch_us'], manifest['last_id'])
+        writer = SnapshotWriter(directory, manifest)
+        added = 0
+        try:
+            for from_us, to_us, source in archives.partitions():
+                if last[0] is not None and to_us < last[0]:
+                    continue
+                cursor = execute(conn, f'SELECT id, epoch_us, status, code, comment FROM {source} '
+                                 'WHERE epoch_us BETWEEN ? AND ? AND (epoch_us, id) > (?, ?) ORDER BY epoch_us, id',
+                                 (from_us, to_us, last[0] if last[0] is not None else -2 ** 63, last[1] or 0))
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    writer.append(rows)
+                    added += len(rows)
+            writer.commit()
+        except BaseException:
+            writer.close()
+            raise
+    finally:
+        conn.close()
+    return {'mode': mode, 'added': added, 'rows': manifest['rows'], 'seconds': time.perf_counter() - started}
+
+
+def open_snapshot(directory):
+    # (manifest, {column: read-only np.memmap}) without reading any data
+    manifest = read_manifest(directory)
+    if manifest is None:
+        raise FileNotFoundError(f"No snapshot in {directory}")
+    lengths = {'comment_offsets': manifest['rows'] + 1, 'comment_bytes': manifest['comment_bytes']}
+    columns = {}
+    for name in COLUMNS:
+        length = lengths.get(name, manifest['rows'])
+        # np.load cannot map an empty array
+        columns[name] = (np.load(Path(directory) / f"{name}.npy", mmap_mode='r')[:length] if length
+                         else np.empty(0, COLUMNS[name]))
+    return manifest, columns
+
+
+def load_snapshot(directory, comments=True):
+    # DataFrame with id, timestamp (UTC), status and code (categoricals) straight from the mapped columns.
+    # Comments are the one column decoded row by row; comments=False leaves them out.
+    import pandas as pd
+
+    manifest, columns = open_snapshot(directory)
+    data = {
+        'id': columns['id'],
+        'timestamp': pd.DatetimeIndex(columns['epoch_us'].view('datetime64[us]')).tz_localize('UTC'),
+        'status': pd.Categorical.from_codes(columns['status'], manifest['statuses']),
+        'code': pd.Categorical.from_codes(columns['code'], manifest['codes']),
+    }
+    if comments:
+        blob = columns['comment_bytes'].tobytes()
+        offsets = columns['comment_offsets'].tolist()
+        data['comment'] = [blob[start:stop].decode('utf-8') for start, stop in zip(offsets[:-1], offsets[1:])]
+    return pd.DataFrame(data, copy=False)
@@ -0,0 +1,169 @@
+import json
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+# Upper bounds of the latency buckets in milliseconds
+LATENCY_BUCKETS_MS = (0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000, float('inf'))
+SLOW_QUERY_MS = 100
+# Frames in these files are skipped when looking for the caller of a statement
+_PASS_THROUGH = ('stamp_sql.py', 'stamp_cache.py', 'contextlib.py')
+
+
+def normalize_query(query):
+    return re.sub(r'\s+', ' ', query).strip()
+
+
+def _caller():
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename.endswith(_PASS_THROUGH):
+        frame = frame.f_back
+    if frame is None:
+        return '?'
+    return f"{frame.f_code.co_name} ({Path(frame.f_code.co_filename).name}:{frame.f_lineno})"
+
+
+class StatementStats:
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.histogram = [0] * len(LATENCY_BUCKETS_MS)
+        self.callers = {}
+
+    def add(self, seconds, rows, caller):
+        self.calls += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.rows += max(rows, 0)
+        ms = seconds * 1000
+        self.histogram[next(i for i, bound in enumerate(LATENCY_BUCKETS_MS) if ms <= bound)] += 1
+        self.callers[caller] = self.callers.get(caller, 0) + 1
+
+    def percentile_ms(self, fraction):
+        # Upper bound of the bucket holding the given fraction of calls
+        needed = fraction * self.calls
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.histogram):
+            seen += count
+            if seen >= needed:
+                return bound if bound != float('inf') else self.max_seconds * 1000
+        return 0.0
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'total_ms': self.seconds * 1000,
+            'mean_ms': self.seconds * 1000 / self.calls if self.calls else 0.0,
+            'p95_ms': self.percentile_ms(0.95),
+            'max_ms': self.max_seconds * 1000,
+            'rows': self.rows,
+            'histogram': dict(zip([str(bound) for bound in LATENCY_BUCKETS_MS], self.histogram)),
+            'callers': dict(sorted(self.callers.items(), key=lambda item: -item[1])),
+        }
+
+
+class SqlStats:
+    # Per-statement latency histograms, row counts and callers, plus a slow-query log file.
+    # Disabled it is a single attribute check per call. Shared by every thread, so updates take a lock.
+    def __init__(self):
+        self.enabled = False
+        self.slow_ms = SLOW_QUERY_MS
+        self.slow_log = None
+        self.statements = {}
+        self.lock = threading.Lock()
+
+    def configure(self, enabled=False, slow_ms=SLOW_QUERY_MS, slow_log=None):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.slow_log = Path(slow_log) if slow_log else None
+
+    def reset(self):
+        with self.lock:
+            self.statements = {}
+
+    def record(self, sql, params, seconds, rows, caller):
+        key = normalize_query(sql)
+        with self.lock:
+            self.statements.setdefault(key, StatementStats()).add(seconds, rows, caller)
+        if self.slow_log is not None and seconds * 1000 >= self.slow_ms:
+            line = (f"{datetime.now():%Y-%m-%d %H:%M:%S}  {seconds * 1000:9.1f} ms  rows={rows}  {caller}\n"
+                    f"    {key}  {tuple(params)!r:.200}\n")
+            with self.lock:
+                self.slow_log.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.slow_log, 'a') as file:
+                    file.write(line)
+
+    def snapshot(self):
+        with self.lock:
+            return {sql: stats.as_dict() for sql, stats in self.statements.items()}
+
+    def dump_json(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({'time': datetime.now().isoformat(timespec='seconds'),
+                                    'slow_ms': self.slow_ms, 'statements': self.snapshot()}, indent=2))
+        return path
+
+
+STATS = SqlStats()
+
+
+def execute(conn, sql, params=()):
+    if not STATS.enabled:
+        return conn.execute(sql, params)
+    started = time.perf_counter()
+    cursor = conn.execute(sql, params)
+    STATS.record(sql, params, time.perf_counter() - started, cursor.rowcount, _caller())
+    return cursor
+
+
+def executemany(conn, sql, rows):
+    if not STATS.enabled:
+        return conn.executemany(sql, rows)
+    started = time.perf_counter()
+    cursor = conn.executemany(sql, rows)
+    STATS.record(sql, (), time.perf_counter() - started, cursor.rowcount, _caller())
+    return cursor
+
+
+def fetchall(conn, sql, params=()):
+    if not STATS.enabled:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+    started = time.perf_counter()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    STATS.record(sql, params, time.perf_counter() - started, len(rows), _caller())
+    return rows
+
+
+def fetchone(conn, sql, params=()):
+    rows = fetchall(conn, sql, params)
+    return rows[0] if rows else None
+
+
+@contextmanager
+def timed(label):
+    # Times a block that is not SQL (time zone conversion, Tk rendering) into the same table
+    if not STATS.enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STATS.record(f"[{label}]", (), time.perf_counter() - started, 0, _caller())
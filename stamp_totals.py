@@ -0,0 +1,248 @@
+import argparse
+from datetime import datetime, time, timedelta
+
+import stamp_db
+from stamp_db import from_epoch_us, to_epoch_us
+from stamp_sql import execute, executemany, fetchall, fetchone
+
+WINDOW_CACHE_SIZE = 1024
+# Longer ranges localize their day bounds in one pandas pass instead of day by day
+VECTORIZED_DAYS = 32
+NAT_US = -2 ** 63
+US_PER_SECOND = 1_000_000
+# Every event of the range with its local day from temp.day_windows; LEAD pairs an in with the event
+# right after it, which for the last one may be the first event past the range
+RECOMPUTE_SQL = '''
+    WITH ordered AS (
+        SELECT epoch_us, code, LEAD(epoch_us) OVER w AS next_us,
+               status = 'in' AND LEAD(status) OVER w = 'out' AS closed
+        FROM {source}
+        WHERE epoch_us >= ?1 AND epoch_us <= COALESCE((SELECT MIN(epoch_us) FROM {source} WHERE epoch_us >= ?2), ?2)
+        WINDOW w AS (ORDER BY epoch_us, id)
+    )
+    INSERT INTO daily_totals (day, code, seconds, lunch_seconds, sessions, events)
+    SELECT d.day, o.code,
+           TOTAL(CASE WHEN closed THEN next_us - epoch_us END) / 1e6,
+           TOTAL(CASE WHEN closed THEN MAX(0, MIN(next_us, d.lunch_stop_us) - MAX(epoch_us, d.lunch_start_us)) END) / 1e6,
+           COUNT(CASE WHEN closed THEN 1 END), COUNT(*)
+    FROM ordered AS o
+    JOIN temp.day_windows AS d ON d.start_us = (SELECT MAX(start_us) FROM temp.day_windows WHERE start_us <= o.epoch_us)
+    WHERE o.epoch_us < ?2
+    GROUP BY d.day, o.code'''
+
+
+def localize(time_zone, naive):
+    return time_zone.localize(naive) if hasattr(time_zone, 'localize') else naive.replace(tzinfo=time_zone)
+
+
+class DayWindow:
+    # Epoch bounds of one local day and of its lunch window
+    def __init__(self, day, time_zone, lunch_start, lunch_stop):
+        self.day = day
+        self.start_us = to_epoch_us(localize(time_zone, datetime.combine(day, time())))
+        self.stop_us = to_epoch_us(localize(time_zone, datetime.combine(day + timedelta(days=1), time())))
+        self.lunch_start_us = to_epoch_us(localize(time_zone, datetime.combine(day, lunch_start)))
+        self.lunch_stop_us = to_epoch_us(localize(time_zone, datetime.combine(day, lunch_stop)))
+
+    def __contains__(self, epoch_us):
+        return self.start_us <= epoch_us < self.stop_us
+
+    def lunch_overlap(self, start_us, stop_us):
+        return max(0, min(stop_us, self.lunch_stop_us) - max(start_us, self.lunch_start_us)) / US_PER_SECOND
+
+
+class DailyTotals:
+    # Maintains daily_totals (local day, code) -> worked seconds, lunch overlap, sessions and events.
+    # Sessions pair an 'in' with a directly following 'out' and count towards the day the 'in' falls on,
+    # matching stamp_report.time_report. With archived=True the incremental updates read archived years
+    # too, on whichever connection they are given, as rebuild does through its partitions.
+    def __init__(self, time_zone, lunch_start=time(10, 30), lunch_stop=time(13, 0), archived=False):
+        self.time_zone = time_zone
+        self.archived = archived
+        self.lunch_start = lunch_start
+        self.lunch_stop = lunch_stop
+        self.signature = f"{time_zone}|{lunch_start:%H:%M}|{lunch_stop:%H:%M}"
+        # Localizing the bounds dominates a stamp's write; stamps keep landing on the same few days
+        self.windows = {}
+
+    def window(self, epoch_us):
+        return self.day_window(from_epoch_us(epoch_us).astimezone(self.time_zone).date())
+
+    def day_window(self, day):
+        window = self.windows.get(day)
+        if window is None:
+            if len(self.windows) >= WINDOW_CACHE_SIZE:
+                self.windows.clear()
+            window = self.windows[day] = DayWindow(day, self.time_zone, self.lunch_start, self.lunch_stop)
+        return window
+
+    def day_windows(self, first_day, last_day):
+        # (start_us, stop_us, day, lunch_start_us, lunch_stop_us) of every day from first_day to last_day.
+        # Long ranges are localized in one pandas pass; wall times it cannot place on their own (ambiguous
+        # or skipped by a DST change) come back as NaT and are left to DayWindow, so both agree.
+        count = (last_day - first_day).days + 1
+        days = [first_day + timedelta(days=i) for i in range(count)]
+        if count <= VECTORIZED_DAYS:
+            bounds = [None] * count
+        else:
+            import pandas as pd
+
+            midnights = pd.date_range(first_day, periods=count + 1, freq='D')
+            offsets = [pd.Timedelta(0)] + [pd.Timedelta(hours=t.hour, minutes=t.minute)
+                                           for t in (self.lunch_start, self.lunch_stop)]
+            starts, lunch_starts, lunch_stops = [
+                (midnights + offset).tz_localize(self.time_zone, ambiguous='NaT', nonexistent='NaT')
+                .as_unit('us').asi8.tolist() for offset in offsets]
+            bounds = zip(starts[:-1], starts[1:], lunch_starts, lunch_stops)
+        windows = []
+        for day, bound in zip(days, bounds):
+            if bound is None or NAT_US in bound:
+                window = self.day_window(day)
+                bound = window.start_us, window.stop_us, window.lunch_start_us, window.lunch_stop_us
+            windows.append((bound[0], bound[1], day.isoformat(), bound[2], bound[3]))
+        return windows
+
+    def source(self, conn, from_us, to_us):
+        if not self.archived:
+            return 'log'
+        from stamp_archive import Archives
+
+        return Archives(conn).source(from_us, to_us)
+
+    def recompute(self, conn, from_us, to_us, source=None):
+        # Recomputes every local day touched by [from_us, to_us] with one aggregate; the caller commits.
+        # source is the log or a union with attached archives (stamp_archive.Archives.source); by default
+        # whatever covers the days and the event after them.
+        first, last = self.window(from_us), self.window(to_us)
+        source = source or self.source(conn, first.start_us, last.stop_us)
+        execute(conn, 'CREATE TEMP TABLE IF NOT EXISTS day_windows (start_us INTEGER PRIMARY KEY, stop_us INTEGER, '
+                'day TEXT, lunch_start_us INTEGER, lunch_stop_us INTEGER)')
+        execute(conn, 'DELETE FROM temp.day_windows')
+        executemany(conn, 'INSERT INTO temp.day_windows VALUES (?, ?, ?, ?, ?)', self.day_windows(first.day, last.day))
+        execute(conn, 'DELETE FROM daily_totals WHERE day BETWEEN ? AND ?', (first.day.isoformat(), last.day.isoformat()))
+        execute(conn, RECOMPUTE_SQL.format(source=source), (first.start_us, last.stop_us))
+
+    def touched(self, conn, entry_id):
+        # Epochs whose days depend on a row: the row itself and the event before it
+        row = fetchone(conn, 'SELECT epoch_us FROM log WHERE id = ?', (entry_id,))
+        return self.neighbours(conn, row[0]) if row and row[0] is not None else []
+
+    def neighbours(self, conn, epoch_us):
+        previous = self.previous(conn, epoch_us)
+        return [epoch_us] if previous is None else [previous, epoch_us]
+
+    def previous(self, conn, epoch_us):
+        # Newest event before epoch_us. Archived years between the log's and epoch_us are searched newest
+        # first, attaching only as far back as the first one with an earlier event.
+        previous = fetchone(conn, 'SELECT MAX(epoch_us) FROM log WHERE epoch_us < ?', (epoch_us,))[0]
+        if not self.archived:
+            return previous
+        years = fetchall(conn, 'SELECT from_us FROM archives WHERE from_us < ?1 AND (?2 IS NULL OR to_us > ?2) '
+                         'ORDER BY from_us DESC', (epoch_us, previous))
+        for (from_us,) in years:
+            found = fetchone(conn, f'SELECT MAX(epoch_us) FROM {self.source(conn, from_us, epoch_us)} '
+                             'WHERE epoch_us >= ? AND epoch_us < ?', (from_us, epoch_us))[0]
+            if found is not None:
+                return found
+        return previous
+
+    def append(self, conn, entry_id):
+        # Constant-time update for a stamp that is the newest in the log, which nearly every stamp is.
+        # Returns False when it is not, and the touched days need a refresh instead. One query gives the
+        # newest row and the one before it, walking idx_log_epoch down from the stamp's predecessor.
+        rows = fetchall(conn, 'SELECT id, epoch_us, status, code FROM log WHERE epoch_us >= coalesce('
+                        '(SELECT MAX(epoch_us) FROM log WHERE epoch_us < (SELECT epoch_us FROM log WHERE id = ?1)), '
+                        '(SELECT epoch_us FROM log WHERE id = ?1)) ORDER BY epoch_us DESC, id DESC LIMIT 2',
+                        (entry_id,))
+        if not rows or rows[0][0] != entry_id:
+            return False
+        row = rows[0][1:]
+        previous = rows[1][1:] if len(rows) > 1 else None
+        if previous is None and self.archived:
+            # The event before it may be archived
+            return False
+        self._upsert(conn, self.window(row[0]).day, row[2], events=1)
+        if previous is not None and previous[1] == 'in' and row[1] == 'out':
+            window = self.window(previous[0])
+            self._upsert(conn, window.day, previous[2], (row[0] - previous[0]) / US_PER_SECOND,
+                         window.lunch_overlap(previous[0], row[0]), sessions=1)
+        return True
+
+    @staticmethod
+    def _upsert(conn, day, code, seconds=0.0, lunch_seconds=0.0, sessions=0, events=0):
+        execute(conn, 'INSERT INTO daily_totals (day, code, seconds, lunch_seconds, sessions, events) '
+                'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (day, code) DO UPDATE SET '
+                'seconds = seconds + excluded.seconds, lunch_seconds = lunch_seconds + excluded.lunch_seconds, '
+                'sessions = sessions + excluded.sessions, events = events + excluded.events',
+                (day.isoformat(), code, seconds, lunch_seconds, sessions, events))
+
+    def refresh(self, conn, epochs):
+        # Only the days containing the given epochs are recomputed
+        windows = {}
+        for epoch_us in epochs:
+            window = self.window(epoch_us)
+            windows[window.day] = window
+        for window in windows.values():
+            self.recompute(conn, window.start_us, window.stop_us - 1)
+
+    def rebuild(self, conn, partitions=None):
+        # partitions are day-aligned (from_us, to_us, source) pieces of the history, as from
+        # stamp_archive.Archives.partitions; by default the log in one piece. Each piece is committed since
+        # archives are only attached and detached between transactions; the signature is dropped first and
+        # written last, so an interrupted rebuild is redone.
+        execute(conn, "DELETE FROM meta WHERE key = 'daily_totals'")
+        execute(conn, 'DELETE FROM daily_totals')
+        conn.commit()
+        if partitions is None:
+            first, last = fetchone(conn, 'SELECT MIN(epoch_us), MAX(epoch_us) FROM log')
+            partitions = [] if first is None else [(first, last, 'log')]
+        for from_us, to_us, source in partitions:
+            self.recompute(conn, from_us, to_us, source)
+            conn.commit()
+        execute(conn, "INSERT OR REPLACE INTO meta (key, value) VALUES ('daily_totals', ?)", (self.signature,))
+        conn.commit()
+
+    def stale(self, conn):
+        # Never filled, or built for another time zone or lunch window
+        row = fetchone(conn, "SELECT value FROM meta WHERE key = 'daily_totals'")
+        return row is None or row[0] != self.signature
+
+    def ensure(self, conn, partitions=None):
+        # Returns whether the rollup had to be rebuilt, for the caller to report
+        if not self.stale(conn):
+            return False
+        self.rebuild(conn, partitions)
+        return True
+
+
+def main(argv=None):
+    from pytz import timezone
+
+    from stamp_archive import Archives
+    from stamp_core import script_config
+
+    parser = argparse.ArgumentParser(description="Rebuild the daily_totals rollup")
+    parser.add_argument('--config', help="defaults.yaml to use")
+    parser.add_argument('--db', help="database (default: db_path in the config)")
+    parser.add_argument('--time-zone', default=str(datetime.now().astimezone().tzinfo))
+    args = parser.parse_args(argv)
+
+    defaults, base_dir, db_file = script_config(args.config)
+    db_file = args.db or db_file
+
+    lunch_start = datetime.strptime(defaults.get('typical_lunch_start', '10:30'), '%H:%M').time()
+    lunch_stop = datetime.strptime(defaults.get('typical_lunch_stop', '13:00'), '%H:%M').time()
+    conn = stamp_db.connect(db_file)
+    try:
+        stamp_db.migrate(conn)
+        daily_totals = DailyTotals(timezone(args.time_zone), lunch_start, lunch_stop, archived=True)
+        daily_totals.rebuild(conn, Archives(conn).partitions(daily_totals.window))
+        count = fetchone(conn, 'SELECT COUNT(*) FROM daily_totals')[0]
+    finally:
+        conn.close()
+    print(f"daily totals rebuilt: {count} rows")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,48 @@
+import functools
+from datetime import datetime, timezone
+
+import numpy as np
+
+UTC_SUFFIX = '+00:00'
+
+
+@functools.lru_cache(maxsize=8)
+def transition_table(time_zone):
+    # (UTC start in epoch us, UTC offset in us) of every period of time_zone, or None when the zone
+    # does not expose its transitions. Same lookup as pytz's fromutc, so results match astimezone().
+    transitions = getattr(time_zone, '_utc_transition_times', None)
+    if transitions is not None:
+        epoch = datetime(1970, 1, 1)
+        starts = np.array([(t - epoch) // (datetime.resolution) if t.year > 1 else np.iinfo(np.int64).min
+                           for t in transitions], dtype=np.int64)
+        offsets = np.array([info[0] // datetime.resolution for info in time_zone._transition_info], dtype=np.int64)
+        return starts, offsets
+    offset = time_zone.utcoffset(None)
+    if offset is None:
+        return None
+    return np.array([np.iinfo(np.int64).min], dtype=np.int64), np.array([offset // datetime.resolution], dtype=np.int64)
+
+
+def local_epoch_us(epoch_us, time_zone):
+    # Wall-clock time in time_zone as epoch-style microseconds, for a whole array at once
+    starts, offsets = transition_table(time_zone)
+    return epoch_us + offsets[np.searchsorted(starts, epoch_us, side='right') - 1]
+
+
+def format_local(timestamps, time_zone):
+    # Stored UTC ISO timestamps -> 'YYYY-MM-DD HH:MM:SS' local time. Whole columns go through the transition
+    # table; anything else (other offsets, text numpy cannot parse, zones without a table) is converted row by row.
+    if not timestamps or transition_table(time_zone) is None:
+        return [_format_row(timestamp, time_zone) for timestamp in timestamps]
+    try:
+        if not all(isinstance(t, str) and t.endswith(UTC_SUFFIX) for t in timestamps):
+            raise ValueError
+        moments = np.array([t[:-len(UTC_SUFFIX)] for t in timestamps], dtype='datetime64[us]')
+    except ValueError:
+        return [_format_row(timestamp, time_zone) for timestamp in timestamps]
+    local = local_epoch_us(moments.astype(np.int64), time_zone).astype('datetime64[us]').astype('datetime64[s]')
+    return np.char.replace(np.datetime_as_string(local), 'T', ' ').tolist()
+
+
+def _format_row(timestamp, time_zone):
+    return datetime.fromisoformat(timestamp).replace(tzinfo=timezone.utc).astimezone(time_zone).strftime('%Y-%m-%d %H:%M:%S')
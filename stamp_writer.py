@@ -0,0 +1,105 @@
+import queue
+import threading
+import time
+
+import stamp_db
+
+GROUP_COMMIT_WINDOW = 0.05
+MAX_GROUP_SIZE = 500
+
+
+class DatabaseWriter(threading.Thread):
+    # Owns the write connection. A write is a function taking the connection; writes submitted close
+    # together share one transaction and one commit, each inside its own savepoint so a failing write
+    # does not take the others down with it. Completions are handed back through dispatch(), which the
+    # Tk thread calls from root.after. When idle after writes it runs a passive WAL checkpoint.
+    def __init__(self, db_file, group_window=GROUP_COMMIT_WINDOW, max_group=MAX_GROUP_SIZE,
+                 checkpoint_interval=stamp_db.CHECKPOINT_INTERVAL, retries=stamp_db.WRITE_RETRIES):
+        super().__init__(daemon=True)
+        self.db_file = db_file
+        self.group_window = group_window
+        self.max_group = max_group
+        self.checkpoint_interval = checkpoint_interval
+        self.retries = retries
+        self.requests = queue.Queue()
+        self.completed = queue.Queue()
+        self.pending = 0
+
+    def submit(self, write, callback=None):
+        self.pending += 1
+        self.requests.put((write, callback))
+
+    def close(self):
+        # Flushes everything already submitted before returning
+        self.requests.put(None)
+        self.join()
+
+    def dispatch(self, wait=None):
+        # Runs the callbacks of finished writes; waits up to `wait` seconds for the first one
+        while True:
+            try:
+                callback, result, error = self.completed.get(wait is not None, wait)
+            except queue.Empty:
+                return
+            wait = None
+            self.pending -= 1
+            if callback is not None:
+                callback(result, error)
+
+    def run(self):
+        conn = stamp_db.connect(self.db_file, isolation_level=None)
+        try:
+            stopping = False
+            written = False
+            while not stopping:
+                try:
+                    item = self.requests.get(timeout=self.checkpoint_interval if written else None)
+                except queue.Empty:
+                    stamp_db.checkpoint(conn)
+                    written = False
+                    continue
+                if item is None:
+                    break
+                group = [item]
+                deadline = time.monotonic() + self.group_window
+                while len(group) < self.max_group:
+                    try:
+                        item = self.requests.get(timeout=max(0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    group.append(item)
+                self.write_group(conn, group)
+                written = True
+        finally:
+            conn.close()
+
+    def write_group(self, conn, group):
+        # The whole group is retried when another process keeps the database locked past the busy timeout
+        for attempt in range(self.retries + 1):
+            outcomes = []
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                for write, callback in group:
+                    conn.execute('SAVEPOINT write')
+                    try:
+                        result = write(conn)
+                    except Exception as e:
+                        conn.execute('ROLLBACK TO write')
+                        outcomes.append((callback, None, e))
+                    else:
+                        outcomes.append((callback, result, None))
+                    conn.execute('RELEASE write')
+                conn.execute('COMMIT')
+                break
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                outcomes = [(callback, None, e) for _, callback in group]
+                if not stamp_db.is_busy(e) or attempt == self.retries:
+                    break
+            stamp_db.backoff(attempt)
+        for outcome in outcomes:
+            self.completed.put(outcome)
@@ -0,0 +1,17 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from stamp_core import StampCore  # noqa: E402
+
+
+@pytest.fixture
+def core(tmp_path):
+    config_path = tmp_path / 'defaults.yaml'
+    config_path.write_text("db_path: 'out/current/time_log.db'\nbackup_dir: 'out/backups/'\n")
+    core = StampCore(config_path)
+    yield core
+    core.close()
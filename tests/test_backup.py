@@ -0,0 +1,69 @@
+import threading
+from datetime import datetime, timedelta, timezone
+
+import stamp_backup
+from stamp_backup import recorded_hash, restore_backup, run_backup, verify_backup
+
+START = datetime(2025, 3, 3, 7, tzinfo=timezone.utc)
+
+
+def stamp(core, count, first=0):
+    for i in range(first, first + count):
+        core.stamp('in' if i % 2 == 0 else 'out', 'work', f"stamp {i}", START + timedelta(hours=i))
+
+
+def test_unchanged_database_is_not_copied(core, tmp_path, monkeypatch):
+    stamp(core, 10)
+    first = run_backup(core.DB_FILE, tmp_path / 'backups')
+    copies = []
+    monkeypatch.setattr(stamp_backup, 'snapshot', lambda *args: copies.append(args))
+
+    assert run_backup(core.DB_FILE, tmp_path / 'backups') == first
+    assert copies == []
+
+
+def test_changed_database_gets_a_new_backup(core, tmp_path):
+    stamp(core, 10)
+    first = run_backup(core.DB_FILE, tmp_path / 'backups')
+    stamp(core, 1, first=10)
+
+    second = run_backup(core.DB_FILE, tmp_path / 'backups')
+
+    assert second != first
+    assert verify_backup(second, recorded_hash(core.conn, second))[0]
+
+
+def test_concurrent_backups_do_not_share_a_file(core, tmp_path):
+    stamp(core, 200)
+    errors = []
+
+    def backup():
+        try:
+            run_backup(core.DB_FILE, tmp_path / 'backups', pages=1)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=backup) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    backups = list((tmp_path / 'backups').iterdir())
+    assert len(backups) == 1 and verify_backup(backups[0])[0]
+
+
+def test_restore_does_not_pass_for_unchanged(core, tmp_path):
+    stamp(core, 10)
+    old = run_backup(core.DB_FILE, tmp_path / 'backups')
+    stamp(core, 1, first=10)
+    newer = run_backup(core.DB_FILE, tmp_path / 'backups')
+    restore_backup(core.DB_FILE, old, tmp_path / 'backups')
+    # As many changes as the newer backup had seen, but other content
+    stamp(core, 1, first=20)
+
+    latest = run_backup(core.DB_FILE, tmp_path / 'backups')
+
+    assert latest not in (old, newer)
+    assert verify_backup(latest, recorded_hash(core.conn, latest))[0]
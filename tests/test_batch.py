@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from stamp_batch import EDIT_JOURNAL_KEEP, batch_write, list_batches, selection, undo_write
+from stamp_db import to_epoch_us
+
+START = datetime(2025, 3, 3, 7, tzinfo=timezone.utc)
+
+
+def stamp_week(core):
+    # In and out twice a day, five days, alternating codes
+    for day in range(5):
+        for i, hours in enumerate((0, 3.5, 4.5, 9)):
+            core.stamp('in' if i % 2 == 0 else 'out', ('work', 'meeting')[day % 2], f"day {day}",
+                       START + timedelta(days=day, hours=hours))
+
+
+def state(core):
+    return (core.conn.execute('SELECT id, timestamp, status, code, comment, epoch_us FROM log ORDER BY id').fetchall(),
+            core.conn.execute('SELECT * FROM daily_totals ORDER BY day, code').fetchall())
+
+
+def middle_days(code=None):
+    return selection(to_epoch_us(START + timedelta(days=1)), to_epoch_us(START + timedelta(days=3, hours=12)), code)
+
+
+@pytest.mark.parametrize('operation, value', [
+    ('shift', timedelta(hours=-20)),
+    ('recode', 'conference'),
+    ('comment', 'moved'),
+    ('replace', ('day', 'dag')),
+    ('delete', None),
+])
+def test_undo_restores_rows_and_totals(core, operation, value):
+    stamp_week(core)
+    before = state(core)
+
+    batch_id, rows = core.apply(batch_write(*middle_days(), operation, value, daily_totals=core.daily_totals))
+
+    assert rows == 12
+    assert state(core) != before
+    assert core.apply(undo_write(core.daily_totals)) == (batch_id, list_batches(core.conn)[0][2], [])
+    assert state(core) == before
+
+
+def test_undo_goes_back_one_batch_at_a_time(core):
+    stamp_week(core)
+    before = state(core)
+    core.apply(batch_write(*middle_days('work'), 'recode', 'conference', daily_totals=core.daily_totals))
+    after_recode = state(core)
+    core.apply(batch_write(*middle_days(), 'delete', daily_totals=core.daily_totals))
+
+    core.apply(undo_write(core.daily_totals))
+    assert state(core) == after_recode
+    core.apply(undo_write(core.daily_totals))
+    assert state(core) == before
+    assert core.apply(undo_write(core.daily_totals)) is None
+
+
+def test_a_selection_without_rows_makes_no_batch(core):
+    stamp_week(core)
+
+    assert core.apply(batch_write(*middle_days('play'), 'delete')) == (None, 0)
+    assert list_batches(core.conn) == []
+
+
+def test_only_the_latest_batches_are_kept(core):
+    stamp_week(core)
+    for i in range(EDIT_JOURNAL_KEEP + 2):
+        core.apply(batch_write(*middle_days(), 'comment', f"pass {i}", daily_totals=core.daily_totals))
+
+    assert len(list_batches(core.conn)) == EDIT_JOURNAL_KEEP
+    assert core.conn.execute('SELECT COUNT(DISTINCT batch_id) FROM edit_journal').fetchone()[0] == EDIT_JOURNAL_KEEP
+
+
+def test_undo_reports_deleted_stamps_that_were_stamped_again(core):
+    stamp_week(core)
+    last_day = selection(to_epoch_us(START + timedelta(days=4)), to_epoch_us(START + timedelta(days=5)))
+    deleted = core.conn.execute(f'SELECT id, timestamp, status, code, comment FROM log WHERE {last_day[0]} ORDER BY id',
+                                last_day[1]).fetchall()
+    core.apply(batch_write(*last_day, 'delete', daily_totals=core.daily_totals))
+    # The same stamp again takes the id it had
+    entry_id, timestamp, status, code, comment = deleted[0]
+    core.stamp(status, code, comment, datetime.fromisoformat(timestamp))
+    before_undo = state(core)[0]
+
+    _, _, skipped = core.apply(undo_write(core.daily_totals))
+
+    assert skipped == [deleted[0]]
+    rows = state(core)[0]
+    assert len(rows) == 20 and [row for row in rows if row[0] == entry_id] == [row for row in before_undo if row[0] == entry_id]
+
+
+def test_undo_leaves_rows_changed_after_the_batch(core):
+    stamp_week(core)
+    core.apply(batch_write(*middle_days(), 'recode', 'conference', daily_totals=core.daily_totals))
+    recoded = [row[0] for row in core.conn.execute(f'SELECT id FROM log WHERE {middle_days()[0]} ORDER BY id',
+                                                   middle_days()[1])]
+    edited, deleted = recoded[0], recoded[1]
+    timestamp, status = core.conn.execute('SELECT timestamp, status FROM log WHERE id = ?', (edited,)).fetchone()
+    core.apply(core.update_write(edited, datetime.fromisoformat(timestamp), status, 'conference', 'by hand'))
+    core.apply(core.delete_write(deleted))
+
+    _, _, skipped = core.apply(undo_write(core.daily_totals))
+
+    assert [row[0] for row in skipped] == [edited, deleted]
+    codes = dict(core.conn.execute('SELECT id, code FROM log'))
+    assert codes[edited] == 'conference' and deleted not in codes
+    assert {codes[entry_id] for entry_id in recoded[2:]} == {'work', 'meeting'}
+    assert core.conn.execute('SELECT comment FROM log WHERE id = ?', (edited,)).fetchone() == ('by hand',)
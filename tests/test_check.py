@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta, timezone
+
+from stamp_batch import undo_write
+from stamp_check import LogChecker, fix_write
+from stamp_db import to_epoch_us
+
+DAY = datetime(2025, 3, 3, 8, tzinfo=timezone.utc)
+
+
+def add(core, status, hours, code='work', timestamp=None, epoch_us=None):
+    # A row as given, bypassing insert_write so broken timestamps can be stored
+    when = DAY + timedelta(hours=hours)
+    return core.conn.execute('INSERT INTO log (timestamp, status, code, comment, epoch_us) VALUES (?, ?, ?, ?, ?)',
+                             (timestamp or when.isoformat(), status, code, '',
+                              to_epoch_us(when) if epoch_us is None else epoch_us)).lastrowid
+
+
+def crafted_log(core):
+    ids = {
+        'session': (add(core, 'in', 0), add(core, 'out', 1)),
+        'duplicate': add(core, 'out', 1),
+        'orphan_out': add(core, 'out', 2),
+        'unclosed_in': add(core, 'in', 3),
+        'naive_timestamp': add(core, 'in', 4, timestamp='2025-03-03T12:00:00'),
+        'offset_timestamp': add(core, 'out', 5, timestamp='2025-03-03T14:00:00+01:00'),
+        'epoch_mismatch': add(core, 'in', 6, epoch_us=to_epoch_us(DAY + timedelta(hours=6, seconds=1))),
+        'long_session': add(core, 'out', 31),
+        'bad_status': add(core, 'pause', 32),
+        'missing_code': add(core, 'in', 33, code=''),
+        'bad_timestamp': add(core, 'out', 34, timestamp='yesterday'),
+        'future': add(core, 'in', 24 * 365 * 100),
+    }
+    core.conn.commit()
+    return ids
+
+
+def issues(core, incremental=False):
+    return {(kind, ids) for kind, ids, _, _ in LogChecker(core.conn).check(incremental)}
+
+
+def test_every_kind_of_issue_is_found(core):
+    ids = crafted_log(core)
+
+    found = issues(core)
+
+    assert found == {
+        ('duplicate', (ids['duplicate'],)),
+        ('orphan_out', (ids['orphan_out'],)),
+        ('unclosed_in', (ids['unclosed_in'], ids['naive_timestamp'])),
+        ('naive_timestamp', (ids['naive_timestamp'],)),
+        ('offset_timestamp', (ids['offset_timestamp'],)),
+        ('epoch_mismatch', (ids['epoch_mismatch'],)),
+        ('long_session', (ids['epoch_mismatch'], ids['long_session'])),
+        ('bad_status', (ids['bad_status'],)),
+        ('missing_code', (ids['missing_code'],)),
+        ('bad_timestamp', (ids['bad_timestamp'],)),
+        ('future', (ids['future'],)),
+    }
+
+
+def test_incremental_check_starts_after_the_last_stamp_checked(core):
+    crafted_log(core)
+    checker = LogChecker(core.conn)
+    list(checker.check())
+    checker.save_position()
+    core.conn.commit()
+    late = add(core, 'out', 24 * 365 * 100 + 1)
+    orphan = add(core, 'out', 24 * 365 * 100 + 2)
+    core.conn.commit()
+
+    assert issues(core, incremental=True) == {('future', (late,)), ('future', (orphan,)), ('orphan_out', (orphan,))}
+
+
+def test_fix_deletes_can_be_undone(core):
+    ids = crafted_log(core)
+    before = core.conn.execute('SELECT * FROM log ORDER BY id').fetchall()
+    fixes = [(kind, ids) for kind, ids, _, _ in LogChecker(core.conn).check()]
+
+    changed, batch_id = core.apply(fix_write(fixes, core.daily_totals))
+
+    # The duplicate, the orphan out and the unclosed in go; three timestamps are rewritten in place
+    assert (changed, batch_id) == (6, 1)
+    assert {kind for kind, _ in issues(core)} == {'long_session', 'bad_status', 'missing_code', 'bad_timestamp', 'future'}
+    assert core.conn.execute('SELECT COUNT(*) FROM log').fetchone()[0] == len(before) - 3
+    assert core.conn.execute("SELECT timestamp FROM log WHERE id = ?",
+                             (ids['offset_timestamp'],)).fetchone()[0] == '2025-03-03T13:00:00+00:00'
+
+    assert core.apply(undo_write(core.daily_totals))[0] == batch_id
+    after = core.conn.execute('SELECT * FROM log ORDER BY id').fetchall()
+    repaired = {ids['naive_timestamp'], ids['offset_timestamp'], ids['epoch_mismatch']}
+    assert [row for row in after if row[0] not in repaired] == [row for row in before if row[0] not in repaired]
@@ -0,0 +1,55 @@
+import sqlite3
+from datetime import datetime, timezone
+
+import stamp_db
+from stamp_db import CURRENT_STATE_REFRESH, to_epoch_us
+
+WHEN = datetime(2025, 3, 3, 7, tzinfo=timezone.utc)
+
+
+def current_state(conn):
+    return conn.execute('SELECT entry_id, epoch_us, status FROM current_state').fetchone()
+
+
+def refreshed(conn):
+    copy = sqlite3.connect(':memory:')
+    conn.backup(copy)
+    for statement in CURRENT_STATE_REFRESH:
+        copy.execute(statement)
+    try:
+        return current_state(copy)
+    finally:
+        copy.close()
+
+
+def insert(conn, status, entry_id=None):
+    conn.execute('INSERT INTO log (id, timestamp, status, code, comment, epoch_us) VALUES (?, ?, ?, ?, ?, ?)',
+                 (entry_id, WHEN.isoformat(), status, 'work', '', to_epoch_us(WHEN)))
+
+
+def test_a_tie_goes_to_the_highest_id(core):
+    insert(core.conn, 'in', 5)
+    insert(core.conn, 'out', 7)
+    # Restored under an older id at the same time, as undo does
+    insert(core.conn, 'in', 6)
+    core.conn.commit()
+
+    assert current_state(core.conn) == (7, to_epoch_us(WHEN), 'out') == refreshed(core.conn)
+
+
+def test_migration_replaces_the_insert_trigger(tmp_path):
+    conn = stamp_db.connect(tmp_path / 'old.db')
+    for migration in stamp_db.MIGRATIONS[:9]:
+        migration(conn)
+    conn.execute('PRAGMA user_version = 9')
+    insert(conn, 'out', 7)
+    insert(conn, 'in', 6)
+    conn.commit()
+    assert current_state(conn)[0] == 6
+
+    stamp_db.migrate(conn)
+
+    assert current_state(conn)[0] == 7
+    insert(conn, 'in', 5)
+    assert current_state(conn)[0] == 7
+    conn.close()
@@ -0,0 +1,84 @@
+import csv
+from datetime import datetime, timedelta, timezone
+
+from pytz import timezone as zone
+
+from stamp_export import export_csv
+from stamp_import import import_file
+
+
+def stamp_day(core, day, count=10):
+    # Alternating ins and outs with microseconds, as the app saves them
+    start = datetime.combine(day, datetime.min.time(), timezone.utc) + timedelta(hours=6, microseconds=123_456)
+    for i in range(count):
+        core.stamp('in' if i % 2 == 0 else 'out', 'work', f"entry {i}", start + timedelta(minutes=47 * i, microseconds=i))
+
+
+def export(core, path, time_zone):
+    query, params, archives = core.export_query('2025-01-01 00:00', '2025-12-31 23:59')
+    return export_csv(core.DB_FILE, path, query, params, time_zone, archives=archives)
+
+
+def test_reimporting_an_export_adds_nothing(core, tmp_path):
+    time_zone = zone('Europe/Oslo')
+    stamp_day(core, datetime(2025, 3, 3).date())
+    path = tmp_path / 'export.csv'
+    assert export(core, path, time_zone) == 10
+
+    stats = import_file(core.conn, path, time_zone, core.daily_totals)
+
+    assert (stats['read'], stats['duplicates'], stats['imported']) == (10, 10, 0)
+    assert core.conn.execute('SELECT COUNT(*) FROM log').fetchone()[0] == 10
+
+
+def test_new_rows_in_an_export_are_imported(core, tmp_path):
+    time_zone = zone('Europe/Oslo')
+    stamp_day(core, datetime(2025, 3, 3).date(), count=4)
+    path = tmp_path / 'export.csv'
+    export(core, path, time_zone)
+    with open(path, 'a', newline='') as file:
+        # Same second as the last stamp but another code, then a later stamp
+        csv.writer(file).writerows([['', '2025-03-03 09:21:00', 'out', 'play', ''],
+                                    ['', '2025-03-03 12:00:00', 'in', 'work', 'new']])
+
+    stats = import_file(core.conn, path, time_zone, core.daily_totals)
+
+    assert (stats['duplicates'], stats['imported']) == (4, 2)
+    assert core.conn.execute('SELECT COUNT(*) FROM log').fetchone()[0] == 6
+
+
+def test_microsecond_timestamps_match_exactly(core, tmp_path):
+    stamp_day(core, datetime(2025, 3, 3).date(), count=1)
+    path = tmp_path / 'import.jsonl'
+    path.write_text('{"timestamp": "2025-03-03T06:00:00.123456+00:00", "status": "in", "code": "work"}\n'
+                    '{"timestamp": "2025-03-03T06:00:00.123457+00:00", "status": "in", "code": "work"}\n')
+
+    stats = import_file(core.conn, path, zone('UTC'))
+
+    assert (stats['duplicates'], stats['imported']) == (1, 1)
+
+
+def test_bulk_import_keeps_search_state_and_totals(core, tmp_path):
+    time_zone = zone('Europe/Oslo')
+    stamp_day(core, datetime(2025, 3, 3).date(), count=3)
+    path = tmp_path / 'import.csv'
+    with open(path, 'w', newline='') as file:
+        # Minute and offset timestamps mixed with naive ones; the last row repeats the one before
+        csv.writer(file).writerows([['timestamp', 'status', 'code', 'comment'],
+                                    ['2025-03-03 10:00', 'in', 'work', 'imported start'],
+                                    ['2025-03-03T10:30:00+00:00', 'out', 'work', 'imported stop'],
+                                    ['2025-03-04 08:00:00', 'in', 'meeting', 'imported open'],
+                                    ['2025-03-04 08:00:00', 'in', 'meeting', 'imported open']])
+
+    stats = import_file(core.conn, path, time_zone, core.daily_totals, rebuild_threshold=0)
+
+    assert (stats['read'], stats['duplicates'], stats['imported']) == (4, 1, 3)
+    assert core.conn.execute('SELECT status, code FROM current_state').fetchone() == ('in', 'meeting')
+    assert core.conn.execute("SELECT COUNT(*) FROM log_fts WHERE log_fts MATCH 'imported'").fetchone()[0] == 3
+    incremental = core.conn.execute('SELECT * FROM daily_totals ORDER BY day, code').fetchall()
+    core.daily_totals.rebuild(core.conn)
+    assert core.conn.execute('SELECT * FROM daily_totals ORDER BY day, code').fetchall() == incremental
+    # The triggers are back for the next stamp
+    core.stamp('out', 'meeting', 'after', datetime(2025, 3, 4, 9, tzinfo=timezone.utc))
+    assert core.conn.execute('SELECT status FROM current_state').fetchone() == ('out',)
+    assert core.conn.execute("SELECT COUNT(*) FROM log_fts WHERE log_fts MATCH 'after'").fetchone()[0] == 1
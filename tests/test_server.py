@@ -0,0 +1,70 @@
+import http.client
+import socket
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from stamp_server import StampClient, StampService, make_server
+
+START = datetime(2025, 3, 3, 7, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def client(core, tmp_path):
+    service = StampService(core, readers=1)
+    server = make_server(service, f"unix://{tmp_path / 'stamp.sock'}")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = StampClient(f"unix://{tmp_path / 'stamp.sock'}")
+    yield client
+    client.close()
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+def test_modify_reads_and_edits_through_the_server(client):
+    ids = [client.stamp('in' if i % 2 == 0 else 'out', 'work', f"stamp {i}", START + timedelta(hours=i))
+           for i in range(5)]
+    window = client.entry_window()
+
+    assert client.latest_id() == ids[-1]
+    assert window.get(ids[2])[1:] == (str(START + timedelta(hours=2)).replace(' ', 'T'), 'in', 'work', 'stamp 2')
+    assert window.adjacent_id(ids[2], 1) == ids[3]
+
+    client.update(ids[2], START + timedelta(hours=2), 'in', 'meeting', 'moved')
+    client.delete(ids[3])
+
+    assert window.get(ids[2])[3:] == ('meeting', 'moved')
+    assert window.adjacent_id(ids[2], 1) == ids[4]
+    assert client.get_entry(ids[3]) is None
+
+
+def dropping_server(path):
+    # Reads each request and hangs up without answering; returns the list of requests it got
+    requests = []
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(path))
+    listener.listen()
+
+    def serve():
+        while True:
+            conn, _ = listener.accept()
+            requests.append(conn.recv(65536).split(b' ')[0].decode())
+            conn.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return requests
+
+
+def test_only_idempotent_requests_are_sent_again(tmp_path):
+    requests = dropping_server(tmp_path / 'drop.sock')
+    client = StampClient(f"unix://{tmp_path / 'drop.sock'}")
+
+    with pytest.raises(http.client.RemoteDisconnected):
+        client.stamp('in', 'work', '', START)
+    assert requests == ['POST']
+    with pytest.raises(http.client.RemoteDisconnected):
+        client.status()
+    assert requests == ['POST', 'GET', 'GET']
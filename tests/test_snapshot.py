@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from stamp_snapshot import COLUMNS, load_snapshot, read_manifest, write_snapshot
+
+START = datetime(2025, 3, 3, 7, tzinfo=timezone.utc)
+
+
+def stamp(core, first, count):
+    for i in range(first, first + count):
+        core.stamp('in' if i % 2 == 0 else 'out', ('work', 'meeting', 'play')[i % 3], f"stamp {i} ø",
+                   START + timedelta(hours=i))
+
+
+def in_log(core):
+    return core.conn.execute('SELECT id, epoch_us, status, code, comment FROM log ORDER BY epoch_us, id').fetchall()
+
+
+def in_snapshot(directory):
+    frame = load_snapshot(directory)
+    epoch_us = frame['timestamp'].dt.tz_convert(None).values.astype('datetime64[us]').astype(np.int64)
+    return list(zip(frame['id'].tolist(), epoch_us.tolist(), frame['status'].astype(str), frame['code'].astype(str),
+                    frame['comment']))
+
+
+def test_first_snapshot_is_full(core, tmp_path):
+    stamp(core, 0, 50)
+
+    stats = write_snapshot(core.DB_FILE, tmp_path / 'snapshot', batch_size=7)
+
+    assert (stats['mode'], stats['added'], stats['rows']) == ('full', 50, 50)
+    assert in_snapshot(tmp_path / 'snapshot') == in_log(core)
+
+
+def test_new_stamps_are_appended(core, tmp_path):
+    stamp(core, 0, 50)
+    write_snapshot(core.DB_FILE, tmp_path / 'snapshot')
+    stamp(core, 50, 20)
+
+    stats = write_snapshot(core.DB_FILE, tmp_path / 'snapshot', batch_size=7)
+
+    assert (stats['mode'], stats['added'], stats['rows']) == ('append', 20, 70)
+    assert in_snapshot(tmp_path / 'snapshot') == in_log(core)
+    assert write_snapshot(core.DB_FILE, tmp_path / 'snapshot')['added'] == 0
+
+
+def test_deleted_stamp_rewrites_the_snapshot(core, tmp_path):
+    stamp(core, 0, 50)
+    write_snapshot(core.DB_FILE, tmp_path / 'snapshot')
+    core.apply(core.delete_write(10))
+    stamp(core, 50, 5)
+
+    stats = write_snapshot(core.DB_FILE, tmp_path / 'snapshot')
+
+    assert (stats['mode'], stats['added'], stats['rows']) == ('full', 54, 54)
+    assert in_snapshot(tmp_path / 'snapshot') == in_log(core)
+
+
+def test_interrupted_append_is_cut_off(core, tmp_path):
+    stamp(core, 0, 50)
+    write_snapshot(core.DB_FILE, tmp_path / 'snapshot')
+    # Data written past the manifest, as by an append that never got to replace it
+    for name in COLUMNS:
+        with open(tmp_path / 'snapshot' / f"{name}.npy", 'ab') as file:
+            file.write(b'\xff' * 64)
+    assert read_manifest(tmp_path / 'snapshot')['rows'] == 50
+    assert in_snapshot(tmp_path / 'snapshot') == in_log(core)
+    stamp(core, 50, 3)
+
+    stats = write_snapshot(core.DB_FILE, tmp_path / 'snapshot')
+
+    assert (stats['mode'], stats['added']) == ('append', 3)
+    assert in_snapshot(tmp_path / 'snapshot') == in_log(core)
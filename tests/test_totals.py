@@ -0,0 +1,103 @@
+import random
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pytz import timezone as zone
+
+from stamp_archive import archive_closed_years
+from stamp_batch import batch_write, selection, undo_write
+import stamp_db
+from stamp_db import to_epoch_us
+from stamp_totals import DailyTotals
+
+# Three weeks around both spring DST changes (US on 9 March, Europe on 30 March)
+START = datetime(2025, 3, 7, tzinfo=timezone.utc)
+SPAN_MINUTES = 26 * 24 * 60
+OPERATIONS = 400
+
+
+def totals(conn):
+    rows = conn.execute('SELECT day, code, seconds, lunch_seconds, sessions, events FROM daily_totals').fetchall()
+    return {(day, code): (seconds, lunch, sessions, events) for day, code, seconds, lunch, sessions, events in rows}
+
+
+def rebuilt(conn, daily_totals):
+    copy = sqlite3.connect(':memory:')
+    conn.backup(copy)
+    daily_totals.rebuild(copy)
+    try:
+        return totals(copy)
+    finally:
+        copy.close()
+
+
+def assert_same(incremental, expected, step):
+    assert incremental.keys() == expected.keys(), step
+    for key, (seconds, lunch, sessions, events) in expected.items():
+        assert incremental[key] == (pytest.approx(seconds), pytest.approx(lunch), sessions, events), (step, key)
+
+
+def random_time(rng):
+    # Whole minutes, so ties on the same epoch come up too
+    return START + timedelta(minutes=rng.randrange(SPAN_MINUTES))
+
+
+def random_write(core, rng, ids):
+    kind = rng.choices(['insert', 'update', 'delete', 'batch', 'undo'], [50, 20, 12, 12, 6])[0]
+    status, code = rng.choice(['in', 'out']), rng.choice(['work', 'meeting', 'play'])
+    if kind == 'insert' or not ids:
+        return 'insert', core.insert_write(random_time(rng), status, code, '')
+    if kind == 'update':
+        return kind, core.update_write(rng.choice(ids), random_time(rng), status, code, '')
+    if kind == 'delete':
+        return kind, core.delete_write(rng.choice(ids))
+    if kind == 'undo':
+        return kind, undo_write(core.daily_totals)
+    first = random_time(rng)
+    where, params = selection(to_epoch_us(first), to_epoch_us(first + timedelta(hours=rng.randrange(1, 72))),
+                              code=rng.choice([None, code]))
+    operation = rng.choice(['shift', 'recode', 'delete'])
+    value = {'shift': timedelta(minutes=rng.randrange(-36 * 60, 36 * 60)), 'recode': code}.get(operation)
+    return f"batch {operation}", batch_write(where, params, operation, value, daily_totals=core.daily_totals)
+
+
+@pytest.mark.parametrize('time_zone', ['UTC', 'Europe/Oslo', 'America/New_York'])
+def test_incremental_totals_match_a_rebuild(core, time_zone):
+    core.time_zone = zone(time_zone)
+    core.daily_totals = DailyTotals(core.time_zone, core.lunch_start, core.lunch_stop)
+    rng = random.Random(time_zone)
+    for step in range(OPERATIONS):
+        ids = [row[0] for row in core.conn.execute('SELECT id FROM log')]
+        kind, write = random_write(core, rng, ids)
+        core.apply(write)
+        assert_same(totals(core.conn), rebuilt(core.conn, core.daily_totals), (step, kind))
+
+
+def test_edits_next_to_an_archived_year_keep_its_totals(core, tmp_path):
+    core.time_zone = zone('UTC')
+    core.daily_totals = DailyTotals(core.time_zone, core.lunch_start, core.lunch_stop, archived=True)
+    for status, when in [('in', datetime(2024, 12, 30, 8)), ('out', datetime(2024, 12, 30, 16)),
+                         ('in', datetime(2024, 12, 31, 22)), ('out', datetime(2025, 1, 1, 2)),
+                         ('in', datetime(2025, 3, 3, 8)), ('out', datetime(2025, 3, 3, 12))]:
+        core.stamp(status, 'work', '', when.replace(tzinfo=timezone.utc))
+    assert [year for year, _, _ in archive_closed_years(core.DB_FILE, tmp_path / 'archive', core.time_zone)] == [2024]
+
+    def check(step):
+        incremental = totals(core.conn)
+        core.daily_totals.rebuild(core.conn, core.archives.partitions(core.daily_totals.window))
+        assert_same(incremental, totals(core.conn), step)
+
+    check('archived')
+    # A stamp written into the archived year, then the log's first stamp, which closes an archived session
+    core.stamp('in', 'work', '', datetime(2024, 12, 30, 18, tzinfo=timezone.utc))
+    check('insert into archived day')
+    first_id = core.conn.execute("SELECT id FROM log WHERE timestamp LIKE '2025-01-01%'").fetchone()[0]
+    core.apply(core.delete_write(first_id))
+    check('delete')
+    # On a connection of its own, as the app's and the server's writers have
+    writer = stamp_db.connect(core.DB_FILE)
+    stamp_db.run_write(writer, core.insert_write(datetime(2025, 1, 1, 3, tzinfo=timezone.utc), 'out', 'work', ''))
+    writer.close()
+    check('insert')
+    assert totals(core.conn)[('2024-12-31', 'work')][:3] == (5 * 3600, 0, 1)